@@ -1,91 +1,203 @@
-import numpy as np
-
-def compute_separations(particles):   
-    """  
-    Compute the separation between particles in each component, stored in 
-    an array named separations. 
-    
-    separations[i][j][k] gives the value of the separation between 
-    the i_th and j_th particle in k_th component. 
-    
-    Parameters:
-    - particles (list): Particles in the system
-
-    Returns:
-    - separations (3d array): Vector separation of each pair of particles.
-    """   
-    # n is the number of particles
-    n = len(particles)
-    
-    # Size as described in document
-    separations = np.zeros((n,n,3)) 
-    
-    # looping for the ith particle
-    for i in range(n):
-         for j in range(i+1, n):
-                # Distance between particles given a coordinate k. 
-                d = ((particles[j].position) - (particles[i].position))
-                
-                # The vector from a to b is the negative of the vector from b to a.
-                separations[i][j] = d
-                separations[j][i] = -d
-                
-    return separations
-
-def compute_forces_potential(particles, separations):    
-    """
-    This function returns two values. The first is the total force acting on each particle, in 3 components. 
-    in an array named total_force_array. Total_force_array[i][k] refers to the total force on particle i in kth component..
-    
-    The second is the total potential energy of the system.
-    
-    Parameters:
-    - particles (list): Particles in the system
-    - separations (3d array): Vector separation of each pair of particles
-    
-    Returns: 
-    - force (2d array): Force on each particle 
-    - potential (float): Total system potential energy      
-    """ 
-    # Unit is AU^3 M_earth^-1 day^-2
-    G = 1
-
-    # N is the number of particles
-    N = len(particles)
-
-    # An array storing the force between 2 particles (i and j) in each component (n)
-    force_array = np.zeros((N,N,3))
-      
-    potential = 0
-    for i in range(N):
-        # Only calculate once for each pair, by Newton's Third Law, Force from a to b has same magnitude but different direction as Force from b to a
-        for j in range(i+1, N):
-            
-            # Separation_i_j has size 3, it contains the distance between particle i and particle j (in all 3 components)
-            # We have not specified which n component to sum over, so it returns all the components of forces between i and j 
-            separation_i_j = separations[i,j]
-                   
-            mod_distance = np.linalg.norm(separation_i_j)
-                 
-            # Storing masses for particles i and j in variables to shorten code length
-            m_i = particles[i].mass
-            m_j = particles[j].mass
-            
-            # Force between two particles is given by GMm\vec{r}/r^3
-            force=(G*(m_i)*(m_j)*(separation_i_j))/mod_distance**3
-            
-            # Total Potential is given by -GMm/r, summed up between all particles
-            potential+=-G*(m_i)*(m_j)/mod_distance
-            
-            # Assigning the value of force for each component into the force_array. Second line uses Newton's third law
-        
-            force_array[i,j]=force
-            force_array[j,i]=-force
-    
-    # We are asked to calculate the total force on each particle, so we sum up
-    forces=np.sum(force_array, axis=1)
-    
-    return forces, potential 
-
-    
-  
\ No newline at end of file
+import numpy as np
+
+# Unit is AU^3 M_earth^-1 day^-2
+G = 1
+
+# Particles per tile in the blocked kernel; systems up to this size use the direct kernel
+DEFAULT_BLOCK_SIZE = 256
+
+def compute_separations_array(positions):
+    """
+    Vectorised separations from a position array.
+
+    separations[..., i, j, k] gives the value of the separation between
+    the i_th and j_th particle in k_th component, i.e. r_j - r_i.
+
+    Parameters:
+    - positions (array): Positions of shape (..., N, 3)
+
+    Returns:
+    - separations (array): Vector separations of shape (..., N, N, 3)
+    """
+    return positions[..., np.newaxis, :, :] - positions[..., :, np.newaxis, :]
+
+def compute_forces_potential_array(masses, separations, softening=0.0):
+    """
+    Vectorised forces and potential from a mass array and a separation array.
+
+    Parameters:
+    - masses (array): Masses of shape (..., N)
+    - separations (array): Vector separations of shape (..., N, N, 3)
+    - softening (float): Plummer softening length, 0 for exact Newtonian gravity
+
+    Returns:
+    - forces (array): Force on each particle, shape (..., N, 3)
+    - potential (float or array): Total potential energy of each system, shape (...)
+    """
+    forces, potential, _ = _forces_potential_distances(masses, separations, softening)
+    return forces, potential
+
+def compute_forces_potential_distances(positions, masses, softening=0.0):
+    """
+    Fused evaluation of forces, potential and pair distances from positions, sharing one
+    separation array and one distance computation between all three results.
+
+    Parameters:
+    - positions (array): Positions of shape (..., N, 3)
+    - masses (array): Masses of shape (..., N)
+    - softening (float): Plummer softening length, 0 for exact Newtonian gravity
+
+    Returns:
+    - forces (array): Force on each particle, shape (..., N, 3)
+    - potential (float or array): Total potential energy of each system, shape (...)
+    - distances (array): Pair distances of shape (..., N, N), not softened
+    """
+    return _forces_potential_distances(masses, compute_separations_array(positions), softening)
+
+def _forces_potential_distances(masses, separations, softening=0.0):
+    n = masses.shape[-1]
+    squared_distances = np.sum(separations ** 2, axis=-1)
+    distances = np.sqrt(squared_distances)
+    # Plummer softening replaces r by sqrt(r^2 + eps^2) in the force and potential
+    softened = np.sqrt(squared_distances + softening ** 2) if softening else distances
+
+    # The diagonal holds the zero self-separations, which do not contribute
+    inv_distances = np.zeros_like(distances)
+    off_diagonal = ~np.eye(n, dtype=bool)
+    inv_distances[..., off_diagonal] = 1 / softened[..., off_diagonal]
+
+    # G*m_i*m_j for every pair
+    mass_products = G * masses[..., :, np.newaxis] * masses[..., np.newaxis, :]
+
+    # Force between two particles is given by GMm\vec{r}/r^3, summed over j
+    forces = np.einsum('...ij,...ijk->...ik', mass_products * inv_distances ** 3, separations)
+
+    # Total Potential is given by -GMm/r; every pair appears twice in the full matrix
+    potential = -0.5 * np.sum(mass_products * inv_distances, axis=(-2, -1))
+
+    return forces, potential, distances
+
+def compute_forces_potential_tiled(positions, masses, block_size=DEFAULT_BLOCK_SIZE, softening=0.0):
+    """
+    Blocked evaluation of forces and potential for a single system of N particles, with
+    O(N * block_size) working memory instead of (N, N, 3) separation arrays.
+
+    Tiles (I, J) with J >= I are visited once; each pair force is added to the particles
+    of tile I and subtracted from those of tile J by Newton's third law. Systems with at most
+    block_size particles use the direct kernel, so small systems give identical results.
+
+    Parameters:
+    - positions (array): Positions of shape (N, 3)
+    - masses (array): Masses of shape (N,)
+    - block_size (int): Particles per tile
+    - softening (float): Plummer softening length, 0 for exact Newtonian gravity
+
+    Returns:
+    - forces (array): Force on each particle, shape (N, 3)
+    - potential (float): Total potential energy
+    - max_distance (float): Largest pair distance, for the proximity check
+    """
+    n = masses.shape[-1]
+    if n <= block_size:
+        forces, potential, distances = compute_forces_potential_distances(positions, masses, softening)
+        return forces, potential, np.max(distances, initial=0.0)
+
+    forces = np.zeros((n, 3))
+    potential = 0.0
+    max_squared_distance = 0.0
+    for i0 in range(0, n, block_size):
+        i1 = min(i0 + block_size, n)
+        positions_i = positions[i0:i1]
+        masses_i = masses[i0:i1]
+        for j0 in range(i0, n, block_size):
+            j1 = min(j0 + block_size, n)
+
+            # separations[a][b] = r_j - r_i for particle a of tile I and b of tile J
+            separations = positions[j0:j1][np.newaxis, :, :] - positions_i[:, np.newaxis, :]
+            squared_distances = np.sum(separations ** 2, axis=-1)
+            max_squared_distance = max(max_squared_distance, float(np.max(squared_distances)))
+
+            with np.errstate(divide='ignore'):
+                inv_distances = 1 / np.sqrt(squared_distances + softening ** 2)
+            if i0 == j0:
+                # Diagonal tile: keep each pair once and drop the self-interaction
+                inv_distances = np.triu(inv_distances, k=1)
+
+            mass_products = G * masses_i[:, np.newaxis] * masses[j0:j1][np.newaxis, :]
+            weights = mass_products * inv_distances ** 3
+            forces[i0:i1] += np.einsum('ab,abk->ak', weights, separations)
+            forces[j0:j1] -= np.einsum('ab,abk->bk', weights, separations)
+            potential -= np.sum(mass_products * inv_distances)
+
+    return forces, potential, np.sqrt(max_squared_distance)
+
+def compute_tracer_accelerations(tracer_positions, positions, masses, softening=0.0):
+    """
+    Accelerations of massless tracers in the field of massive particles, in one O(M * N) pass.
+
+    The loop runs over the N massive particles, so the working memory is a few (M, 3) arrays
+    however many tracers there are. Tracers do not act on the massive particles or on each other.
+
+    Parameters:
+    - tracer_positions (array): Tracer positions of shape (M, 3)
+    - positions (array): Positions of the massive particles, shape (N, 3)
+    - masses (array): Masses of shape (N,)
+    - softening (float): Plummer softening length, 0 for exact Newtonian gravity
+
+    Returns:
+    - accelerations (array): Acceleration of each tracer, shape (M, 3)
+    - nearest (array): Distance of each tracer to the closest massive particle, shape (M,), not softened
+    - nearest_index (array): Index of that particle, shape (M,)
+    """
+    accelerations = np.zeros_like(tracer_positions)
+    squared_distances = np.empty((masses.shape[-1], len(tracer_positions)))
+    for j in range(masses.shape[-1]):
+        separations = positions[j] - tracer_positions
+        squared_distances[j] = np.einsum('ak,ak->a', separations, separations)
+        softened = squared_distances[j] + softening ** 2 if softening else squared_distances[j]
+        # Gm/r^3 without a fractional power; a tracer exactly on a particle gets an infinite
+        # acceleration, which callers mask out
+        weights = np.sqrt(softened)
+        weights *= softened
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(G * masses[j], weights, out=weights)
+        separations *= weights[:, np.newaxis]
+        accelerations += separations
+    nearest_index = np.argmin(squared_distances, axis=0)
+    return accelerations, np.sqrt(np.min(squared_distances, axis=0)), nearest_index
+
+def compute_separations(particles):
+    """
+    Compute the separation between particles in each component, stored in
+    an array named separations.
+
+    separations[i][j][k] gives the value of the separation between
+    the i_th and j_th particle in k_th component.
+
+    Parameters:
+    - particles (list): Particles in the system
+
+    Returns:
+    - separations (3d array): Vector separation of each pair of particles.
+    """
+    positions = np.array([particle.position for particle in particles], dtype=float).reshape(-1, 3)
+    return compute_separations_array(positions)
+
+def compute_forces_potential(particles, separations):
+    """
+    This function returns two values. The first is the total force acting on each particle, in 3 components.
+    in an array named total_force_array. Total_force_array[i][k] refers to the total force on particle i in kth component..
+
+    The second is the total potential energy of the system.
+
+    Parameters:
+    - particles (list): Particles in the system
+    - separations (3d array): Vector separation of each pair of particles
+
+    Returns:
+    - force (2d array): Force on each particle
+    - potential (float): Total system potential energy
+    """
+    masses = np.array([particle.mass for particle in particles], dtype=float)
+    forces, potential = compute_forces_potential_array(masses, separations)
+    return forces, float(potential)
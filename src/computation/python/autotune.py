@@ -0,0 +1,144 @@
+"""
+Automatic choice of the time step from a relative energy error budget.
+
+The energy error of a splitting scheme of order p behaves like C*dt^p, where the constant C
+depends on the orbit: a wide hierarchical system may have a C many orders of magnitude smaller
+than a configuration with close encounters. tune_dt measures C for one system by short probe
+integrations. Each probe runs the scheme over the same first probe_time time units and records
+the relative energy deviation, (max E - min E) / |E0|, the quantity reported in the run statistics.
+Every probe covers the whole window, however many steps that takes, so that the fit compares
+errors over the same stretch of the orbit; a probe at a small step costs no more than the start
+of the run at that step.
+C is then fitted with the order fixed, in log space over all probes, and the next probe is taken
+at the dt that the fit predicts will meet the tolerance. The search stops once a probe meets
+the tolerance and the fit does not promise a step much larger than it. If no probe meets the
+tolerance, or one still fails at MIN_DT, the tuning records that the tolerance was not met.
+
+The first probe starts from the error constant the scheme registry measured on the figure-eight
+orbit, so for typical three-body orbits one or two probes suffice. The chosen dt is finally
+shrunk to divide the output interval, so that output frames stay on the output grid.
+
+The prediction only covers the probe window: symplectic schemes keep the energy error of
+regular orbits bounded, but a chaotic orbit can meet a closer encounter later in the run, so
+the final dt carries a safety factor.
+"""
+import math
+import numpy as np
+from typing import Dict, List, Sequence, Tuple
+
+from system_state import SystemState
+from force_cache import ForceCache
+from schemes import SplittingScheme
+
+# Length in time units of the probe integrations
+PROBE_TIME = 5.0
+MAX_PROBES = 6
+# The chosen dt is this fraction of the dt predicted to meet the tolerance exactly
+SAFETY = 0.9
+# A probe that meets the tolerance is accepted unless the fit predicts a dt this much larger
+ACCEPT_RATIO = 1.25
+# Energy deviations below this are round-off and carry no information about C
+ROUNDOFF = 1e-14
+MIN_DT = 1e-7
+
+def probe_energy_error(state: SystemState, scheme: SplittingScheme, dt: float, duration: float, backend,
+                       proximity_threshold: float = np.inf) -> float:
+    """
+    Relative energy deviation of a fixed-step run of duration time units from state, which is
+    left unchanged. A probe stops early if the system breaks up past the proximity threshold.
+    """
+    state = SystemState(list(state.labels), state.masses.copy(), state.positions.copy(), state.velocities.copy())
+    cache = ForceCache(backend.evaluate)
+    _, potential, _ = cache.evaluate(state)
+    initial = state.kinetic_energy() + potential
+    lowest = highest = initial
+    for _ in range(max(1, int(round(duration / dt)))):
+        backend.symplectic_step(state, dt, scheme.coefficients, scheme.stages, cache)
+        _, potential, distances = cache.evaluate(state)
+        energy = state.kinetic_energy() + potential
+        lowest, highest = min(lowest, energy), max(highest, energy)
+        if np.any(distances > proximity_threshold):
+            break
+    return float(abs((highest - lowest) / initial))
+
+def fit_error_constant(probes: Sequence[Tuple[float, float]], order: int) -> float:
+    """
+    Least squares fit of log(error) = log(C) + order*log(dt) with the order fixed. Probes at
+    round-off level only bound C from above; if every probe is, the bound of the largest dt is used.
+    """
+    usable = [(dt, error) for dt, error in probes if error > ROUNDOFF]
+    if not usable:
+        dt = max(dt for dt, _ in probes)
+        return ROUNDOFF / dt ** order
+    return math.exp(np.mean([math.log(error) - order * math.log(dt) for dt, error in usable]))
+
+def snap_to_output_grid(dt: float, output_interval: float) -> float:
+    """Largest step not above dt that divides the output interval"""
+    return output_interval / math.ceil(output_interval / dt - 1e-9)
+
+def tune_dt(state: SystemState, scheme: SplittingScheme, tolerance: float, backend, max_dt: float,
+            output_interval: float, probe_time: float = PROBE_TIME, proximity_threshold: float = np.inf) -> Dict:
+    """
+    Choose the largest dt, at most max_dt, expected to keep the relative energy deviation of
+    the scheme on this system within tolerance.
+
+    Parameters
+    ----------
+    state: SystemState
+        initial state of the run, with the centre of mass velocity already removed
+    scheme: SplittingScheme
+        the integration scheme; its order fixes the slope of the fit
+    tolerance: float
+        relative energy error budget
+    backend:
+        compute backend used for the probes (see backends.py)
+    max_dt: float
+        upper bound of the step
+    output_interval: float
+        the chosen step divides it
+    probe_time: float
+        time units covered by each probe
+
+    Returns
+    -------
+    dict with the chosen dt, the predicted error C*dt^order, the fitted error constant, the
+    tolerance, whether the probe at the chosen step met it, the probe time and the (dt, error)
+    pair of every probe
+    """
+    if tolerance <= 0:
+        raise ValueError("The energy tolerance must be positive")
+    order = scheme.order
+
+    def predicted_dt(constant: float) -> float:
+        return min(max_dt, max(MIN_DT, SAFETY * (tolerance / constant) ** (1 / order)))
+
+    dt = predicted_dt(scheme.error_constant) if scheme.error_constant else max_dt
+    probes: List[Tuple[float, float]] = []
+    for _ in range(MAX_PROBES):
+        error = probe_energy_error(state, scheme, dt, probe_time, backend, proximity_threshold)
+        probes.append((dt, error))
+        candidate = predicted_dt(fit_error_constant(probes, order))
+        if error <= tolerance and (candidate <= ACCEPT_RATIO * dt or dt >= max_dt):
+            break
+        if error > tolerance and dt <= MIN_DT:
+            break
+        dt = candidate
+    else:
+        # No probe settled the search: keep the largest step seen to meet the tolerance
+        passing = [dt for dt, error in probes if error <= tolerance]
+        dt = max(passing) if passing else min(dt for dt, _ in probes)
+    # The chosen step is always a probed one; it fails the tolerance when no probe met it
+    tolerance_met = dict(probes)[dt] <= tolerance
+
+    constant = fit_error_constant(probes, order)
+    dt = snap_to_output_grid(dt, output_interval)
+    return {
+        "tolerance": tolerance,
+        "dt": dt,
+        "predicted_error": constant * dt ** order,
+        "error_constant": constant,
+        "order": order,
+        "tolerance_met": tolerance_met,
+        "probe_time": probe_time,
+        "probes": [[probe_dt, error] for probe_dt, error in probes],
+    }
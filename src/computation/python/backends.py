@@ -0,0 +1,289 @@
+"""
+Compute backends for the force evaluation and the symplectic step loop.
+
+A backend provides
+    evaluate(positions, masses) -> (forces, potential, distances)
+    symplectic_step(state, dt, coeffs, steps, cache)
+    advance(state, cache, dt, coeffs, steps, current_time, max_steps, stop_time, proximity_threshold)
+        -> (steps_taken, current_time, terminated)
+
+advance runs up to max_steps whole integration steps, stopping early after the step on which
+the time reaches stop_time or a pair separation exceeds the proximity threshold. On return the
+cache holds the forces, potential and distances at the final positions.
+
+NumpyBackend is the vectorised reference implementation. NumbaBackend compiles the whole
+multi-stage loop (kicks, drifts, pairwise forces and the proximity check) into one call and is
+only available when Numba is installed; get_backend("numba") falls back to NumPy otherwise.
+
+Either backend accepts force_solver="tree" to evaluate single systems larger than a tree leaf
+with the Barnes-Hut code in barnes_hut (opening parameter theta); smaller systems, including
+the three-body configurations, and stacked ensembles always use direct summation.
+
+Running this module checks that the available backends agree to PARITY_TOLERANCE.
+"""
+import warnings
+import numpy as np
+from typing import Dict, List, Tuple
+
+import Forces_and_Separations
+import barnes_hut
+from force_cache import ForceCache
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    numba = None
+    NUMBA_AVAILABLE = False
+
+# Maximum relative difference allowed between backends in check_parity
+PARITY_TOLERANCE = 1e-9
+
+FORCE_SOLVERS = ("direct", "tree")
+
+# Module constants are frozen into the compiled kernels
+_G = Forces_and_Separations.G
+
+class NumpyBackend:
+    """
+    Reference backend built on the vectorised kernels in Forces_and_Separations. Single systems
+    larger than block_size use the tiled kernel, whose third result is the largest pair distance
+    rather than the full distance matrix; both work with the proximity check. With the tree
+    solver the third result is barnes_hut.max_distance_estimate.
+    """
+    name = "numpy"
+
+    def __init__(self, softening: float = 0.0, block_size: int = Forces_and_Separations.DEFAULT_BLOCK_SIZE,
+                 force_solver: str = "direct", theta: float = 0.5, quadrupole: bool = False,
+                 leaf_size: int = 8):
+        if force_solver not in FORCE_SOLVERS:
+            raise ValueError(f"Unknown force solver: {force_solver}")
+        self.softening = softening
+        self.block_size = block_size
+        self.force_solver = force_solver
+        self.theta = theta
+        self.quadrupole = quadrupole
+        self.leaf_size = leaf_size
+
+    def uses_tree(self, positions: np.ndarray) -> bool:
+        """Whether evaluate uses the Barnes-Hut solver for these positions"""
+        return self.force_solver == "tree" and positions.ndim == 2 and positions.shape[0] > self.leaf_size
+
+    def evaluate(self, positions: np.ndarray, masses: np.ndarray):
+        if self.uses_tree(positions):
+            forces, potential = barnes_hut.compute_forces_potential_tree(
+                positions, masses, self.theta, self.quadrupole, self.softening, self.leaf_size)
+            return forces, potential, barnes_hut.max_distance_estimate(positions, masses)
+        if positions.ndim == 2 and positions.shape[0] > self.block_size:
+            return Forces_and_Separations.compute_forces_potential_tiled(positions, masses, self.block_size, self.softening)
+        return Forces_and_Separations.compute_forces_potential_distances(positions, masses, self.softening)
+
+    def symplectic_step(self, state, dt: float, coeffs: Dict[str, List[float]], steps: int, cache: ForceCache) -> None:
+        """Perform one step of symplectic integration in place"""
+        for k in range(steps):
+            # First update all velocities, then all positions; stages without a kick need no forces
+            if coeffs["c"][k] != 0:
+                forces, _, _ = cache.evaluate(state)
+                state.kick(forces, dt, coeffs["c"][k])
+            if coeffs["d"][k] != 0:
+                state.drift(dt, coeffs["d"][k])
+                cache.invalidate()
+
+    def advance(self, state, cache: ForceCache, dt: float, coeffs: Dict[str, List[float]], steps: int,
+                current_time: float, max_steps: int, stop_time: float, proximity_threshold: float) -> Tuple[int, float, bool]:
+        """Run up to max_steps integration steps, stopping at stop_time or on a proximity violation"""
+        for n in range(max_steps):
+            self.symplectic_step(state, dt, coeffs, steps, cache)
+            current_time += dt
+            _, _, distances = cache.evaluate(state)
+            if np.any(distances > proximity_threshold):
+                return n + 1, current_time, True
+            if current_time >= stop_time:
+                return n + 1, current_time, False
+        return max_steps, current_time, False
+
+if NUMBA_AVAILABLE:
+    @numba.njit(cache=True, fastmath=False)
+    def _numba_forces(positions, masses, forces, distances, softening):
+        """Pairwise forces, potential and distances using Newton's third law"""
+        eps2 = softening * softening
+        n = positions.shape[0]
+        potential = 0.0
+        forces[:, :] = 0.0
+        for i in range(n):
+            distances[i, i] = 0.0
+            for j in range(i + 1, n):
+                dx = positions[j, 0] - positions[i, 0]
+                dy = positions[j, 1] - positions[i, 1]
+                dz = positions[j, 2] - positions[i, 2]
+                r2 = dx * dx + dy * dy + dz * dz
+                r = np.sqrt(r2)
+                distances[i, j] = r
+                distances[j, i] = r
+                if eps2 != 0.0:
+                    r = np.sqrt(r2 + eps2)
+                mm = _G * masses[i] * masses[j]
+                f = mm / (r * r * r)
+                forces[i, 0] += f * dx
+                forces[i, 1] += f * dy
+                forces[i, 2] += f * dz
+                forces[j, 0] -= f * dx
+                forces[j, 1] -= f * dy
+                forces[j, 2] -= f * dz
+                potential -= mm / r
+        return potential
+
+    @numba.njit(cache=True, fastmath=False)
+    def _numba_advance(positions, velocities, masses, forces, distances, have_forces, dt, c, d,
+                       current_time, max_steps, stop_time, proximity_threshold, softening):
+        """
+        Integration loop: returns (steps taken, time, terminated, potential, force evaluations).
+        forces and distances hold the values at the final positions on return.
+        """
+        n = positions.shape[0]
+        n_stages = c.shape[0]
+        evaluations = 0
+        potential = 0.0
+        valid = have_forces
+        for step in range(max_steps):
+            for k in range(n_stages):
+                if c[k] != 0.0:
+                    if not valid:
+                        potential = _numba_forces(positions, masses, forces, distances, softening)
+                        evaluations += 1
+                        valid = True
+                    kick = c[k] * dt
+                    for i in range(n):
+                        for a in range(3):
+                            velocities[i, a] += kick * forces[i, a] / masses[i]
+                if d[k] != 0.0:
+                    drift = d[k] * dt
+                    for i in range(n):
+                        for a in range(3):
+                            positions[i, a] += drift * velocities[i, a]
+                    valid = False
+            current_time += dt
+            if not valid:
+                potential = _numba_forces(positions, masses, forces, distances, softening)
+                evaluations += 1
+                valid = True
+            terminated = False
+            for i in range(n):
+                for j in range(i + 1, n):
+                    if distances[i, j] > proximity_threshold:
+                        terminated = True
+            if terminated:
+                return step + 1, current_time, True, potential, evaluations
+            if current_time >= stop_time:
+                return step + 1, current_time, False, potential, evaluations
+        return max_steps, current_time, False, potential, evaluations
+
+class NumbaBackend(NumpyBackend):
+    """Backend that JIT-compiles the force kernel and the whole step loop with Numba"""
+    name = "numba"
+
+    def __init__(self, softening: float = 0.0, block_size: int = Forces_and_Separations.DEFAULT_BLOCK_SIZE,
+                 force_solver: str = "direct", theta: float = 0.5, quadrupole: bool = False,
+                 leaf_size: int = 8):
+        if not NUMBA_AVAILABLE:
+            raise ImportError("The numba backend requires the numba package")
+        super().__init__(softening, block_size, force_solver, theta, quadrupole, leaf_size)
+
+    def evaluate(self, positions: np.ndarray, masses: np.ndarray):
+        if positions.ndim != 2 or self.uses_tree(positions):
+            # Stacked ensembles and tree runs use the NumPy kernels
+            return super().evaluate(positions, masses)
+        n = positions.shape[0]
+        forces = np.zeros((n, 3))
+        distances = np.zeros((n, n))
+        potential = _numba_forces(np.ascontiguousarray(positions), np.ascontiguousarray(masses), forces, distances,
+                                  self.softening)
+        return forces, potential, distances
+
+    def symplectic_step(self, state, dt: float, coeffs: Dict[str, List[float]], steps: int, cache: ForceCache) -> None:
+        if state.positions.ndim != 2 or self.uses_tree(state.positions):
+            return super().symplectic_step(state, dt, coeffs, steps, cache)
+        self.advance(state, cache, dt, coeffs, steps, 0.0, 1, np.inf, np.inf)
+
+    def advance(self, state, cache: ForceCache, dt: float, coeffs: Dict[str, List[float]], steps: int,
+                current_time: float, max_steps: int, stop_time: float, proximity_threshold: float) -> Tuple[int, float, bool]:
+        if state.positions.ndim != 2 or self.uses_tree(state.positions):
+            return super().advance(state, cache, dt, coeffs, steps, current_time, max_steps, stop_time, proximity_threshold)
+        n = state.n_particles
+        have_forces = cache.valid
+        forces = np.array(cache.forces, dtype=float) if have_forces else np.zeros((n, 3))
+        distances = np.array(cache.distances, dtype=float) if have_forces else np.zeros((n, n))
+        potential = cache.potential if have_forces else 0.0
+        c = np.asarray(coeffs["c"][:steps], dtype=float)
+        d = np.asarray(coeffs["d"][:steps], dtype=float)
+        steps_taken, current_time, terminated, new_potential, evaluations = _numba_advance(
+            state.positions, state.velocities, state.masses, forces, distances, have_forces,
+            dt, c, d, current_time, max_steps, stop_time, proximity_threshold, self.softening)
+        if evaluations == 0:
+            new_potential = potential
+        cache.store(forces, new_potential, distances, evaluations)
+        return steps_taken, current_time, terminated
+
+BACKENDS = {"numpy": NumpyBackend, "numba": NumbaBackend}
+
+def get_backend(name: str = "numpy", **options):
+    """
+    Return a backend instance by name, falling back to NumPy when Numba is unavailable.
+    Options (softening, block_size, force_solver, theta, quadrupole, leaf_size) are passed to
+    the backend constructor.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}")
+    if name == "numba" and not NUMBA_AVAILABLE:
+        warnings.warn("numba is not installed; falling back to the numpy backend", RuntimeWarning)
+        return NumpyBackend(**options)
+    return BACKENDS[name](**options)
+
+def available_backends() -> List[str]:
+    """Names of the backends usable in this environment"""
+    return [name for name in BACKENDS if name != "numba" or NUMBA_AVAILABLE]
+
+def check_parity(coeffs: Dict[str, List[float]], steps: int, n_particles: int = 3, n_steps: int = 200,
+                 dt: float = 1e-3, seed: int = 0, tolerance: float = PARITY_TOLERANCE,
+                 **options) -> Dict[str, float]:
+    """
+    Compare every available backend against NumPy on a random bound configuration: one force
+    evaluation and a short integration. Options (e.g. softening) are passed to every backend.
+    Returns the largest relative difference per backend and raises AssertionError if any
+    exceeds the tolerance.
+    """
+    from system_state import SystemState
+
+    rng = np.random.default_rng(seed)
+    masses = rng.uniform(0.5, 1.5, n_particles)
+    positions = rng.uniform(-1.0, 1.0, (n_particles, 3))
+    velocities = rng.uniform(-0.3, 0.3, (n_particles, 3))
+    labels = [str(i) for i in range(n_particles)]
+
+    def run(backend):
+        state = SystemState(labels, masses, positions.copy(), velocities.copy())
+        state.remove_com_velocity()
+        cache = ForceCache(backend.evaluate)
+        forces, potential, _ = backend.evaluate(state.positions, state.masses)
+        backend.advance(state, cache, dt, coeffs, steps, 0.0, n_steps, np.inf, np.inf)
+        return forces, potential, state.positions, state.velocities
+
+    reference = run(NumpyBackend(**options))
+    differences = {}
+    for name in available_backends():
+        result = run(BACKENDS[name](**options))
+        differences[name] = max(
+            float(np.max(np.abs(a - b)) / max(float(np.max(np.abs(b))), 1e-300)) for a, b in zip(result, reference))
+        if differences[name] > tolerance:
+            raise AssertionError(f"Backend {name} differs from numpy by {differences[name]:.3e} (tolerance {tolerance:.1e})")
+    return differences
+
+if __name__ == "__main__":
+    from schemes import SCHEMES
+
+    for name, scheme in SCHEMES.items():
+        for n_particles in (3, 8):
+            differences = check_parity(scheme.coefficients, scheme.stages, n_particles)
+            print(f"{name}, N={n_particles}: " +
+                  ", ".join(f"{name} {difference:.2e}" for name, difference in differences.items()))
+    print(f"All backends agree to {PARITY_TOLERANCE:.0e}")
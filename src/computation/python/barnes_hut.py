@@ -0,0 +1,199 @@
+"""
+Barnes-Hut tree code for large-N force evaluation.
+
+The octree is stored in flat arrays. Particles are permuted so that every node covers a
+contiguous slice of the permuted order, and each node stores its centre, half width, mass,
+centre of mass and (optionally) traceless quadrupole moment. Forces are computed by walking
+the tree once per node with the whole group of target particles still interested in it, so
+the Python loop runs over nodes while the work per node is vectorised over particles.
+
+A node is accepted as a single multipole when size / distance < theta and the target lies
+outside the node's cell; otherwise its children are opened, and leaves are summed directly.
+"""
+import numpy as np
+from typing import Tuple
+
+import Forces_and_Separations
+
+class Octree(object):
+    """
+    Flat-array octree over a set of particles.
+
+    Attributes
+    ----------
+    order: [N] permutation; node k covers particles order[start[k]:end[k]]
+    start, end: [K] particle slice of each node
+    children: [K,8] child node indices, -1 where absent (all -1 for leaves)
+    centre: [K,3] geometric centre of each cell
+    half_size: [K] half the side length of each cell
+    mass: [K] total mass in each node
+    com: [K,3] centre of mass of each node
+    quadrupole: [K,3,3] traceless quadrupole moment about the centre of mass, or None
+    """
+
+    def __init__(self, positions: np.ndarray, masses: np.ndarray, leaf_size: int = 8, quadrupole: bool = False):
+        """
+        Builds the tree.
+
+        Parameters
+        ----------
+        positions: [N,3] float array
+        masses: [N] float array
+        leaf_size: int
+            maximum number of particles in a leaf
+        quadrupole: bool
+            also compute quadrupole moments of every node
+        """
+        n = len(masses)
+        self.order = np.arange(n)
+        lower = positions.min(axis=0)
+        upper = positions.max(axis=0)
+        # Slightly enlarged cube so that every particle lies strictly inside the root cell
+        root_half = 0.5 * float(np.max(upper - lower)) * (1 + 1e-9) + 1e-300
+
+        start, end, children, centre, half_size = [0], [n], [[-1] * 8], [0.5 * (lower + upper)], [root_half]
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            s, e = start[node], end[node]
+            if e - s <= leaf_size or half_size[node] < 1e-12 * root_half:
+                continue
+            indices = self.order[s:e]
+            relative = positions[indices] > centre[node]
+            octant = relative[:, 0] * 1 + relative[:, 1] * 2 + relative[:, 2] * 4
+            sort = np.argsort(octant, kind="stable")
+            self.order[s:e] = indices[sort]
+            counts = np.bincount(octant, minlength=8)
+            offset = s
+            for child_octant in range(8):
+                count = counts[child_octant]
+                if count == 0:
+                    continue
+                sign = np.array([child_octant & 1, (child_octant >> 1) & 1, (child_octant >> 2) & 1]) * 2 - 1
+                child = len(start)
+                start.append(offset)
+                end.append(offset + count)
+                children.append([-1] * 8)
+                centre.append(centre[node] + sign * 0.5 * half_size[node])
+                half_size.append(0.5 * half_size[node])
+                children[node][child_octant] = child
+                stack.append(child)
+                offset += count
+
+        self.start = np.array(start)
+        self.end = np.array(end)
+        self.children = np.array(children)
+        self.centre = np.array(centre)
+        self.half_size = np.array(half_size)
+        self.is_leaf = np.all(self.children < 0, axis=1)
+
+        # Multipole moments of every node from its particle slice
+        k = len(start)
+        self.mass = np.zeros(k)
+        self.com = np.zeros((k, 3))
+        self.quadrupole = np.zeros((k, 3, 3)) if quadrupole else None
+        sorted_positions = positions[self.order]
+        sorted_masses = masses[self.order]
+        cumulative_mass = np.concatenate([[0.0], np.cumsum(sorted_masses)])
+        cumulative_moment = np.concatenate([np.zeros((1, 3)), np.cumsum(sorted_masses[:, np.newaxis] * sorted_positions, axis=0)])
+        self.mass = cumulative_mass[self.end] - cumulative_mass[self.start]
+        self.com = (cumulative_moment[self.end] - cumulative_moment[self.start]) / self.mass[:, np.newaxis]
+        if quadrupole:
+            for node in range(k):
+                d = sorted_positions[self.start[node]:self.end[node]] - self.com[node]
+                m = sorted_masses[self.start[node]:self.end[node]]
+                self.quadrupole[node] = (3 * np.einsum('p,pi,pj->ij', m, d, d)
+                                         - np.eye(3) * np.sum(m * np.sum(d ** 2, axis=1)))
+
+def compute_forces_potential_tree(positions: np.ndarray, masses: np.ndarray, theta: float = 0.5,
+                                  quadrupole: bool = False, softening: float = 0.0, leaf_size: int = 8) -> Tuple[np.ndarray, float]:
+    """
+    Approximate forces and potential with a Barnes-Hut tree, with the same contract as
+    Forces_and_Separations.compute_forces_potential. Systems no larger than a leaf are
+    summed directly.
+
+    Parameters:
+    - positions (array): Positions of shape (N, 3)
+    - masses (array): Masses of shape (N,)
+    - theta (float): Multipole acceptance parameter; 0 reproduces direct summation
+    - quadrupole (bool): Add quadrupole corrections to accepted nodes
+    - softening (float): Plummer softening length
+    - leaf_size (int): Maximum particles per leaf
+
+    Returns:
+    - forces (array): Force on each particle, shape (N, 3)
+    - potential (float): Total system potential energy
+    """
+    G = Forces_and_Separations.G
+    n = len(masses)
+    if n <= leaf_size:
+        forces, potential, _ = Forces_and_Separations.compute_forces_potential_distances(positions, masses, softening)
+        return forces, float(potential)
+
+    tree = Octree(positions, masses, leaf_size, quadrupole)
+    eps2 = softening ** 2
+    acceleration = np.zeros((n, 3))
+    potential_per_mass = np.zeros(n)
+
+    stack = [(0, np.arange(n))]
+    while stack:
+        node, targets = stack.pop()
+        target_positions = positions[targets]
+
+        # r points from the node's centre of mass to each target
+        r = target_positions - tree.com[node]
+        r2 = np.sum(r ** 2, axis=1)
+        size = 2 * tree.half_size[node]
+        outside = np.any(np.abs(target_positions - tree.centre[node]) > tree.half_size[node], axis=1)
+        accept = outside & (size * size < theta * theta * r2)
+
+        if np.any(accept):
+            accepted = targets[accept]
+            ra = r[accept]
+            r2a = r2[accept] + eps2
+            inv_r = 1 / np.sqrt(r2a)
+            inv_r3 = inv_r / r2a
+            acceleration[accepted] -= G * tree.mass[node] * ra * inv_r3[:, np.newaxis]
+            potential_per_mass[accepted] -= G * tree.mass[node] * inv_r
+            if tree.quadrupole is not None:
+                q = tree.quadrupole[node]
+                qr = ra @ q
+                rqr = np.sum(qr * ra, axis=1)
+                inv_r5 = inv_r3 / r2a
+                acceleration[accepted] += G * (qr * inv_r5[:, np.newaxis]
+                                               - 2.5 * (rqr * inv_r5 / r2a)[:, np.newaxis] * ra)
+                potential_per_mass[accepted] -= 0.5 * G * rqr * inv_r5
+
+        remaining = targets[~accept]
+        if len(remaining) == 0:
+            continue
+        if tree.is_leaf[node]:
+            # Direct summation against the leaf's particles, skipping self-interaction
+            sources = tree.order[tree.start[node]:tree.end[node]]
+            separations = positions[sources][np.newaxis, :, :] - positions[remaining][:, np.newaxis, :]
+            squared = np.sum(separations ** 2, axis=-1) + eps2
+            with np.errstate(divide='ignore'):
+                inv = 1 / np.sqrt(squared)
+            inv[remaining[:, np.newaxis] == sources[np.newaxis, :]] = 0.0
+            weights = G * masses[sources][np.newaxis, :] * inv
+            acceleration[remaining] += np.einsum('ts,tsk->tk', weights * inv ** 2, separations)
+            potential_per_mass[remaining] -= np.sum(weights, axis=1)
+        else:
+            for child in tree.children[node]:
+                if child >= 0:
+                    stack.append((child, remaining))
+
+    forces = masses[:, np.newaxis] * acceleration
+    # Every pair contributes to the potential of both of its particles
+    potential = 0.5 * float(np.sum(masses * potential_per_mass))
+    return forces, potential
+
+def max_distance_estimate(positions: np.ndarray, masses: np.ndarray) -> float:
+    """
+    O(N) lower bound on the largest pair distance, for the proximity check: the largest
+    distance from the particle farthest from the centre of mass to any other particle. It is
+    a true pair distance, so exceeding the threshold implies the exact check would as well.
+    """
+    com = np.sum(masses[:, np.newaxis] * positions, axis=0) / np.sum(masses)
+    farthest = positions[np.argmax(np.sum((positions - com) ** 2, axis=1))]
+    return float(np.sqrt(np.max(np.sum((positions - farthest) ** 2, axis=1))))
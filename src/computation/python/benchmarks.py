@@ -0,0 +1,387 @@
+"""
+Performance benchmarks of the force evaluation and the integrators.
+
+Suites:
+
+    forces   force evaluations/s and pair interactions/s of each backend and force solver,
+             for random bound systems of increasing N
+    step     steps/s and force evaluations/s of every method on the figure-eight orbit, through
+             Integrator.symplectic_step (the Python stage loop) and through backend.advance (the
+             production loop, compiled by the numba backend)
+    batch    member steps/s of ensemble_step for increasing batch sizes
+    pareto   wall time against relative energy deviation for every orbit of an initial
+             conditions file, method and dt, with the Pareto-optimal runs of each orbit marked
+
+Rates are the best of several repeats of a workload sized to run for at least MIN_TIME
+seconds. Peak memory is measured with tracemalloc in a separate, untimed run. Results are
+written as JSON: metadata about the machine and library versions, and one record per
+measurement with the benchmark name, its parameters and its metrics.
+
+Compare two result files with
+
+    python benchmarks.py compare baseline.json results.json [--threshold 0.1]
+
+which matches records by benchmark and parameters and reports every metric that is worse
+than the baseline by more than the threshold (rates lower, times, memory and errors higher),
+exiting with status 1 if there is any regression.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from system_state import SystemState
+from force_cache import ForceCache
+from backends import get_backend, available_backends
+from schemes import get_scheme, parse_method
+from integration_loop_refactored import Integrator, InitialCondition, parse_initial_conditions
+
+SUITES = ("forces", "step", "batch", "pareto")
+DEFAULT_INITIAL_CONDITIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data",
+                                          "initial_conditions.txt")
+# Minimum duration of one timed repeat, and the number of repeats of which the best is kept
+MIN_TIME = 0.2
+REPEATS = 3
+# Direction of each metric: 1 if higher is better, -1 if lower is better
+METRICS = {
+    "steps_per_second": 1,
+    "force_evaluations_per_second": 1,
+    "evaluations_per_second": 1,
+    "interactions_per_second": 1,
+    "member_steps_per_second": 1,
+    "peak_memory_bytes": -1,
+    "wall_time": -1,
+    "energy_error": -1,
+}
+# Differences below these are noise and never count as regressions
+METRIC_FLOORS = {"energy_error": 1e-12, "peak_memory_bytes": 64 * 1024}
+
+def measure_rate(run: Callable[[int], None], min_time: float = MIN_TIME, repeats: int = REPEATS) -> float:
+    """
+    Units of work per second of run(n), which performs n units. n is doubled until one call
+    takes min_time; the best of repeats calls of that size is reported.
+    """
+    n = 1
+    while True:
+        start = time.perf_counter()
+        run(n)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        n *= 2
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        run(n)
+        best = min(best, time.perf_counter() - start)
+    return n / best
+
+def peak_memory(run: Callable[[], None]) -> int:
+    """Peak bytes allocated through Python and NumPy while run() executes"""
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def random_state(n_particles: int, seed: int = 0) -> SystemState:
+    """A random system of n_particles equal-mass particles of total mass 1 in a unit sphere, in its centre of mass frame"""
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(n_particles, 3))
+    positions = directions / np.linalg.norm(directions, axis=1, keepdims=True) * rng.uniform(0, 1, (n_particles, 1)) ** (1 / 3)
+    velocities = rng.normal(scale=0.1, size=(n_particles, 3))
+    state = SystemState([str(i) for i in range(n_particles)], np.ones(n_particles) / n_particles, positions, velocities)
+    state.remove_com_velocity()
+    return state
+
+def record(benchmark: str, params: Dict, metrics: Dict) -> Dict:
+    return {"benchmark": benchmark, "params": params, "metrics": metrics}
+
+def bench_forces(sizes: Sequence[int], backends: Sequence[str], tree_from: int = 256) -> List[Dict]:
+    """Force evaluation throughput for each size, backend and, from tree_from particles, force solver"""
+    records = []
+    for n in sizes:
+        state = random_state(n)
+        for backend_name in backends:
+            for solver in ("direct", "tree") if n >= tree_from else ("direct",):
+                backend = get_backend(backend_name, force_solver=solver)
+                # Compile or warm up outside the timing
+                backend.evaluate(state.positions, state.masses)
+
+                def run(count: int) -> None:
+                    for _ in range(count):
+                        backend.evaluate(state.positions, state.masses)
+
+                rate = measure_rate(run)
+                records.append(record("forces", {"backend": backend_name, "force_solver": solver, "n_particles": n}, {
+                    "evaluations_per_second": rate,
+                    "interactions_per_second": rate * n * (n - 1) / 2,
+                    "peak_memory_bytes": peak_memory(lambda: run(1)),
+                }))
+    return records
+
+def bench_step(initial_condition: InitialCondition, methods: Sequence[Union[int, str]], backends: Sequence[str],
+               dt: float = 1e-3) -> List[Dict]:
+    """Step throughput of every method and backend through the Python stage loop and through advance"""
+    records = []
+    for backend_name in backends:
+        backend = get_backend(backend_name)
+        for method in methods:
+            scheme = get_scheme(method)
+            for loop in ("symplectic_step", "advance"):
+                state = SystemState.from_particles(initial_condition.particles)
+                state.remove_com_velocity()
+                cache = ForceCache(backend.evaluate)
+
+                if loop == "symplectic_step":
+                    def run(count: int) -> None:
+                        for _ in range(count):
+                            Integrator.symplectic_step(state, dt, scheme.coefficients, scheme.stages, cache, backend)
+                else:
+                    def run(count: int) -> None:
+                        backend.advance(state, cache, dt, scheme.coefficients, scheme.stages, 0.0, count, np.inf, np.inf)
+
+                run(1)
+                before = cache.evaluations
+                run(100)
+                evaluations_per_step = (cache.evaluations - before) / 100
+                rate = measure_rate(run)
+                records.append(record("step", {"backend": backend_name, "method": method, "loop": loop,
+                                               "orbit": initial_condition.name, "dt": dt}, {
+                    "steps_per_second": rate,
+                    "force_evaluations_per_second": rate * evaluations_per_step,
+                    "peak_memory_bytes": peak_memory(lambda: run(100)),
+                }))
+    return records
+
+def bench_batch(initial_condition: InitialCondition, batch_sizes: Sequence[int], method: Union[int, str] = 4,
+                dt: float = 1e-3) -> List[Dict]:
+    """Ensemble throughput for copies of one orbit at each batch size"""
+    from ensemble import EnsembleState, stack_coefficients, ensemble_step
+
+    records = []
+    for batch_size in batch_sizes:
+        state = EnsembleState.from_members([(initial_condition, method)] * batch_size)
+        state.remove_com_velocity()
+        c, d = stack_coefficients(state.methods)
+        cache = ForceCache()
+
+        def run(count: int) -> None:
+            for _ in range(count):
+                ensemble_step(state, dt, c, d, cache)
+
+        rate = measure_rate(run)
+        records.append(record("batch", {"method": method, "batch_size": batch_size, "orbit": initial_condition.name, "dt": dt}, {
+            "steps_per_second": rate,
+            "member_steps_per_second": rate * batch_size,
+            "peak_memory_bytes": peak_memory(lambda: run(10)),
+        }))
+    return records
+
+def energy_run(initial_condition: InitialCondition, method: Union[int, str], dt: float, duration: float,
+               backend, sample_interval: float = 0.05) -> Dict:
+    """
+    Integrate for duration with the production loop and sample the energy every sample_interval.
+    Returns the wall time of the integration, the relative energy deviation (max E - min E)/|E0|,
+    the steps and the force evaluations.
+    """
+    scheme = get_scheme(method)
+    state = SystemState.from_particles(initial_condition.particles)
+    state.remove_com_velocity()
+    cache = ForceCache(backend.evaluate)
+    _, potential, _ = cache.evaluate(state)
+    initial = state.kinetic_energy() + potential
+    lowest = highest = initial
+    current_time = 0.0
+    steps = 0
+    wall_time = 0.0
+    n_samples = int(round(duration / sample_interval))
+    for sample in range(1, n_samples + 1):
+        start = time.perf_counter()
+        taken, current_time, _ = backend.advance(state, cache, dt, scheme.coefficients, scheme.stages, current_time,
+                                                 2 ** 62, sample * sample_interval - 1e-9 * dt, np.inf)
+        wall_time += time.perf_counter() - start
+        steps += taken
+        _, potential, _ = cache.evaluate(state)
+        energy = state.kinetic_energy() + potential
+        lowest, highest = min(lowest, energy), max(highest, energy)
+    return {"wall_time": wall_time, "energy_error": float(abs((highest - lowest) / initial)),
+            "steps": steps, "force_evaluations": cache.evaluations}
+
+def pareto_front(points: Sequence[Dict]) -> List[bool]:
+    """Whether each point is Pareto-optimal in (wall_time, energy_error)"""
+    return [not any(other["wall_time"] <= point["wall_time"] and other["energy_error"] <= point["energy_error"]
+                    and (other["wall_time"] < point["wall_time"] or other["energy_error"] < point["energy_error"])
+                    for other in points)
+            for point in points]
+
+def bench_pareto(initial_conditions: Sequence[InitialCondition], methods: Sequence[Union[int, str]],
+                 dts: Sequence[float], duration: float, backend_name: str = "numpy") -> List[Dict]:
+    """Energy deviation against wall time of every orbit, method and dt"""
+    backend = get_backend(backend_name)
+    records = []
+    for initial_condition in initial_conditions:
+        runs = []
+        for method in methods:
+            for dt in dts:
+                metrics = energy_run(initial_condition, method, dt, duration, backend)
+                runs.append(record("pareto", {"backend": backend_name, "orbit": initial_condition.name, "method": method,
+                                              "dt": dt, "duration": duration}, metrics))
+        for run, optimal in zip(runs, pareto_front([run["metrics"] for run in runs])):
+            run["metrics"]["pareto_optimal"] = optimal
+        records += runs
+    return records
+
+def metadata() -> Dict:
+    """Machine, library and source revision of a benchmark run"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "backends": available_backends(),
+    }
+
+def run_benchmarks(suites: Sequence[str], initial_conditions_file: str = DEFAULT_INITIAL_CONDITIONS,
+                   methods: Optional[Sequence[Union[int, str]]] = None, quick: bool = False,
+                   progress: Callable[[str], None] = print) -> Dict:
+    """
+    Run the selected suites and return the results document. quick uses fewer sizes, orbits
+    and steps, for a smoke test rather than a measurement.
+    """
+    methods = list(methods or Integrator.COEFFICIENTS)
+    backends = available_backends()
+    initial_conditions = parse_initial_conditions(initial_conditions_file)
+    figure_eight = next((ic for ic in initial_conditions if ic.name == "fo8"), initial_conditions[0])
+    records = []
+    for suite in suites:
+        progress(f"Running {suite} benchmarks")
+        if suite == "forces":
+            records += bench_forces([3, 32, 256] if quick else [3, 8, 32, 128, 512, 2048], backends)
+        elif suite == "step":
+            records += bench_step(figure_eight, methods, backends)
+        elif suite == "batch":
+            records += bench_batch(figure_eight, [1, 16, 256] if quick else [1, 4, 16, 64, 256, 1024])
+        elif suite == "pareto":
+            orbits = initial_conditions[:2] if quick else initial_conditions
+            dts = [0.01, 0.0025] if quick else [0.02, 0.01, 0.005, 0.0025, 0.00125]
+            records += bench_pareto(orbits, methods, dts, 1.0 if quick else 5.0)
+        else:
+            raise ValueError(f"Unknown benchmark suite: {suite}")
+    return {"metadata": metadata(), "records": records}
+
+def record_key(entry: Dict) -> str:
+    return entry["benchmark"] + " " + json.dumps(entry["params"], sort_keys=True)
+
+def compare(baseline: Dict, results: Dict, threshold: float = 0.1) -> Dict[str, List]:
+    """
+    Compare results with a baseline. Returns the regressions and improvements beyond the
+    threshold as (key, metric, baseline value, new value, relative change) tuples, and the
+    keys of records missing from either file.
+    """
+    old = {record_key(entry): entry["metrics"] for entry in baseline["records"]}
+    new = {record_key(entry): entry["metrics"] for entry in results["records"]}
+    comparison = {"regressions": [], "improvements": [],
+                  "missing": sorted(set(old) - set(new)), "added": sorted(set(new) - set(old))}
+    for key in sorted(set(old) & set(new)):
+        for metric, direction in METRICS.items():
+            if metric not in old[key] or metric not in new[key]:
+                continue
+            before, after = old[key][metric], new[key][metric]
+            if abs(after - before) <= METRIC_FLOORS.get(metric, 0.0):
+                continue
+            change = (after - before) / before if before else np.inf
+            if direction * change < -threshold:
+                comparison["regressions"].append((key, metric, before, after, change))
+            elif direction * change > threshold:
+                comparison["improvements"].append((key, metric, before, after, change))
+    return comparison
+
+def print_results(results: Dict) -> None:
+    for entry in results["records"]:
+        params = ", ".join(f"{name}={value}" for name, value in entry["params"].items())
+        metrics = ", ".join(f"{name}={value:.4g}" if isinstance(value, float) else f"{name}={value}"
+                            for name, value in entry["metrics"].items())
+        print(f"{entry['benchmark']:7s} {params}: {metrics}")
+
+def print_pareto(results: Dict) -> None:
+    """Pareto-optimal method and dt choices of each orbit, cheapest first"""
+    fronts: Dict[str, List[Dict]] = {}
+    for entry in results["records"]:
+        if entry["benchmark"] == "pareto" and entry["metrics"]["pareto_optimal"]:
+            fronts.setdefault(entry["params"]["orbit"], []).append(entry)
+    for orbit, front in fronts.items():
+        print(f"\nPareto front for {orbit}:")
+        for entry in sorted(front, key=lambda entry: entry["metrics"]["wall_time"]):
+            print(f"  method {entry['params']['method']!s:>10} dt {entry['params']['dt']:<8g} "
+                  f"{entry['metrics']['wall_time']:.4f} s  energy deviation {entry['metrics']['energy_error']:.3e}")
+
+def print_comparison(comparison: Dict) -> None:
+    for title, entries in (("Regressions", comparison["regressions"]), ("Improvements", comparison["improvements"])):
+        if entries:
+            print(f"{title}:")
+            for key, metric, before, after, change in entries:
+                print(f"  {key}: {metric} {before:.4g} -> {after:.4g} ({change:+.1%})")
+    for title, keys in (("Missing from the results", comparison["missing"]), ("Not in the baseline", comparison["added"])):
+        if keys:
+            print(f"{title}: {len(keys)} records")
+    if not comparison["regressions"]:
+        print("No regressions")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the force evaluation and the integrators")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run = subparsers.add_parser("run", help="Run benchmark suites and write the results")
+    run.add_argument("--suites", nargs="+", choices=SUITES, default=list(SUITES))
+    run.add_argument("--methods", type=parse_method, nargs="+", metavar="METHOD",
+                     help="Methods to benchmark (default: the numbered methods)")
+    run.add_argument("--initial-conditions", default=DEFAULT_INITIAL_CONDITIONS,
+                     help="Orbits of the step, batch and pareto suites")
+    run.add_argument("--output", default="benchmark_results.json", help="Results file")
+    run.add_argument("--quick", action="store_true", help="Small sizes and short runs, for a smoke test")
+    run.add_argument("--baseline", help="Compare the results with this results file")
+    run.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+    compare_parser = subparsers.add_parser("compare", help="Flag regressions of results against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_benchmarks(args.suites, args.initial_conditions, args.methods, args.quick)
+        print_results(results)
+        print_pareto(results)
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=1)
+        print(f"\nResults saved to {args.output}")
+        baseline_path = args.baseline
+    else:
+        with open(args.results, "r") as results_file:
+            results = json.load(results_file)
+        baseline_path = args.baseline
+
+    if baseline_path is not None:
+        with open(baseline_path, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        comparison = compare(baseline, results, args.threshold)
+        print_comparison(comparison)
+        if comparison["regressions"]:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
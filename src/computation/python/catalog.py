@@ -0,0 +1,312 @@
+"""
+Streaming loader for large libraries of initial conditions.
+
+A catalog is a file in the initial conditions format: a configuration name on its own line,
+followed by one line per particle,
+
+    <label> <mass> <x> <y> <z> <vx> <vy> <vz>
+
+where particle labels start with a digit and names do not. Catalogs of thousands of orbits are
+read lazily: configurations are scanned as byte blocks and parsed in batches, with the numeric
+columns of a whole batch converted by one NumPy call into contiguous arrays
+
+    masses      [B,N]
+    positions   [B,N,3]
+    velocities  [B,N,3]
+
+Consecutive configurations with the same number of particles share a batch. Particle lines are
+validated (field count, numeric and finite values, positive masses) with their line numbers in
+the error. Configurations without particles are skipped, as parse_initial_conditions does.
+
+Catalog builds an index next to the file (<file>.index.json) with the byte offset, length and
+particle count of every configuration, so that one orbit, a list of orbits or a shard of the
+catalog is read without scanning the file again. The index records the size and modification
+time of the catalog and is rebuilt when they change.
+"""
+import argparse
+import json
+import os
+import numpy as np
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from particle3D import Particle3D
+from system_state import SystemState
+
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+DEFAULT_BATCH_SIZE = 1024
+PARTICLE_FIELDS = 8
+
+class CatalogEntry:
+    """Location of one configuration in a catalog file"""
+
+    def __init__(self, name: str, offset: int, length: int, n_particles: int, line: int):
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.n_particles = n_particles
+        self.line = line
+
+    def to_list(self) -> list:
+        return [self.name, self.offset, self.length, self.n_particles, self.line]
+
+class CatalogBatch:
+    """
+    Configurations with the same number of particles, as stacked arrays.
+
+    Attributes
+    ----------
+    names: list of B configuration names
+    labels: list of B lists of N particle labels
+    masses: [B,N] float array of particle masses
+    positions: [B,N,3] float array of particle positions
+    velocities: [B,N,3] float array of particle velocities
+    """
+
+    def __init__(self, names: List[str], labels: List[List[str]], masses: np.ndarray, positions: np.ndarray,
+                 velocities: np.ndarray):
+        self.names = names
+        self.labels = labels
+        self.masses = masses
+        self.positions = positions
+        self.velocities = velocities
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def system_state(self, b: int) -> SystemState:
+        """Configuration b as a SystemState"""
+        return SystemState(self.labels[b], self.masses[b].copy(), self.positions[b].copy(), self.velocities[b].copy())
+
+    def initial_condition(self, b: int):
+        """Configuration b as an InitialCondition of Particle3D instances"""
+        from integration_loop_refactored import InitialCondition
+
+        return InitialCondition(self.names[b], [
+            Particle3D(label, float(mass), position.copy(), velocity.copy())
+            for label, mass, position, velocity in zip(self.labels[b], self.masses[b], self.positions[b], self.velocities[b])])
+
+def _is_name(line: bytes) -> bool:
+    return not line[:1].isdigit()
+
+def scan_blocks(path: str) -> Iterator[Tuple[CatalogEntry, bytes]]:
+    """
+    Stream the configurations of a catalog as (entry, block) pairs, where block holds the raw
+    bytes of its name and particle lines. Configurations without particles are skipped.
+    """
+    with open(path, "rb") as catalog_file:
+        offset = 0
+        name = None
+        start = start_line = 0
+        n_particles = 0
+        lines: List[bytes] = []
+        for line_number, line in enumerate(catalog_file, 1):
+            stripped = line.strip()
+            if stripped:
+                if _is_name(stripped):
+                    if name is not None and n_particles:
+                        yield CatalogEntry(name, start, offset - start, n_particles, start_line), b"".join(lines)
+                    name = stripped.decode("utf-8")
+                    start, start_line = offset, line_number
+                    n_particles = 0
+                    lines = []
+                elif name is not None:
+                    n_particles += 1
+            if name is not None:
+                lines.append(line)
+            offset += len(line)
+        if name is not None and n_particles:
+            yield CatalogEntry(name, start, offset - start, n_particles, start_line), b"".join(lines)
+
+def parse_blocks(path: str, entries: Sequence[CatalogEntry], blocks: Sequence[bytes]) -> CatalogBatch:
+    """Parse the blocks of configurations with equal particle counts into one batch"""
+    n_particles = entries[0].n_particles
+    labels: List[List[str]] = []
+    fields: List[bytes] = []
+    for entry, block in zip(entries, blocks):
+        if entry.n_particles != n_particles:
+            raise ValueError(f"{path}: a batch mixes {n_particles} and {entry.n_particles} particle configurations")
+        rows = [line.split() for line in block.splitlines()[1:] if line.strip()]
+        config_labels = []
+        for i, row in enumerate(rows):
+            if len(row) != PARTICLE_FIELDS:
+                raise ValueError(f"{path}:{_line_of(entry, block, i)}: expected {PARTICLE_FIELDS} fields "
+                                 f"(label, mass, position, velocity), found {len(row)}")
+            config_labels.append(row[0].decode("utf-8"))
+            fields += row[1:]
+        labels.append(config_labels)
+    try:
+        values = np.array(fields, dtype=float).reshape(len(entries), n_particles, PARTICLE_FIELDS - 1)
+    except ValueError:
+        # Locate the offending line
+        for entry, block in zip(entries, blocks):
+            for i, line in enumerate(line for line in block.splitlines()[1:] if line.strip()):
+                try:
+                    [float(value) for value in line.split()[1:]]
+                except ValueError:
+                    raise ValueError(f"{path}:{_line_of(entry, block, i)}: non-numeric particle value") from None
+        raise
+    masses = values[..., 0]
+    if not np.all(np.isfinite(values)):
+        b, p = np.argwhere(~np.all(np.isfinite(values), axis=-1))[0]
+        raise ValueError(f"{path}:{_line_of(entries[b], blocks[b], p)}: non-finite particle value")
+    if np.any(masses <= 0):
+        b, p = np.argwhere(masses <= 0)[0]
+        raise ValueError(f"{path}:{_line_of(entries[b], blocks[b], p)}: particle masses must be positive")
+    return CatalogBatch([entry.name for entry in entries], labels, np.ascontiguousarray(masses),
+                        np.ascontiguousarray(values[..., 1:4]), np.ascontiguousarray(values[..., 4:7]))
+
+def _line_of(entry: CatalogEntry, block: bytes, particle: int) -> int:
+    """File line number of particle `particle` of a configuration"""
+    lines = block.splitlines()
+    seen = -1
+    for i, line in enumerate(lines[1:], 1):
+        if line.strip():
+            seen += 1
+            if seen == particle:
+                return entry.line + i
+    return entry.line
+
+def _batched(path: str, pairs: Iterable[Tuple[CatalogEntry, bytes]], batch_size: int) -> Iterator[CatalogBatch]:
+    """Group consecutive configurations with equal particle counts into batches of at most batch_size"""
+    entries: List[CatalogEntry] = []
+    blocks: List[bytes] = []
+    for entry, block in pairs:
+        if entries and (len(entries) == batch_size or entry.n_particles != entries[0].n_particles):
+            yield parse_blocks(path, entries, blocks)
+            entries, blocks = [], []
+        entries.append(entry)
+        blocks.append(block)
+    if entries:
+        yield parse_blocks(path, entries, blocks)
+
+def iter_batches(path: str, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[CatalogBatch]:
+    """Stream every configuration of a catalog in batches, without an index"""
+    return _batched(path, scan_blocks(path), batch_size)
+
+class Catalog:
+    """
+    Indexed access to a catalog file.
+
+    Parameters
+    ----------
+    path: str
+        catalog in the initial conditions format
+    index_path: str
+        index file (default: next to the catalog); the index is kept in memory only if it
+        cannot be written
+
+    Attributes
+    ----------
+    entries: CatalogEntry of every configuration, in file order
+    names: configuration names in file order; names are looked up by their first occurrence
+    """
+
+    def __init__(self, path: str, index_path: Optional[str] = None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self.entries = self._load_index()
+        self.names = [entry.name for entry in self.entries]
+        self._by_name: Dict[str, CatalogEntry] = {}
+        for entry in self.entries:
+            self._by_name.setdefault(entry.name, entry)
+
+    def _source(self) -> Dict:
+        status = os.stat(self.path)
+        return {"size": status.st_size, "mtime_ns": status.st_mtime_ns}
+
+    def _load_index(self) -> List[CatalogEntry]:
+        source = self._source()
+        try:
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+            if index.get("version") == INDEX_VERSION and index.get("source") == source:
+                return [CatalogEntry(*entry) for entry in index["entries"]]
+        except (OSError, ValueError, TypeError):
+            pass
+        entries = [entry for entry, _ in scan_blocks(self.path)]
+        index = {"version": INDEX_VERSION, "catalog": os.path.basename(self.path), "source": source,
+                 "entries": [entry.to_list() for entry in entries]}
+        try:
+            temporary = self.index_path + ".tmp"
+            with open(temporary, "w") as index_file:
+                json.dump(index, index_file)
+            os.replace(temporary, self.index_path)
+        except OSError:
+            pass
+        return entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._by_name
+
+    def entry(self, name: str) -> CatalogEntry:
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise KeyError(f"No configuration named {name} in {self.path}") from None
+
+    def select(self, names: Optional[Sequence[str]] = None, shard: Optional[Tuple[int, int]] = None) -> List[CatalogEntry]:
+        """
+        Entries of the given names (default: all), restricted to shard (i, n): every n-th
+        entry starting at the i-th, so that n workers with shards 0..n-1 cover the catalog once
+        """
+        entries = [self.entry(name) for name in names] if names is not None else list(self.entries)
+        if shard is not None:
+            index, count = shard
+            if not 0 <= index < count:
+                raise ValueError(f"Invalid shard {index}/{count}")
+            entries = entries[index::count]
+        return entries
+
+    def _read(self, entries: Sequence[CatalogEntry]) -> Iterator[Tuple[CatalogEntry, bytes]]:
+        with open(self.path, "rb") as catalog_file:
+            for entry in entries:
+                catalog_file.seek(entry.offset)
+                yield entry, catalog_file.read(entry.length)
+
+    def batches(self, names: Optional[Sequence[str]] = None, shard: Optional[Tuple[int, int]] = None,
+                batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[CatalogBatch]:
+        """Stream the selected configurations in batches of equal particle counts"""
+        return _batched(self.path, self._read(self.select(names, shard)), batch_size)
+
+    def load(self, name: str) -> CatalogBatch:
+        """A single configuration as a batch of one"""
+        entry = self.entry(name)
+        return parse_blocks(self.path, [entry], [block for _, block in self._read([entry])])
+
+    def initial_conditions(self, names: Optional[Sequence[str]] = None, shard: Optional[Tuple[int, int]] = None,
+                           batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator:
+        """Stream the selected configurations as InitialCondition instances"""
+        for batch in self.batches(names, shard, batch_size):
+            for b in range(len(batch)):
+                yield batch.initial_condition(b)
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a shard given as I/N, 0 <= I < N"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shards are given as I/N, not {value}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard {value}")
+    return index, count
+
+def main():
+    parser = argparse.ArgumentParser(description="Index and inspect a catalog of initial conditions")
+    parser.add_argument("path", help="Catalog in the initial conditions format")
+    parser.add_argument("--orbits", nargs="+", help="Show only these configurations")
+    parser.add_argument("--shard", type=parse_shard, help="Show only shard I/N of the catalog")
+    args = parser.parse_args()
+
+    catalog = Catalog(args.path)
+    print(f"{len(catalog)} configurations in {args.path}, index {catalog.index_path}")
+    for batch in catalog.batches(args.orbits, args.shard):
+        for b, name in enumerate(batch.names):
+            state = batch.system_state(b)
+            print(f"{name}: {state.n_particles} particles, total mass {np.sum(batch.masses[b]):g}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Checkpoints of single-system runs, for resuming killed runs and extending finished ones.
+
+A checkpoint is an .npz file next to the trajectory holding the positions, velocities and
+cached forces of the system, and a JSON record of the run: time, next output time, step index,
+status, force evaluation count, the diagnostics totals and the size of the trajectory file when
+the checkpoint was taken. Checkpoints are only taken right after an output frame has been
+flushed (and at the end of a run), so resuming truncates the trajectory to that size, appends,
+and reproduces the uninterrupted run bit for bit.
+
+Files are written to a temporary name and renamed, so a run killed while checkpointing keeps
+its previous checkpoint.
+"""
+import json
+import os
+import numpy as np
+from typing import Dict
+
+CHECKPOINT_VERSION = 1
+
+def checkpoint_path(output_path: str) -> str:
+    """Checkpoint file belonging to a trajectory file"""
+    return os.path.splitext(output_path)[0] + ".checkpoint.npz"
+
+def save_checkpoint(path: str, state, force_cache, diagnostics, run: Dict) -> None:
+    """
+    Atomically write a checkpoint.
+
+    Parameters
+    ----------
+    path: str
+        checkpoint file
+    state: SystemState being integrated
+    force_cache: ForceCache holding the forces at the current positions, if valid
+    diagnostics: Diagnostics of the run
+    run: dict
+        JSON-serialisable run record (method, dt, current_time, next_output_time,
+        steps_completed, status, output_bytes, force_evaluations, ...)
+    """
+    diagnostics_state = diagnostics.state_dict()
+    history = diagnostics_state.pop("history")
+    record = dict(run, version=CHECKPOINT_VERSION, labels=list(state.labels), diagnostics=diagnostics_state)
+    arrays = {"positions": state.positions, "velocities": state.velocities, "masses": state.masses}
+    if force_cache.valid:
+        record["potential"] = float(force_cache.potential)
+        arrays["forces"] = force_cache.forces
+        arrays["distances"] = force_cache.distances
+    if history is not None:
+        arrays["history"] = history
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        np.savez(f, record=np.array(json.dumps(record)), **arrays)
+    os.replace(temporary, path)
+
+def load_checkpoint(path: str) -> Dict:
+    """Read a checkpoint into its run record, with the arrays added under their names"""
+    with np.load(path) as data:
+        record = json.loads(str(data["record"]))
+        if record.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version in {path}: {record.get('version')}")
+        for name in data.files:
+            if name != "record":
+                record[name] = data[name]
+    if "history" in record:
+        record["diagnostics"]["history"] = record.pop("history")
+    return record
@@ -0,0 +1,377 @@
+"""
+Compact, chunked trajectory export for progressive delivery.
+
+A trajectory is exported as a data file of independently compressed chunks of a fixed number
+of frames, plus a small JSON index. A consumer fetches the index, then fetches (e.g. with an
+HTTP Range request) and decodes only the first chunk to show the first frame, and streams the
+remaining chunks afterwards. While a simulation is running the index is rewritten after every
+chunk, so a partially written export can already be consumed.
+
+Index (<stem>.index.json):
+
+    format, version, header (labels, masses, dt, method, output_interval, ...),
+    encoding, max_error, quantum, delta_order, frames_per_chunk, frames, complete,
+    chunks: [{offset, length, start_frame, frames, t0, t1, delta_dtype}, ...]
+
+Chunk (bytes [offset, offset + length) of <stem>.tbc) is zlib-compressed, so browsers can
+inflate it with DecompressionStream("deflate"). Inflated, it is a sequence of little-endian
+arrays, each byte-shuffled (all first bytes of its elements, then all second bytes, ...),
+which lets the compressor see the slowly varying high bytes together:
+
+    times        float64 [F]
+    d_energy     float32 [F]
+    d_momentum   float32 [F,3]
+    positions    encoded [F,N,3]
+    velocities   encoded [F,N,3]
+
+with either encoding
+
+    "float32"    float32 [F,N,3]
+    "quantized"  integers q = round(x / quantum), quantum = 2 * max_error, differenced
+                 delta_order times along the frames: the first delta_order rows as int64
+                 [min(F, delta_order),N,3], then the rest as delta_dtype ("<i4", or "<i8" if
+                 a chunk needs it). Decoding cumulatively sums delta_order times and
+                 multiplies by quantum, so every coordinate is within max_error of the original
+                 and errors do not accumulate.
+
+Smooth orbits have small second differences, so the quantized encoding typically needs 1-2
+bytes per coordinate after compression. Running this module exports an existing text or
+binary trajectory.
+"""
+import argparse
+import json
+import os
+import zlib
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from trajectory import TrajectoryReader, buffer_dtype, output_times, MAGIC as BINARY_MAGIC
+
+FORMAT = "TBCHUNK"
+VERSION = 1
+ENCODINGS = ("quantized", "float32")
+CHUNKED_SUFFIX = ".tbc"
+INDEX_SUFFIX = ".index.json"
+DEFAULT_MAX_ERROR = 1e-6
+DEFAULT_CHUNK_FRAMES = 256
+
+def index_path(path: str) -> str:
+    """Index file belonging to a chunked data file"""
+    return os.path.splitext(path)[0] + INDEX_SUFFIX
+
+def export_path(output_path: str) -> str:
+    """Chunked export file belonging to a trajectory file"""
+    return os.path.splitext(output_path)[0] + CHUNKED_SUFFIX
+
+def _shuffle(array: np.ndarray) -> bytes:
+    """Bytes of array grouped by byte position within each element"""
+    raw = np.ascontiguousarray(array).view(np.uint8).reshape(-1, array.dtype.itemsize)
+    return raw.T.tobytes()
+
+def _unshuffle(data: bytes, dtype: str, shape: Tuple[int, ...]) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    raw = np.frombuffer(data, dtype=np.uint8, count=count * dtype.itemsize).reshape(dtype.itemsize, count)
+    return np.ascontiguousarray(raw.T).view(dtype).reshape(shape)
+
+def _difference(q: np.ndarray, order: int) -> np.ndarray:
+    for _ in range(order):
+        q = np.diff(q, axis=0, prepend=np.zeros((1,) + q.shape[1:], dtype=q.dtype))
+    return q
+
+def _integrate(d: np.ndarray, order: int) -> np.ndarray:
+    for _ in range(order):
+        d = np.cumsum(d, axis=0)
+    return d
+
+class ChunkedTrajectoryWriter:
+    """
+    Writes frames as a chunked export; has the interface of the trajectory writers, so it can
+    be used on its own, behind a BufferedTrajectoryWriter or in a TeeTrajectoryWriter.
+
+    Parameters
+    ----------
+    path: str
+        data file; the index is written next to it (index_path)
+    header: dict
+        trajectory header (labels, masses, dt, method, output_interval, ...)
+    encoding: str
+        "quantized" or "float32"
+    max_error: float
+        largest absolute error of a quantized position or velocity coordinate
+    frames_per_chunk: int
+        frames per chunk; the last chunk may be shorter
+    delta_order: int
+        differencing order of the quantized encoding
+    level: int
+        zlib compression level
+    """
+
+    def __init__(self, path: str, header: Dict, encoding: str = "quantized", max_error: float = DEFAULT_MAX_ERROR,
+                 frames_per_chunk: int = DEFAULT_CHUNK_FRAMES, delta_order: int = 2, level: int = 9):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown export encoding: {encoding}")
+        if max_error <= 0:
+            raise ValueError("The export max_error must be positive")
+        self.path = path
+        self.index_path = index_path(path)
+        self.n_particles = len(header["labels"])
+        self.encoding = encoding
+        self.level = level
+        self.index = {
+            "format": FORMAT,
+            "version": VERSION,
+            "header": header,
+            "encoding": encoding,
+            "max_error": max_error if encoding == "quantized" else None,
+            "quantum": 2 * max_error if encoding == "quantized" else None,
+            "delta_order": delta_order if encoding == "quantized" else None,
+            "frames_per_chunk": frames_per_chunk,
+            "compression": "zlib",
+            "byte_shuffle": True,
+            "frames": 0,
+            "complete": False,
+            "chunks": [],
+        }
+        self.file = open(path, "wb")
+        self._buffer = np.zeros(frames_per_chunk, dtype=buffer_dtype(self.n_particles))
+        self._count = 0
+        self._write_index()
+
+    def write_frame(self, time: float, positions: np.ndarray, velocities: np.ndarray, energy: float,
+                    momentum: np.ndarray, d_energy: float = 0.0, d_momentum: Tuple[float, float, float] = (0.0, 0.0, 0.0)) -> None:
+        frame = self._buffer[self._count]
+        frame["time"] = time
+        frame["positions"] = positions
+        frame["velocities"] = velocities
+        frame["energy"] = energy
+        frame["momentum"] = momentum
+        frame["d_energy"] = d_energy
+        frame["d_momentum"] = d_momentum
+        self._count += 1
+        if self._count == len(self._buffer):
+            self._write_chunk()
+
+    def write_frames(self, frames: np.ndarray) -> None:
+        """Write a block of frames with the buffer_dtype layout; the frames are copied"""
+        start = 0
+        while start < len(frames):
+            count = min(len(frames) - start, len(self._buffer) - self._count)
+            for name in self._buffer.dtype.names:
+                self._buffer[name][self._count:self._count + count] = frames[name][start:start + count]
+            self._count += count
+            start += count
+            if self._count == len(self._buffer):
+                self._write_chunk()
+
+    def _deltas(self, values: np.ndarray) -> np.ndarray:
+        """Quantized [F,N,3] values differenced delta_order times along the frames"""
+        return _difference(np.round(values / self.index["quantum"]).astype(np.int64), self.index["delta_order"])
+
+    def _write_chunk(self) -> None:
+        if self._count == 0:
+            return
+        frames = self._buffer[:self._count]
+        parts = [_shuffle(frames["time"].astype("<f8")), _shuffle(frames["d_energy"].astype("<f4")),
+                 _shuffle(frames["d_momentum"].astype("<f4"))]
+        chunk = {"offset": self.file.tell(), "start_frame": self.index["frames"], "frames": self._count,
+                 "t0": float(frames["time"][0]), "t1": float(frames["time"][-1])}
+        if self.encoding == "float32":
+            parts += [_shuffle(frames["positions"].astype("<f4")), _shuffle(frames["velocities"].astype("<f4"))]
+        else:
+            order = self.index["delta_order"]
+            deltas = [self._deltas(frames["positions"]), self._deltas(frames["velocities"])]
+            # The tails of both blocks share one dtype, int64 only if a delta does not fit int32
+            wide = any(np.max(np.abs(d[order:]), initial=0) >= 2 ** 31 for d in deltas)
+            chunk["delta_dtype"] = "<i8" if wide else "<i4"
+            for d in deltas:
+                parts += [_shuffle(d[:order].astype("<i8")), _shuffle(d[order:].astype(chunk["delta_dtype"]))]
+        payload = zlib.compress(b"".join(parts), self.level)
+        chunk["length"] = len(payload)
+        self.file.write(payload)
+        self.file.flush()
+        self.index["chunks"].append(chunk)
+        self.index["frames"] += self._count
+        self._count = 0
+        self._write_index()
+
+    def _write_index(self) -> None:
+        """Atomically replace the index, so consumers never read a partial one"""
+        temporary = self.index_path + ".tmp"
+        with open(temporary, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temporary, self.index_path)
+
+    def flush(self) -> None:
+        """Flush the data file; frames of an incomplete chunk stay buffered"""
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file.closed:
+            return
+        self._write_chunk()
+        self.file.close()
+        self.index["complete"] = True
+        self._write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_index(path: str) -> Dict:
+    """Read the index of a chunked export, given the data file or the index file"""
+    with open(path if path.endswith(INDEX_SUFFIX) else index_path(path), "r") as index_file:
+        index = json.load(index_file)
+    if index.get("format") != FORMAT or index.get("version") != VERSION:
+        raise ValueError(f"{path} is not a chunked trajectory export")
+    return index
+
+def decode_chunk(index: Dict, chunk: Dict, payload: bytes) -> Dict[str, np.ndarray]:
+    """Decode the compressed bytes of one chunk into times, d_energy, d_momentum, positions and velocities"""
+    data = zlib.decompress(payload)
+    frames = chunk["frames"]
+    shape = (frames, len(index["header"]["labels"]), 3)
+    offset = 0
+
+    def take(dtype: str, array_shape: Tuple[int, ...]) -> np.ndarray:
+        nonlocal offset
+        size = int(np.prod(array_shape)) * np.dtype(dtype).itemsize
+        array = _unshuffle(data[offset:offset + size], dtype, array_shape)
+        offset += size
+        return array
+
+    decoded = {"times": take("<f8", (frames,)), "d_energy": take("<f4", (frames,)),
+               "d_momentum": take("<f4", (frames, 3))}
+    for name in ("positions", "velocities"):
+        if index["encoding"] == "float32":
+            decoded[name] = take("<f4", shape).astype(float)
+        else:
+            order = index["delta_order"]
+            head = take("<i8", (min(frames, order),) + shape[1:])
+            tail = take(chunk["delta_dtype"], (max(frames - order, 0),) + shape[1:]).astype(np.int64)
+            decoded[name] = _integrate(np.concatenate([head, tail]), order) * index["quantum"]
+    return decoded
+
+class ChunkedTrajectoryReader:
+    """
+    Reader of chunked exports.
+
+    Attributes
+    ----------
+    index: the export index
+    header: the trajectory header
+    n_chunks, n_frames: number of complete chunks and frames
+    """
+
+    def __init__(self, path: str):
+        self.path = path if not path.endswith(INDEX_SUFFIX) else path[:-len(INDEX_SUFFIX)] + CHUNKED_SUFFIX
+        self.index = read_index(path)
+        self.header = self.index["header"]
+        self.n_chunks = len(self.index["chunks"])
+        self.n_frames = self.index["frames"]
+
+    def chunk(self, i: int) -> Dict[str, np.ndarray]:
+        """Decode chunk i only"""
+        chunk = self.index["chunks"][i]
+        with open(self.path, "rb") as data_file:
+            data_file.seek(chunk["offset"])
+            payload = data_file.read(chunk["length"])
+        return decode_chunk(self.index, chunk, payload)
+
+    def read(self) -> Dict[str, np.ndarray]:
+        """Decode every chunk into whole-trajectory arrays"""
+        chunks = [self.chunk(i) for i in range(self.n_chunks)]
+        if not chunks:
+            n = len(self.header["labels"])
+            return {"times": np.zeros(0), "d_energy": np.zeros(0), "d_momentum": np.zeros((0, 3)),
+                    "positions": np.zeros((0, n, 3)), "velocities": np.zeros((0, n, 3))}
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+def read_trajectory_frames(path: str, output_interval: float = 0.05, dt: Optional[float] = None) -> Tuple[Dict, np.ndarray]:
+    """
+    Read a binary or text trajectory into a header and a buffer_dtype frame array. Text
+    trajectories carry no header, times or masses: frame times are reconstructed from the
+    run's dt (see output_times) and the masses are left out.
+    """
+    with open(path, "rb") as trajectory_file:
+        binary = trajectory_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    if binary:
+        reader = TrajectoryReader(path)
+        frames = np.zeros(reader.n_frames, dtype=buffer_dtype(len(reader.labels)))
+        for name in ("time", "positions", "velocities", "energy", "momentum"):
+            frames[name] = reader.frames()[name]
+        frames["d_energy"] = np.diff(frames["energy"], prepend=frames["energy"][:1])
+        frames["d_momentum"] = np.diff(frames["momentum"], axis=0, prepend=frames["momentum"][:1])
+        return dict(reader.header), frames
+
+    labels: List[str] = []
+    blocks = []
+    with open(path, "r") as trajectory_file:
+        block = None
+        for line in trajectory_file:
+            line = line.strip()
+            if line.startswith("dMomentum"):
+                block = {"d_momentum": [float(value) for value in line.split("=")[1].split()], "particles": []}
+                blocks.append(block)
+            elif line.startswith("dEnergy"):
+                block["d_energy"] = float(line.split("=")[1])
+            elif line:
+                block["particles"].append([float(value) for value in line.split()[1:7]])
+                if len(blocks) == 1:
+                    labels.append(line.split()[0])
+    blocks = [block for block in blocks if len(block["particles"]) == len(labels)]
+    frames = np.zeros(len(blocks), dtype=buffer_dtype(len(labels)))
+    frames["time"] = output_times(len(blocks), dt, output_interval)
+    if blocks:
+        values = np.array([block["particles"] for block in blocks])
+        frames["positions"] = values[..., :3]
+        frames["velocities"] = values[..., 3:]
+        frames["d_energy"] = [block["d_energy"] for block in blocks]
+        frames["d_momentum"] = [block["d_momentum"] for block in blocks]
+    return {"labels": labels, "dt": dt, "output_interval": output_interval}, frames
+
+def export_trajectory(input_path: str, output_path: Optional[str] = None, encoding: str = "quantized",
+                      max_error: float = DEFAULT_MAX_ERROR, frames_per_chunk: int = DEFAULT_CHUNK_FRAMES,
+                      header: Optional[Dict] = None, dt: Optional[float] = None) -> str:
+    """
+    Export a finished text or binary trajectory, by default next to it. The header of a binary
+    trajectory is used unless one is given. The frames of a text trajectory are placed in time
+    by dt, by default that of the given header unless it describes an adaptive run. Returns the
+    path of the data file.
+    """
+    output_path = output_path or export_path(input_path)
+    if dt is None and not (header or {}).get("adaptive"):
+        dt = (header or {}).get("dt")
+    file_header, frames = read_trajectory_frames(input_path, dt=dt)
+    with ChunkedTrajectoryWriter(output_path, header or file_header, encoding, max_error, frames_per_chunk) as writer:
+        writer.write_frames(frames)
+    return output_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a trajectory as compressed chunks with an index")
+    parser.add_argument("input_path", help="Text or binary trajectory")
+    parser.add_argument("output_path", nargs="?", help=f"Data file (default: next to the input, {CHUNKED_SUFFIX})")
+    parser.add_argument("--encoding", choices=ENCODINGS, default="quantized")
+    parser.add_argument("--max-error", type=float, default=DEFAULT_MAX_ERROR,
+                        help="Largest absolute error of a quantized coordinate")
+    parser.add_argument("--chunk-frames", type=int, default=DEFAULT_CHUNK_FRAMES, help="Frames per chunk")
+    parser.add_argument("--dt", type=float, help="Time step of a text trajectory's run, which places its frames in time")
+    args = parser.parse_args()
+
+    output_path = export_trajectory(args.input_path, args.output_path, args.encoding, args.max_error, args.chunk_frames,
+                                    dt=args.dt)
+    reader = ChunkedTrajectoryReader(output_path)
+    _, frames = read_trajectory_frames(args.input_path, dt=args.dt)
+    decoded = reader.read()
+    error = max(float(np.max(np.abs(decoded["positions"] - frames["positions"]), initial=0.0)),
+                float(np.max(np.abs(decoded["velocities"] - frames["velocities"]), initial=0.0)))
+    size = os.path.getsize(output_path) + os.path.getsize(index_path(output_path))
+    print(f"{reader.n_frames} frames in {reader.n_chunks} chunks: {os.path.getsize(args.input_path)} -> {size} bytes "
+          f"({os.path.getsize(args.input_path) / max(size, 1):.1f}x smaller), "
+          f"first chunk {reader.index['chunks'][0]['length'] if reader.n_chunks else 0} bytes, "
+          f"largest error {error:.3e}")
+
+if __name__ == "__main__":
+    main()
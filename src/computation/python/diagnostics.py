@@ -0,0 +1,218 @@
+"""
+Constant-memory conservation diagnostics.
+
+StreamingStatistics folds a series of values into running count, first, last, min, max,
+mean, standard deviation and RMS drift from the first value, so energy and momentum checks
+cost O(1) memory however long the run. Diagnostics samples energy and momentum at a
+configurable cadence and only keeps full histories when explicitly asked to.
+"""
+import math
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+class StreamingStatistics:
+    """
+    Running statistics of a series of scalars, or elementwise of a series of arrays.
+
+    Scalar updates use plain Python arithmetic, so they are cheap enough to run every
+    integration step. Array updates accept a mask selecting which elements are updated.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._sum_sq_drift = 0.0
+
+    def update(self, value, mask=None) -> None:
+        """Fold one value (or one array of values, optionally masked) into the statistics"""
+        if mask is None and np.ndim(value) == 0:
+            self._update_scalar(float(value))
+        else:
+            self._update_array(np.asarray(value, dtype=float), mask)
+
+    def _update_scalar(self, value: float) -> None:
+        if self.first is None:
+            self.first = self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.last = value
+        self.count += 1
+        # Welford's update of the mean and the sum of squared deviations
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self._sum_sq_drift += (value - self.first) ** 2
+
+    def _update_array(self, value: np.ndarray, mask) -> None:
+        if self.first is None:
+            self.first = value.copy()
+            self.min = value.copy()
+            self.max = value.copy()
+            self.last = value.copy()
+            self.count = np.zeros(value.shape, dtype=int)
+            self.mean = np.zeros(value.shape)
+            self._m2 = np.zeros(value.shape)
+            self._sum_sq_drift = np.zeros(value.shape)
+        mask = np.broadcast_to(True if mask is None else mask, value.shape)
+        self.count = self.count + mask
+        delta = np.where(mask, value - self.mean, 0.0)
+        self.mean = self.mean + delta / np.maximum(self.count, 1)
+        self._m2 = self._m2 + np.where(mask, delta * (value - self.mean), 0.0)
+        self._sum_sq_drift = self._sum_sq_drift + np.where(mask, (value - self.first) ** 2, 0.0)
+        self.min = np.where(mask, np.minimum(self.min, value), self.min)
+        self.max = np.where(mask, np.maximum(self.max, value), self.max)
+        self.last = np.where(mask, value, self.last)
+
+    STATE_FIELDS = ("count", "first", "last", "min", "max", "mean", "_m2", "_sum_sq_drift")
+
+    def state_dict(self) -> Dict:
+        """The running totals, for checkpointing"""
+        return {field: getattr(self, field) for field in self.STATE_FIELDS}
+
+    def load_state_dict(self, state: Dict) -> None:
+        """Restore running totals saved by state_dict"""
+        for field in self.STATE_FIELDS:
+            setattr(self, field, state[field])
+
+    @property
+    def range(self):
+        """max - min"""
+        return self.max - self.min
+
+    @property
+    def drift(self):
+        """last - first"""
+        return self.last - self.first
+
+    @property
+    def std(self):
+        """Standard deviation about the mean"""
+        return np.sqrt(self._m2 / np.maximum(self.count, 1))
+
+    @property
+    def rms_drift(self):
+        """Root mean square deviation from the first value"""
+        return np.sqrt(self._sum_sq_drift / np.maximum(self.count, 1))
+
+class GrowableArray:
+    """Append-only float array that doubles its capacity, used for opt-in histories"""
+    def __init__(self, width: int = 1, capacity: int = 1024):
+        self._data = np.zeros((capacity, width))
+        self._size = 0
+
+    def append(self, *values: float) -> None:
+        if self._size == len(self._data):
+            self._data = np.concatenate([self._data, np.zeros_like(self._data)])
+        self._data[self._size] = values
+        self._size += 1
+
+    def to_array(self) -> np.ndarray:
+        return self._data[:self._size].copy()
+
+    def extend(self, rows: np.ndarray) -> None:
+        for row in rows:
+            self.append(*row)
+
+class Diagnostics:
+    """
+    Energy and momentum diagnostics of a single run.
+
+    Parameters
+    ----------
+    sample_every: int
+        integration steps between samples; output frames and the final state are
+        always sampled as well
+    keep_history: bool
+        also store every sample (time, energy, momentum) for plotting or saving
+    """
+
+    def __init__(self, sample_every: int = 1, keep_history: bool = False):
+        self.sample_every = max(1, int(sample_every))
+        self.keep_history = keep_history
+        self.energy = StreamingStatistics()
+        self.momentum = [StreamingStatistics() for _ in range(3)]
+        self.history = GrowableArray(width=5) if keep_history else None
+        self.last_energy: Optional[float] = None
+        self.last_momentum: Optional[np.ndarray] = None
+
+    def should_sample(self, step: int) -> bool:
+        """Whether integration step `step` falls on the sampling cadence"""
+        return (step + 1) % self.sample_every == 0
+
+    def steps_to_next_sample(self, step: int) -> int:
+        """Number of steps from integration step `step` up to and including the next sampled step"""
+        return self.sample_every - step % self.sample_every
+
+    def record(self, time: float, energy: float, momentum: np.ndarray) -> Tuple[float, np.ndarray]:
+        """
+        Fold a sample into the statistics and return its change in energy and momentum
+        since the previous sample.
+        """
+        energy = float(energy)
+        if self.last_energy is None:
+            d_energy, d_momentum = 0.0, np.zeros(3)
+        else:
+            d_energy, d_momentum = energy - self.last_energy, momentum - self.last_momentum
+        self.energy.update(energy)
+        for statistics, value in zip(self.momentum, momentum):
+            statistics.update(value)
+        if self.history is not None:
+            self.history.append(time, energy, *momentum)
+        self.last_energy = energy
+        self.last_momentum = np.array(momentum, dtype=float)
+        return d_energy, d_momentum
+
+    def state_dict(self) -> Dict:
+        """
+        Everything needed to continue the statistics exactly, for checkpointing. Scalars are
+        plain Python floats, which round-trip through JSON without loss; the history, if kept,
+        is returned as an array under "history".
+        """
+        return {
+            "sample_every": self.sample_every,
+            "energy": self.energy.state_dict(),
+            "momentum": [statistics.state_dict() for statistics in self.momentum],
+            "last_energy": self.last_energy,
+            "last_momentum": None if self.last_momentum is None else self.last_momentum.tolist(),
+            "history": None if self.history is None else self.history.to_array(),
+        }
+
+    def load_state_dict(self, state: Dict) -> None:
+        """Restore statistics saved by state_dict"""
+        self.energy.load_state_dict(state["energy"])
+        for statistics, saved in zip(self.momentum, state["momentum"]):
+            statistics.load_state_dict(saved)
+        self.last_energy = state["last_energy"]
+        self.last_momentum = None if state["last_momentum"] is None else np.array(state["last_momentum"])
+        if self.history is not None and state.get("history") is not None:
+            self.history.extend(state["history"])
+
+    def summary(self) -> Dict:
+        """Conservation statistics of the samples recorded so far"""
+        if self.energy.count == 0:
+            return {}
+        initial_energy = self.energy.first
+        return {
+            "samples": self.energy.count,
+            "energy_deviation": abs(self.energy.range / initial_energy),
+            "energy_drift": self.energy.drift / abs(initial_energy),
+            "energy_rms": float(self.energy.rms_drift) / abs(initial_energy),
+            "momentum_diff_x": abs(self.momentum[0].range),
+            "momentum_diff_y": abs(self.momentum[1].range),
+            "momentum_diff_z": abs(self.momentum[2].range),
+            "momentum_drift": math.sqrt(sum(statistics.drift ** 2 for statistics in self.momentum)),
+        }
+
+    def history_arrays(self) -> Dict[str, np.ndarray]:
+        """The kept history as times, energy and [S,3] momentum arrays"""
+        if self.history is None:
+            raise ValueError("Diagnostics history was not kept; use keep_history=True")
+        data = self.history.to_array()
+        return {"times": data[:, 0], "energy": data[:, 1], "momentum": data[:, 2:]}
@@ -0,0 +1,242 @@
+"""
+Batched ensemble integration. B systems with the same number of particles are stacked into
+(B,N,3) arrays and advanced together, one vectorised force evaluation per stage for the whole
+batch, so the per-step Python overhead is shared by every member.
+
+Members may use different symplectic methods: their coefficient lists are padded with zeros
+to the longest scheme, and a zero kick/drift stage leaves a member unchanged. Members that
+reach the proximity threshold are masked out and stop evolving while the rest continue.
+With keep_history, every diagnostics sample of a member is saved next to its trajectory, in the
+layout of single runs. Ensembles are not looked up in or stored to the result cache.
+"""
+import numpy as np
+from tqdm import tqdm
+from typing import List, Dict, Tuple, Optional, Union
+import copy
+import os
+
+from system_state import SystemState
+from force_cache import ForceCache
+from backends import get_backend
+from integration_loop_refactored import SimulationConfig, InitialCondition
+from schemes import get_scheme
+from trajectory import open_trajectory_writer
+from output_pipeline import TeeTrajectoryWriter
+from chunked_export import ChunkedTrajectoryWriter, export_path
+from diagnostics import StreamingStatistics, GrowableArray
+
+class EnsembleState(SystemState):
+    """
+    Stacked state of B systems of N particles.
+
+    Attributes
+    ----------
+    names: list of B configuration names
+    methods: list of B integrator methods
+    labels: list of N particle names, taken from the first member
+    masses: [B,N] float array of particle masses
+    positions: [B,N,3] float array of particle positions
+    velocities: [B,N,3] float array of particle velocities
+    active: [B] bool array, False once a member has terminated
+    """
+
+    def __init__(self, names, methods, labels, masses, positions, velocities):
+        super().__init__(labels, masses, positions, velocities)
+        self.names = list(names)
+        self.methods = list(methods)
+        self.active = np.ones(len(self.names), dtype=bool)
+
+    @property
+    def batch_size(self):
+        """Number of members in the ensemble"""
+        return self.masses.shape[0]
+
+    @staticmethod
+    def from_members(members: List[Tuple[InitialCondition, int]]):
+        """
+        Stacks (initial condition, method) pairs into one ensemble. All initial
+        conditions must have the same number of particles.
+        """
+        states = [SystemState.from_particles(copy.deepcopy(ic.particles)) for ic, _ in members]
+        if len({state.n_particles for state in states}) != 1:
+            raise ValueError("All ensemble members must have the same number of particles")
+        return EnsembleState(
+            [ic.name for ic, _ in members],
+            [method for _, method in members],
+            states[0].labels,
+            np.stack([state.masses for state in states]),
+            np.stack([state.positions for state in states]),
+            np.stack([state.velocities for state in states]),
+        )
+
+    def member(self, b: int) -> SystemState:
+        """Returns a copy of member b as a single SystemState"""
+        return SystemState(list(self.labels), self.masses[b].copy(), self.positions[b].copy(), self.velocities[b].copy())
+
+def stack_coefficients(methods: List[Union[int, str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build [B,S] kick and drift coefficient tables for a list of methods, where S is the
+    largest number of stages. Shorter schemes are padded with zero coefficients.
+    """
+    n_stages = max(get_scheme(method).stages for method in methods)
+    c = np.zeros((len(methods), n_stages))
+    d = np.zeros((len(methods), n_stages))
+    for b, method in enumerate(methods):
+        coeffs = get_scheme(method).coefficients
+        c[b, :len(coeffs["c"])] = coeffs["c"]
+        d[b, :len(coeffs["d"])] = coeffs["d"]
+    return c, d
+
+def ensemble_step(state: EnsembleState, dt: float, c: np.ndarray, d: np.ndarray, cache: Optional[ForceCache] = None) -> None:
+    """
+    Perform one symplectic step in place for every active member of the ensemble.
+
+    Parameters
+    ----------
+    state : EnsembleState
+        Stacked system state
+    dt : float
+        Time step
+    c, d : [B,S] float arrays
+        Kick and drift coefficients of each member, from stack_coefficients
+    cache : ForceCache, optional
+        Forces at the current positions, reused across stages and steps
+    """
+    if cache is None:
+        cache = ForceCache()
+    c_active = np.where(state.active[:, np.newaxis], c, 0.0)
+    d_active = np.where(state.active[:, np.newaxis], d, 0.0)
+    for k in range(c.shape[1]):
+        if np.any(c_active[:, k] != 0):
+            forces, _, _ = cache.evaluate(state)
+            state.kick(forces, dt, c_active[:, k, np.newaxis, np.newaxis])
+        if np.any(d_active[:, k] != 0):
+            state.drift(dt, d_active[:, k, np.newaxis, np.newaxis])
+            cache.invalidate()
+
+class EnsembleSimulation:
+    """Runs many configurations and methods as batched ensembles"""
+    def __init__(self, config: SimulationConfig):
+        self.config = config
+
+    def run_ensemble(self, initial_conditions: List[InitialCondition], methods: List[int]) -> None:
+        """Run every initial condition with every method, batching configurations of equal size"""
+        groups: Dict[int, List[Tuple[InitialCondition, int]]] = {}
+        for initial_condition in initial_conditions:
+            for method in methods:
+                groups.setdefault(len(initial_condition.particles), []).append((initial_condition, method))
+        for members in groups.values():
+            self._run_batch(EnsembleState.from_members(members))
+
+    def _energy_momentum(self, state: EnsembleState) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Per-member total energy, momentum and maximum pair distance"""
+        _, potential, distances = self.force_cache.evaluate(state)
+        return state.kinetic_energy() + potential, state.momentum(), np.max(distances, axis=(-2, -1))
+
+    def _run_batch(self, state: EnsembleState) -> None:
+        """Integrate one ensemble, writing a trajectory file per member"""
+        state.remove_com_velocity()
+        c, d = stack_coefficients(state.methods)
+        # Stacked states use the direct kernels of the configured backend, with its softening
+        backend = get_backend(self.config.backend, softening=self.config.softening)
+        self.force_cache = ForceCache(backend.evaluate)
+        print(f"\nProcessing ensemble of {state.batch_size} members")
+
+        output_paths = [self.config.output_path(name, method) for name, method in zip(state.names, state.methods)]
+        writers = []
+        try:
+            for b, path in enumerate(output_paths):
+                # Schemes selected by name get their own output directories
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                header = {"labels": state.labels, "masses": state.masses[b].tolist(), "dt": self.config.dt,
+                          "method": state.methods[b], "output_interval": self.config.output_interval}
+                writer = open_trajectory_writer(path, self.config.output_format, header)
+                if self.config.export:
+                    writer = TeeTrajectoryWriter(writer, ChunkedTrajectoryWriter(
+                        export_path(path), header, self.config.export, self.config.export_max_error,
+                        self.config.export_chunk_frames))
+                writers.append(writer)
+
+            energy, momentum, _ = self._energy_momentum(state)
+            self.energy_statistics = StreamingStatistics()
+            self.momentum_statistics = StreamingStatistics()
+            self.histories = [GrowableArray(width=5) for _ in range(state.batch_size)] if self.config.keep_history else None
+            self._sample(0.0, state.active, energy, momentum)
+            for b, writer in enumerate(writers):
+                writer.write_frame(0.0, state.positions[b], state.velocities[b], energy[b], momentum[b], 0.0, (0.0, 0.0, 0.0))
+
+            current_time = 0.0
+            next_output_time = 0.0
+            sample_every = max(1, int(self.config.diagnostics_every))
+            total_steps = self.config.num_integration_steps
+            for step in tqdm(range(total_steps), desc=f"Simulating ensemble of {state.batch_size}", ncols=100):
+                current_time += self.config.dt
+                ensemble_step(state, self.config.dt, c, d, self.force_cache)
+
+                energy, momentum, max_distance = self._energy_momentum(state)
+                terminated = state.active & (max_distance > self.config.proximity_threshold)
+                # As in single runs, output frames and terminating members are sampled as well as
+                # every diagnostics_every steps
+                write_output = current_time >= next_output_time
+                if write_output or (step + 1) % sample_every == 0:
+                    sampled = state.active
+                else:
+                    sampled = terminated
+                d_energy, d_momentum = self._sample(current_time, sampled, energy, momentum)
+
+                for b in np.flatnonzero(terminated):
+                    print(f"\nSimulation terminated early for {state.names[b]} with method {state.methods[b]}")
+                state.active &= ~terminated
+                if not np.any(state.active):
+                    break
+
+                # All members share dt, so they share the output grid
+                if write_output:
+                    for b in np.flatnonzero(state.active):
+                        writers[b].write_frame(current_time, state.positions[b], state.velocities[b], energy[b],
+                                               momentum[b], d_energy[b], tuple(d_momentum[b]))
+                    next_output_time = current_time + self.config.output_interval
+        finally:
+            for writer in writers:
+                writer.close()
+
+        for b, path in enumerate(output_paths):
+            if self.histories is not None:
+                data = self.histories[b].to_array()
+                np.savez(os.path.splitext(path)[0] + ".diagnostics.npz", times=data[:, 0], energy=data[:, 1],
+                         momentum=data[:, 2:])
+            self._print_statistics(b, state, path)
+
+    def _sample(self, time: float, sampled: np.ndarray, energy: np.ndarray,
+                momentum: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Fold the energies and momenta of the sampled members into the streaming statistics (and
+        their histories, if kept) and return their changes since each member's previous sample
+        (zero for the first sample and for members not sampled), matching Diagnostics.record
+        """
+        if self.energy_statistics.first is None:
+            d_energy, d_momentum = np.zeros_like(energy), np.zeros_like(momentum)
+        else:
+            d_energy = np.where(sampled, energy - self.energy_statistics.last, 0.0)
+            d_momentum = np.where(sampled[:, np.newaxis], momentum - self.momentum_statistics.last, 0.0)
+        self.energy_statistics.update(energy, sampled)
+        self.momentum_statistics.update(momentum, sampled[:, np.newaxis])
+        if self.histories is not None:
+            for b in np.flatnonzero(sampled):
+                self.histories[b].append(time, energy[b], *momentum[b])
+        return d_energy, d_momentum
+
+    def _print_statistics(self, b: int, state: EnsembleState, output_file_path: str) -> None:
+        """Print statistics for one ensemble member"""
+        energy_deviation = np.abs(self.energy_statistics.range[b] / self.energy_statistics.first[b])
+        momentum_diff = np.abs(self.momentum_statistics.range[b])
+
+        try:
+            print(f"File size for {state.names[b]} (method {state.methods[b]}): {os.path.getsize(output_file_path)} bytes")
+        except OSError as e:
+            print(f"Error checking file {output_file_path}: {e}")
+        print(f"\nStatistics for {state.names[b]}:")
+        print(f"Energy Deviation: {energy_deviation:.6e}")
+        print(f"Maximum Difference in Momentum (x-direction): {momentum_diff[0]:.6e}")
+        print(f"Maximum Difference in Momentum (y-direction): {momentum_diff[1]:.6e}")
+        print(f"Data saved to {output_file_path}")
@@ -0,0 +1,301 @@
+"""
+Event detection during integration: escapes, near-collisions, syzygies and plane crossings.
+
+An event is a vectorised function of the state returning one value per channel (per particle,
+per pair, ...). It fires on a channel when that value changes sign across a step, optionally
+only in one direction. The event time is then refined inside the step by root finding on a
+cubic Hermite interpolant of the positions and velocities between the two ends of the step,
+which uses the velocities and accelerations already known there, so no extra force
+evaluations are needed.
+
+Each event has an action: "record" writes the refined time and interpolated state to the
+event log, "count" only counts, and "terminate" records and stops the run. The log is a
+compact binary file: MAGIC, a JSON header with the event descriptions, then fixed-size
+records (time, event index, channel, positions, velocities).
+"""
+import json
+import struct
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+MAGIC = b"TBEVNT01"
+ACTIONS = ("record", "count", "terminate")
+AXES = {"x": 0, "y": 1, "z": 2}
+
+# Root refinement stops when the bracket in units of the step is this small
+ROOT_TOLERANCE = 1e-13
+ROOT_MAX_ITERATIONS = 60
+
+class Event(object):
+    """
+    Base class of events. Subclasses set name and direction (+1 rising, -1 falling, 0 both)
+    and implement values(positions, velocities, masses) returning an array of channels.
+    """
+    name = "event"
+    direction = 0
+
+    def __init__(self, action: str = "record"):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown event action: {action}")
+        self.action = action
+
+    def values(self, positions: np.ndarray, velocities: np.ndarray, masses: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def parameters(self) -> Dict:
+        """Parameters identifying the event, stored in the log header"""
+        return {}
+
+    def describe(self) -> Dict:
+        return dict(self.parameters(), name=self.name, action=self.action, direction=self.direction)
+
+class Escape(Event):
+    """A particle moving out beyond radius from the centre of mass; one channel per particle"""
+    name = "escape"
+    direction = 1
+
+    def __init__(self, radius: float, action: str = "terminate"):
+        super().__init__(action)
+        self.radius = float(radius)
+
+    def values(self, positions, velocities, masses):
+        com = np.sum(masses[:, np.newaxis] * positions, axis=0) / np.sum(masses)
+        return np.sqrt(np.sum((positions - com) ** 2, axis=1)) - self.radius
+
+    def parameters(self):
+        return {"radius": self.radius}
+
+class NearCollision(Event):
+    """Two particles approaching within distance; one channel per pair i < j"""
+    name = "collision"
+    direction = -1
+
+    def __init__(self, distance: float, action: str = "terminate"):
+        super().__init__(action)
+        self.distance = float(distance)
+
+    def values(self, positions, velocities, masses):
+        i, j = np.triu_indices(len(masses), k=1)
+        return np.sqrt(np.sum((positions[j] - positions[i]) ** 2, axis=1)) - self.distance
+
+    def parameters(self):
+        return {"distance": self.distance}
+
+class Syzygy(Event):
+    """
+    Collinearity of three bodies: the signed area of their triangle projected on the plane
+    normal to axis changes sign. One channel; the body in the middle can be read off the
+    recorded positions.
+    """
+    name = "syzygy"
+    direction = 0
+
+    def __init__(self, axis: str = "z", action: str = "record"):
+        super().__init__(action)
+        self.axis = axis
+        self.normal = np.eye(3)[AXES[axis]]
+
+    def values(self, positions, velocities, masses):
+        if len(masses) != 3:
+            raise ValueError("Syzygy events are defined for three bodies")
+        area = np.cross(positions[1] - positions[0], positions[2] - positions[0])
+        return np.array([np.dot(area, self.normal)])
+
+    def parameters(self):
+        return {"axis": self.axis}
+
+class PlaneCrossing(Event):
+    """Poincare section: one particle crossing the plane axis = offset in the given direction"""
+    name = "plane"
+
+    def __init__(self, particle: int = 0, axis: str = "z", offset: float = 0.0, direction: int = 1,
+                 action: str = "record"):
+        super().__init__(action)
+        self.particle = int(particle)
+        self.axis = axis
+        self.offset = float(offset)
+        self.direction = int(direction)
+
+    def values(self, positions, velocities, masses):
+        return np.array([positions[self.particle, AXES[self.axis]] - self.offset])
+
+    def parameters(self):
+        return {"particle": self.particle, "axis": self.axis, "offset": self.offset}
+
+EVENT_TYPES = {"escape": Escape, "collision": NearCollision, "syzygy": Syzygy, "plane": PlaneCrossing}
+
+def parse_event_spec(spec: str) -> Event:
+    """
+    Build an event from a command line spec "name[,key=value...]", e.g. "syzygy",
+    "escape,radius=50", "collision,distance=0.01,action=count" or "plane,particle=1,axis=y".
+    """
+    name, *options = spec.split(",")
+    if name not in EVENT_TYPES:
+        raise ValueError(f"Unknown event {name!r}; choose from {', '.join(EVENT_TYPES)}")
+    kwargs = {}
+    for option in options:
+        key, _, value = option.partition("=")
+        if key in ("action", "axis"):
+            kwargs[key] = value
+        elif key in ("particle", "direction"):
+            kwargs[key] = int(value)
+        else:
+            kwargs[key] = float(value)
+    return EVENT_TYPES[name](**kwargs)
+
+def hermite(theta: float, h: float, x0: np.ndarray, dx0: np.ndarray, x1: np.ndarray, dx1: np.ndarray) -> np.ndarray:
+    """Cubic Hermite interpolant at fraction theta of a step of length h"""
+    theta2 = theta * theta
+    theta3 = theta2 * theta
+    return ((2 * theta3 - 3 * theta2 + 1) * x0 + (theta3 - 2 * theta2 + theta) * h * dx0
+            + (3 * theta2 - 2 * theta3) * x1 + (theta3 - theta2) * h * dx1)
+
+def record_dtype(n_particles: int) -> np.dtype:
+    """Layout of one event log record"""
+    return np.dtype([("time", "<f8"), ("event", "<u2"), ("channel", "<u4"),
+                     ("positions", "<f8", (n_particles, 3)), ("velocities", "<f8", (n_particles, 3))])
+
+class EventDetector(object):
+    """
+    Checks a list of events after every step of one run.
+
+    Parameters
+    ----------
+    events: list of Event
+    masses: [N] particle masses
+    log_path: str, optional
+        event log file; without one recorded events are only counted
+    labels: particle labels for the log header
+    mode: "w" to start a new log, "a" to append to one (when resuming)
+    """
+
+    def __init__(self, events: List[Event], masses: np.ndarray, log_path: Optional[str] = None,
+                 labels: Optional[List[str]] = None, mode: str = "w"):
+        self.events = list(events)
+        self.masses = masses
+        self.counts = [0] * len(self.events)
+        self.log_path = log_path
+        self.dtype = record_dtype(len(masses))
+        self._previous = None
+        self.log = None
+        if log_path is not None:
+            self.log = open(log_path, "ab" if mode == "a" else "wb")
+            if mode != "a":
+                header = json.dumps({"labels": list(labels or []),
+                                     "events": [event.describe() for event in self.events]}).encode()
+                self.log.write(MAGIC + struct.pack("<Q", len(header)) + header)
+
+    def start(self, positions: np.ndarray, velocities: np.ndarray) -> None:
+        """Evaluate the events at the start of integration (or after resuming)"""
+        self._previous = [event.values(positions, velocities, self.masses) for event in self.events]
+
+    def _crossed(self, event: Event, before: np.ndarray, after: np.ndarray) -> np.ndarray:
+        rising = (before < 0) & (after >= 0)
+        falling = (before > 0) & (after <= 0)
+        if event.direction > 0:
+            return rising
+        if event.direction < 0:
+            return falling
+        return rising | falling
+
+    def check(self, t0: float, positions0: np.ndarray, velocities0: np.ndarray, accelerations0: np.ndarray,
+              t1: float, positions1: np.ndarray, velocities1: np.ndarray, accelerations1: np.ndarray) -> bool:
+        """
+        Look for events in the step from t0 to t1, given both end states, handle the ones that
+        fired in time order and return whether a terminating event fired. Events after the first
+        terminating one fall past the end of the run and are neither counted nor logged.
+        """
+        current = [event.values(positions1, velocities1, self.masses) for event in self.events]
+        fired = []
+        for index, (event, before, after) in enumerate(zip(self.events, self._previous, current)):
+            for channel in np.flatnonzero(self._crossed(event, before, after)):
+                fired.append((index, int(channel), float(before[channel]), float(after[channel])))
+        self._previous = current
+        if not fired:
+            return False
+
+        h = t1 - t0
+
+        def interpolate(theta):
+            return (hermite(theta, h, positions0, velocities0, positions1, velocities1),
+                    hermite(theta, h, velocities0, accelerations0, velocities1, accelerations1))
+
+        located = []
+        for index, channel, before, after in fired:
+            def value(theta):
+                return float(self.events[index].values(*interpolate(theta), self.masses)[channel])
+            located.append((self._refine(value, before, after), index, channel))
+
+        stop = None
+        for theta, index, channel in sorted(located):
+            if stop is not None and theta > stop:
+                break
+            self.counts[index] += 1
+            action = self.events[index].action
+            if action == "count":
+                continue
+            if self.log is not None:
+                record = np.zeros(1, dtype=self.dtype)
+                record["time"] = t0 + theta * h
+                record["event"] = index
+                record["channel"] = channel
+                record["positions"], record["velocities"] = interpolate(theta)
+                self.log.write(record.tobytes())
+            if action == "terminate" and stop is None:
+                stop = theta
+        return stop is not None
+
+    @staticmethod
+    def _refine(value, g0: float, g1: float) -> float:
+        """Root of value(theta) in [0, 1] by the Illinois variant of regula falsi"""
+        a, b = 0.0, 1.0
+        side = 0
+        for _ in range(ROOT_MAX_ITERATIONS):
+            if b - a < ROOT_TOLERANCE or g1 == g0:
+                break
+            c = (a * g1 - b * g0) / (g1 - g0)
+            gc = value(c)
+            if gc == 0:
+                return c
+            if (gc > 0) == (g1 > 0):
+                b, g1 = c, gc
+                if side == -1:
+                    g0 /= 2
+                side = -1
+            else:
+                a, g0 = c, gc
+                if side == 1:
+                    g1 /= 2
+                side = 1
+        return b if abs(g1) < abs(g0) else a
+
+    def summary(self) -> Dict[str, int]:
+        """Number of times each event fired, keyed by event name (and index when repeated)"""
+        names = [event.name for event in self.events]
+        return {(name if names.count(name) == 1 else f"{name}_{index}"): count
+                for index, (name, count) in enumerate(zip(names, self.counts))}
+
+    def flush(self) -> None:
+        if self.log is not None:
+            self.log.flush()
+
+    def close(self) -> None:
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_event_log(path: str) -> Tuple[Dict, np.ndarray]:
+    """Read an event log into its header and a structured array of records"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an event log")
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+        records = np.fromfile(f, dtype=record_dtype(len(header["labels"])))
+    return header, records
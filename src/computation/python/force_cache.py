@@ -0,0 +1,82 @@
+"""
+ForceCache, the forces, potential and pair distances of a state's current positions.
+
+Every symplectic scheme needs the force at the positions reached at the end of a step twice:
+for the diagnostics and proximity check of that step and for the first kick of the next one.
+Schemes ending on a zero drift (methods 2 and 4) also finish with a force evaluation at the
+final positions. The cache evaluates each configuration once and is invalidated by any drift
+that actually moves the particles.
+"""
+import Forces_and_Separations
+
+class ForceCache(object):
+    """
+    Cached fused force evaluation for one SystemState.
+
+    Attributes
+    ----------
+    forces: [...,N,3] forces at the cached positions
+    potential: total potential energy at the cached positions
+    distances: [...,N,N] pair distances at the cached positions
+    evaluations: number of force evaluations performed
+
+    Methods
+    -------
+    evaluate: returns (forces, potential, distances), computing them if the cache is stale
+    invalidate: marks the cache stale after the positions have changed
+    store: fills the cache with values computed elsewhere, e.g. by a compiled step loop
+    """
+
+    def __init__(self, evaluator=None):
+        """
+        Parameters
+        ----------
+        evaluator: callable, optional
+            evaluator(positions, masses) -> (forces, potential, distances), by default
+            Forces_and_Separations.compute_forces_potential_distances
+        """
+        self.evaluator = evaluator or Forces_and_Separations.compute_forces_potential_distances
+        self.evaluations = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Mark the cached values as stale"""
+        self.forces = None
+        self.potential = None
+        self.distances = None
+        self.valid = False
+
+    def evaluate(self, state):
+        """
+        Returns forces, potential and pair distances at the current positions of state.
+
+        Parameters
+        ----------
+        state: SystemState
+            The state whose positions the cache tracks
+
+        Returns
+        -------
+        forces, potential, distances
+        """
+        if not self.valid:
+            self.forces, self.potential, self.distances = self.evaluator(state.positions, state.masses)
+            self.evaluations += 1
+            self.valid = True
+        return self.forces, self.potential, self.distances
+
+    def store(self, forces, potential, distances, evaluations=0):
+        """
+        Fill the cache with values for the current positions computed outside the cache.
+
+        Parameters
+        ----------
+        forces, potential, distances: values at the current positions
+        evaluations: int
+            number of force evaluations spent producing them, added to the counter
+        """
+        self.forces = forces
+        self.potential = potential
+        self.distances = distances
+        self.evaluations += evaluations
+        self.valid = True
@@ -0,0 +1,190 @@
+"""
+Per-phase timers, counters and hooks for the simulation loop.
+
+An Instrumentation object keeps cumulative wall time and call counts per named phase
+(integrate, forces, events, diagnostics, output, checkpoint, ...). Phases nest: push starts a
+phase and pauses the enclosing one, pop ends it and resumes the enclosing one, so the times are
+exclusive and add up to the instrumented part of the run. Counters are incremented explicitly;
+gauges are callables read only when a snapshot is taken (e.g. the force evaluation counter of a
+ForceCache, or the size of the output file), so they cost nothing per step.
+
+The simulation holds None instead of an Instrumentation when profiling is off, and every
+instrumentation point is guarded by one `is not None` check, so disabled instrumentation costs
+a few attribute tests per output frame or diagnostics sample.
+
+Hooks receive the measurements as they are made, for external profilers or metrics exporters.
+A hook is any object with some of the methods
+
+    run_started(info)               info: dict describing the run
+    phase_started(name)
+    phase_finished(name, seconds)   exclusive seconds of this call of the phase
+    snapshot(data)                  periodic snapshot (see Instrumentation.snapshot)
+    run_finished(summary)           the run summary (see Instrumentation.summary)
+
+Phase hooks are only dispatched when some hook defines them. With a log path, the run start,
+a snapshot every `interval` seconds and the summary are also appended to a file as JSON lines.
+"""
+import json
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+HOOK_METHODS = ("run_started", "phase_started", "phase_finished", "snapshot", "run_finished")
+
+class Instrumentation:
+    """
+    Phase timers, counters, gauges and hooks of one simulation run.
+
+    Parameters
+    ----------
+    hooks: sequence of hook objects
+    log_path: str
+        JSON lines file appended to with the run start, periodic snapshots and the summary
+    interval: float
+        seconds between periodic snapshots, 0 for none
+    clock: callable
+        time source in seconds
+    """
+
+    def __init__(self, hooks: Sequence = (), log_path: Optional[str] = None, interval: float = 10.0,
+                 clock: Callable[[], float] = time.perf_counter):
+        self.hooks = list(hooks)
+        self._dispatch = {method: [getattr(hook, method) for hook in self.hooks if hasattr(hook, method)]
+                          for method in HOOK_METHODS}
+        self._phase_hooks = bool(self._dispatch["phase_started"] or self._dispatch["phase_finished"])
+        self.log_path = log_path
+        self.interval = interval
+        self.clock = clock
+        self.info: Dict = {}
+        self.phases: Dict[str, List[float]] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self._stack: List[List] = []
+        self._start = self._last_snapshot = clock()
+
+    def start_run(self, info: Dict) -> None:
+        """Reset the measurements and announce a new run"""
+        self.info = dict(info)
+        self.phases = {}
+        self.counters = {}
+        self.gauges = {}
+        self._stack = []
+        self._start = self._last_snapshot = self.clock()
+        self._emit("run_started", self.info)
+
+    def push(self, name: str) -> None:
+        """Start phase name, pausing the enclosing phase"""
+        now = self.clock()
+        if self._stack:
+            self._charge(self._stack[-1], now)
+        self._stack.append([name, now, 0.0])
+        if self._phase_hooks:
+            for hook in self._dispatch["phase_started"]:
+                hook(name)
+
+    def pop(self) -> None:
+        """End the innermost phase and resume the enclosing one"""
+        now = self.clock()
+        frame = self._stack.pop()
+        self._charge(frame, now)
+        totals = self.phases.get(frame[0])
+        if totals is None:
+            totals = self.phases[frame[0]] = [0.0, 0]
+        totals[0] += frame[2]
+        totals[1] += 1
+        if self._stack:
+            self._stack[-1][1] = now
+        if self._phase_hooks:
+            for hook in self._dispatch["phase_finished"]:
+                hook(frame[0], frame[2])
+
+    @staticmethod
+    def _charge(frame: List, now: float) -> None:
+        frame[2] += now - frame[1]
+        frame[1] = now
+
+    def timed(self, name: str, function: Callable) -> Callable:
+        """Wrap function so that each call is timed as phase name"""
+        def wrapper(*args, **kwargs):
+            self.push(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.pop()
+        return wrapper
+
+    def count(self, name: str, amount: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        """Register a value read when snapshots and the summary are taken"""
+        self.gauges[name] = read
+
+    def values(self) -> Dict[str, float]:
+        """Counters and current gauge readings"""
+        values = dict(self.counters)
+        for name, read in self.gauges.items():
+            values[name] = read()
+        return values
+
+    def snapshot(self) -> Dict:
+        """Elapsed wall time, per-phase seconds and calls, and counter and gauge values so far"""
+        elapsed = self.clock() - self._start
+        values = self.values()
+        rates = {f"{name}_per_second": value / elapsed for name, value in values.items()
+                 if elapsed > 0 and isinstance(value, (int, float))}
+        return {
+            "run": self.info,
+            "elapsed": elapsed,
+            "phases": {name: {"seconds": seconds, "calls": calls} for name, (seconds, calls) in self.phases.items()},
+            "counters": values,
+            "rates": rates,
+        }
+
+    def tick(self) -> None:
+        """Emit a periodic snapshot if interval seconds have passed since the last one"""
+        if self.interval <= 0 or not (self.log_path or self._dispatch["snapshot"]):
+            return
+        now = self.clock()
+        if now - self._last_snapshot >= self.interval:
+            self._last_snapshot = now
+            self._emit("snapshot", self.snapshot())
+
+    def summary(self) -> Dict:
+        """Final snapshot of the run, with the share of wall time spent in each phase"""
+        summary = self.snapshot()
+        elapsed = summary["elapsed"]
+        instrumented = sum(phase["seconds"] for phase in summary["phases"].values())
+        for phase in summary["phases"].values():
+            phase["fraction"] = phase["seconds"] / elapsed if elapsed > 0 else 0.0
+        summary["uninstrumented_seconds"] = max(0.0, elapsed - instrumented)
+        return summary
+
+    def finish_run(self) -> Dict:
+        """Close any open phases and return and announce the run summary"""
+        while self._stack:
+            self.pop()
+        summary = self.summary()
+        self._emit("run_finished", summary)
+        return summary
+
+    def _emit(self, event: str, data: Dict) -> None:
+        for hook in self._dispatch[event]:
+            hook(data)
+        if self.log_path:
+            line = json.dumps({"event": event, "time": time.time(), **data}, default=str)
+            # One write per line keeps lines from concurrent sweep workers whole
+            with open(self.log_path, "a") as log_file:
+                log_file.write(line + "\n")
+
+def format_summary(summary: Dict) -> str:
+    """Human readable report of a run summary"""
+    lines = [f"Profile ({summary['elapsed']:.3f} s):"]
+    for name, phase in sorted(summary["phases"].items(), key=lambda item: -item[1]["seconds"]):
+        per_call = phase["seconds"] / phase["calls"] * 1e6 if phase["calls"] else 0.0
+        lines.append(f"  {name:<12} {phase['seconds']:9.3f} s {phase['fraction']:7.1%} "
+                     f"{phase['calls']:>10} calls {per_call:10.1f} us/call")
+    lines.append(f"  {'other':<12} {summary['uninstrumented_seconds']:9.3f} s")
+    for name, value in summary["counters"].items():
+        rate = summary["rates"].get(f"{name}_per_second")
+        lines.append(f"  {name:<20} {value:>14,.0f}" + (f" ({rate:,.0f}/s)" if rate is not None else ""))
+    return "\n".join(lines)
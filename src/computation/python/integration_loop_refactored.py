@@ -1,24 +1,111 @@
 import numpy as np
 from particle3D import Particle3D
+from system_state import SystemState
+from force_cache import ForceCache
+from backends import get_backend, BACKENDS, FORCE_SOLVERS
+from adaptive import TimeTransformedStepper
+from autotune import tune_dt, PROBE_TIME
+from schemes import METHODS, SCHEMES, get_scheme, parse_method
+from events import Event, EventDetector, parse_event_spec
+from checkpoint import checkpoint_path, save_checkpoint, load_checkpoint
+from result_cache import ResultCache, result_key, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
 import Forces_and_Separations
+from trajectory import open_trajectory_writer, update_header, FORMATS
+from output_pipeline import BufferedTrajectoryWriter, TeeTrajectoryWriter
+from chunked_export import ChunkedTrajectoryWriter, export_trajectory, export_path, ENCODINGS, \
+    DEFAULT_MAX_ERROR, DEFAULT_CHUNK_FRAMES
+from diagnostics import Diagnostics
+from instrumentation import Instrumentation, format_summary
+from catalog import Catalog, parse_shard
 import sys
 import time
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Union, Optional, Callable, Sequence
 import copy
+import contextlib
 import os
+import warnings
+import argparse
+
+DEFAULT_OUTPUT_DIR = "/Users/allisonlau/VSCodeProjects/three-body/public/position_files"
+EVENT_LOG_SUFFIX = ".events"
 
 class SimulationConfig:
     """Configuration class for simulation parameters"""
-    def __init__(self, num_steps: int, dt: float, proximity_threshold: float = 100):
+    def __init__(self, num_steps: int, dt: float, proximity_threshold: float = 100, output_dir: str = DEFAULT_OUTPUT_DIR,
+                 output_format: str = "text", output_buffer_frames: int = 1024,
+                 diagnostics_every: int = 1, keep_history: bool = False, backend: str = "numpy",
+                 softening: float = 0.0, force_solver: str = "direct", theta: float = 0.5,
+                 quadrupole: bool = False, cache_dir: Optional[str] = None,
+                 cache_max_bytes: int = DEFAULT_MAX_BYTES, force: bool = False, checkpoint_every: int = 0,
+                 adaptive: bool = False, events: Optional[List[Event]] = None,
+                 energy_tolerance: Optional[float] = None, export: Optional[str] = None,
+                 export_max_error: float = DEFAULT_MAX_ERROR, export_chunk_frames: int = DEFAULT_CHUNK_FRAMES,
+                 profile: bool = False, profile_log: Optional[str] = None, profile_interval: float = 10.0):
         self.output_interval = 0.05
         self.dt = dt
         self.proximity_threshold = proximity_threshold
+        self.output_dir = output_dir
+        self.output_format = output_format
+        # Frames per chunk handed to the background writer thread; 0 writes synchronously
+        self.output_buffer_frames = output_buffer_frames
+        # Integration steps between energy/momentum samples, and whether to keep every sample
+        self.diagnostics_every = diagnostics_every
+        self.keep_history = keep_history
+        # Name of the compute backend for forces and the step loop (see backends.py)
+        self.backend = backend
+        # Plummer softening length of the gravitational interaction, 0 for exact Newtonian forces
+        self.softening = softening
+        # "tree" uses the Barnes-Hut solver with opening parameter theta for systems larger than
+        # a tree leaf; three-body configurations always use direct summation
+        self.force_solver = force_solver
+        self.theta = theta
+        self.quadrupole = quadrupole
+        # Result cache directory (None disables caching); force re-runs and replaces cached results
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.force = force
+        # Output frames between checkpoints (0 disables checkpointing); a checkpoint is also
+        # written when a run ends, so finished runs can be extended
+        self.checkpoint_every = checkpoint_every
+        # Time-transformed adaptive steps (see adaptive.py) instead of a fixed dt; outputs stay
+        # on the output_interval grid and dt sets the length of the first step
+        self.adaptive = adaptive
+        # Events checked after every step (see events.py), logged next to each trajectory
+        self.events = list(events or [])
+        # Relative energy error budget; when set, each configuration and method runs with the
+        # largest dt, at most dt, that probe runs predict will meet it (see autotune.py)
+        self.energy_tolerance = energy_tolerance
+        # Encoding of a compressed, chunked copy of each trajectory for progressive loading
+        # (see chunked_export.py), None for no export
+        self.export = export
+        self.export_max_error = export_max_error
+        self.export_chunk_frames = export_chunk_frames
+        # Per-phase timers and counters (see instrumentation.py): profile prints a report per
+        # run, profile_log appends JSON lines with a snapshot every profile_interval seconds
+        self.profile = profile
+        self.profile_log = profile_log
+        self.profile_interval = profile_interval
         
         # Calculate actual number of integration steps needed
         self.total_time = num_steps * self.output_interval
-        self.num_integration_steps = int(self.total_time / self.dt)
+        self.num_integration_steps = self._integration_steps()
+    
+    def _integration_steps(self) -> int:
+        # Steps that divide the output interval must not lose the last one to rounding
+        return int(self.total_time / self.dt + 1e-9)
+    
+    def with_dt(self, dt: float) -> "SimulationConfig":
+        """A copy of the configuration with a different time step"""
+        config = copy.copy(self)
+        config.dt = dt
+        config.num_integration_steps = config._integration_steps()
+        return config
+    
+    def output_path(self, name: str, method: int) -> str:
+        """Path of the trajectory file for a configuration and method"""
+        return os.path.join(self.output_dir, str(method), f"{name}{FORMATS[self.output_format]}")
 
 class InitialCondition:
     def __init__(self, name: str, particles: List[Particle3D]):
@@ -27,50 +114,38 @@ class InitialCondition:
 
 class Integrator:
     """Class handling different integration methods"""
-    # Symplectic integrator coefficients
-    COEFFICIENTS = {
-        1: {
-            "c": [1],
-            "d": [1]
-        },
-        2: {
-            "c": [1/2, 1/2],
-            "d": [1, 0]
-        },
-        3: {
-            "c": [7/24, 3/4, -1/24],
-            "d": [2/3, -2/3, 1]
-        },
-        4: {
-            "c": [
-                1/(2*(2-2**(1/3))),
-                (1-2**(1/3))/(2*(2-2**(1/3))),
-                (1-2**(1/3))/(2*(2-2**(1/3))),
-                1/(2*(2-2**(1/3)))
-            ],
-            "d": [
-                1/(2-2**(1/3)),
-                (-2**(1/3))/(2-2**(1/3)),
-                1/(2-2**(1/3)),
-                0
-            ]
-        }
-    }
+    # Symplectic integrator coefficients of the numbered methods; these and the further
+    # schemes selectable by name live in the registry in schemes.py
+    COEFFICIENTS = {method: scheme.coefficients for method, scheme in sorted(METHODS.items())}
     
     @staticmethod
-    def symplectic_step(particles: List[Particle3D], dt: float, coeffs: Dict[str, List[float]], steps: int) -> None:
-        """Perform one step of symplectic integration"""
-        for k in range(steps):
-            separations = Forces_and_Separations.compute_separations(particles)
-            forces, _ = Forces_and_Separations.compute_forces_potential(particles, separations)
-            
-            # First update all velocities
-            for particle, force in zip(particles, forces):
-                particle.update_velocity_symplectic(dt, force, coeffs["c"][k])
-                
-            # Then update all positions
-            for particle in particles:
-                particle.update_position_symplectic(dt, coeffs["d"][k])
+    def symplectic_step(state: Union[SystemState, List[Particle3D]], dt: float, coeffs: Dict[str, List[float]], steps: int,
+                        cache: Optional[ForceCache] = None, backend=None, tracers=None) -> None:
+        """
+        Perform one step of symplectic integration in place on a SystemState (or a list of Particle3D).
+        
+        With a ForceCache, forces at unchanged positions are reused across stages and steps,
+        and the cache holds the forces at the final positions when the step returns. The
+        backend (NumPy by default) performs the kicks, drifts and force evaluations.
+        
+        With a TracerState (see tracers.py) the massless tracers are kicked and drifted in
+        the same stages, in the field of the state's particles.
+        """
+        if not isinstance(state, SystemState):
+            particles = state
+            state = SystemState.from_particles(particles)
+            Integrator.symplectic_step(state, dt, coeffs, steps, backend=backend)
+            state.sync_particles(particles)
+            return
+        
+        if backend is None:
+            backend = get_backend("numpy")
+        if cache is None:
+            cache = ForceCache(backend.evaluate)
+        if tracers is not None:
+            tracers.symplectic_step(state, dt, coeffs, steps, cache)
+        else:
+            backend.symplectic_step(state, dt, coeffs, steps, cache)
     
     # @staticmethod
     # def euler_step(particles: List[Particle3D], dt: float) -> None:
@@ -84,239 +159,776 @@ class Integrator:
 
 def parse_initial_conditions(file_path: str) -> List[InitialCondition]:
     """Parse the initial conditions file and return a list of configurations"""
+    try:
+        with open(file_path, 'r') as file:
+            lines = file.readlines()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Initial conditions file not found: {file_path}")
+    return parse_initial_condition_lines(lines)
+
+def parse_initial_condition_lines(lines: List[str]) -> List[InitialCondition]:
+    """Parse lines in the initial conditions file format into a list of configurations"""
     initial_conditions = []
     current_name = None
     current_particles = []
     
-    try:
-        with open(file_path, 'r') as file:
-            lines = file.readlines()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
             
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if not line[0].isdigit():  # This is a configuration name
-                if current_name and current_particles:
-                    initial_conditions.append(InitialCondition(current_name, current_particles))
-                current_name = line
-                current_particles = []
-            else:  # This is a particle definition
-                particle = Particle3D.read_line(line)
-                current_particles.append(particle)
-                
-        # Add the last configuration
-        if current_name and current_particles:
-            initial_conditions.append(InitialCondition(current_name, current_particles))
+        if not line[0].isdigit():  # This is a configuration name
+            if current_name and current_particles:
+                initial_conditions.append(InitialCondition(current_name, current_particles))
+            current_name = line
+            current_particles = []
+        else:  # This is a particle definition
+            particle = Particle3D.read_line(line)
+            current_particles.append(particle)
             
-        return initial_conditions
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Initial conditions file not found: {file_path}")
+    # Add the last configuration
+    if current_name and current_particles:
+        initial_conditions.append(InitialCondition(current_name, current_particles))
+        
+    return initial_conditions
 
 class NBodySimulation:
-    def __init__(self, config: SimulationConfig):
+    # Number of integration steps between calls to a progress callback
+    PROGRESS_INTERVAL = 1000
+    
+    def __init__(self, config: SimulationConfig, verbose: bool = True, hooks: Sequence = (), frame_sinks: Sequence = ()):
         self.config = config
+        self.verbose = verbose
+        # Instrumentation hooks (see instrumentation.py); any hook enables the instrumentation
+        self.hooks = list(hooks)
+        # Writers that receive every output frame of a run as it is recorded, alongside the
+        # trajectory file, e.g. to stream frames to a client (see service.py)
+        self.frame_sinks = list(frame_sinks)
+        self.instrumentation = None
         self.next_output_time = 0.0  # Track when to write next output
     
+    def _log(self, message: str) -> None:
+        """Print a progress message unless running quietly"""
+        if self.verbose:
+            print(message)
+    
     def _reset_simulation_state(self):
         """Reset simulation state variables between runs"""
         self.next_output_time = 0.0  # Reset output timing
+        self.frames_written = 0
+    
+    def run_simulation(self, initial_condition: InitialCondition, method: Union[int, str],
+                       progress: Optional[Callable[[int], None]] = None, resume: bool = False) -> Dict:
+        """
+        Run simulation for a specific initial condition and return its statistics.
+        
+        method is a method number (1-4) or the name of a scheme in the schemes registry.
+        
+        If a progress callback is given it is called with the number of integration steps
+        completed since the previous call, and no per-run progress bar is shown.
+        
+        With a cache_dir configured, a run whose inputs, settings and code are unchanged is not
+        integrated again: the cached trajectory is copied to the output path instead.
+        
+        With resume, a run continues from its latest checkpoint, if there is one: the
+        trajectory is truncated to the checkpointed frames and appended to, reproducing the
+        uninterrupted run exactly. Resuming a finished run with more steps extends it.
+        
+        With an energy_tolerance configured, dt is first chosen for this configuration and
+        method by probe runs (see autotune.py) and recorded with the tuning in the statistics
+        and, for binary output, in the trajectory header. Progress is still reported in steps
+        of the configured dt. A resumed run keeps the dt of its checkpoint.
+        
+        With profiling configured or hooks given, the time spent in each phase of the run and
+        counts of steps, force evaluations, frames and bytes written are measured and returned
+        in the statistics under "profile" (see instrumentation.py).
+        """
+        self.instrumentation = None
+        if self.config.profile or self.config.profile_log or self.hooks:
+            self.instrumentation = Instrumentation(self.hooks, self.config.profile_log, self.config.profile_interval)
+            self.instrumentation.start_run({"name": initial_condition.name, "method": method, "dt": self.config.dt})
+        statistics = self._run_tuned(initial_condition, method, progress, resume)
+        if self.instrumentation is not None:
+            statistics = dict(statistics, profile=self.instrumentation.finish_run())
+            if self.verbose and self.config.profile:
+                print(format_summary(statistics["profile"]))
+        return statistics
+    
+    def _run_tuned(self, initial_condition: InitialCondition, method: Union[int, str],
+                   progress: Optional[Callable[[int], None]] = None, resume: bool = False) -> Dict:
+        """Run with the configured dt, or with the auto-tuned one if an energy tolerance is set"""
+        self.autotune = None
+        if self.config.energy_tolerance is None:
+            return self._run_simulation(initial_condition, method, progress, resume)
+        
+        base_config = self.config
+        if self.instrumentation is not None:
+            self.instrumentation.push("autotune")
+        # Tuned runs are cached under the configured dt and the tolerance, with the tuning in
+        # their statistics, so a cache hit needs no probe runs
+        self.autotune = self._cached_tuning(initial_condition, method, resume)
+        if self.autotune is None:
+            self.autotune = self._tune_dt(initial_condition, method, resume)
+        if self.instrumentation is not None:
+            self.instrumentation.pop()
+        self.config = base_config.with_dt(self.autotune["dt"])
+        if progress is not None:
+            progress = self._scaled_progress(progress, base_config.num_integration_steps / self.config.num_integration_steps)
+        try:
+            return self._run_simulation(initial_condition, method, progress, resume, cache_config=base_config)
+        finally:
+            self.config = base_config
     
-    def run_simulation(self, initial_condition: InitialCondition, method: int) -> None:
-        """Run simulation for a specific initial condition"""
+    def _cached_tuning(self, initial_condition: InitialCondition, method: Union[int, str], resume: bool) -> Optional[Dict]:
+        """The tuning stored with a cached result of this run, None if it has to be tuned"""
+        if self.config.cache_dir is None or self.config.force:
+            return None
+        if resume and os.path.exists(checkpoint_path(self.config.output_path(initial_condition.name, method))):
+            return None
+        meta = ResultCache(self.config.cache_dir, self.config.cache_max_bytes).lookup(
+            result_key(initial_condition, method, self.config))
+        if meta is None:
+            return None
+        tuning = meta["statistics"].get("autotune")
+        if tuning is not None:
+            self._log(f"Using cached dt for {initial_condition.name} (method {method}): {tuning['dt']:.6g}")
+        return tuning
+    
+    def _tune_dt(self, initial_condition: InitialCondition, method: Union[int, str], resume: bool) -> Dict:
+        """The auto-tuned dt of a run, from its checkpoint when resuming"""
+        checkpoint_file = checkpoint_path(self.config.output_path(initial_condition.name, method))
+        if resume and os.path.exists(checkpoint_file):
+            tuning = load_checkpoint(checkpoint_file).get("autotune")
+            if tuning is not None:
+                return tuning
+        
+        state = SystemState.from_particles(copy.deepcopy(initial_condition.particles))
+        state.remove_com_velocity()
+        backend = get_backend(self.config.backend, softening=self.config.softening,
+                              force_solver=self.config.force_solver, theta=self.config.theta,
+                              quadrupole=self.config.quadrupole)
+        tuning = tune_dt(state, get_scheme(method), self.config.energy_tolerance, backend, self.config.dt,
+                         self.config.output_interval, probe_time=min(self.config.total_time, PROBE_TIME),
+                         proximity_threshold=self.config.proximity_threshold)
+        self._log(f"Auto-tuned dt for {initial_condition.name} (method {method}): {tuning['dt']:.6g} "
+                  f"after {len(tuning['probes'])} probes, predicted energy error {tuning['predicted_error']:.2e}")
+        if not tuning["tolerance_met"]:
+            warnings.warn(f"No probe of {initial_condition.name} (method {method}) met the energy tolerance "
+                          f"{tuning['tolerance']:g}; running with dt {tuning['dt']:.6g}", RuntimeWarning)
+        return tuning
+    
+    @staticmethod
+    def _scaled_progress(progress: Callable[[int], None], scale: float) -> Callable[[int], None]:
+        """Wrap a progress callback so that steps of one length are reported as steps of another"""
+        done = 0
+        reported = 0
+        
+        def update(steps: int) -> None:
+            nonlocal done, reported
+            done += steps
+            position = int(done * scale)
+            if position > reported:
+                progress(position - reported)
+                reported = position
+        return update
+    
+    def _run_simulation(self, initial_condition: InitialCondition, method: Union[int, str],
+                        progress: Optional[Callable[[int], None]] = None, resume: bool = False,
+                        cache_config: Optional[SimulationConfig] = None) -> Dict:
+        """
+        Run simulation for a specific initial condition with the configured dt. The result is
+        cached under the settings of cache_config, by default the configuration.
+        """
         # Reset state at the start of each run
         self._reset_simulation_state()
         
         self.particles = copy.deepcopy(initial_condition.particles)
-        self.n_particles = len(self.particles)
+        self.state = SystemState.from_particles(self.particles)
+        self.n_particles = self.state.n_particles
         self._initialize_system()
         
-        output_file_path = f"/Users/allisonlau/VSCodeProjects/three-body/public/position_files/{method}/{initial_condition.name}.txt"
-        print(f"\nProcessing configuration: {initial_condition.name} with method {method}")
+        self.scheme = get_scheme(method)
+        output_file_path = self.config.output_path(initial_condition.name, method)
+        self._log(f"\nProcessing configuration: {initial_condition.name} with method {method}")
+        
+        checkpoint_file = checkpoint_path(output_file_path)
+        checkpoint = None
+        if resume and os.path.exists(checkpoint_file):
+            checkpoint = load_checkpoint(checkpoint_file)
+            if checkpoint["method"] != method or checkpoint["dt"] != self.config.dt \
+                    or checkpoint["labels"] != self.state.labels:
+                raise ValueError(f"Checkpoint {checkpoint_file} belongs to a different run")
         
-        # Initialize arrays based on number of integration steps
-        times = np.zeros(self.config.num_integration_steps)
-        energy = np.zeros(self.config.num_integration_steps)
-        momentum_history = {
-            'x': [], 'y': [], 'z': [], 'total': []
+        header = {
+            "labels": self.state.labels,
+            "masses": self.state.masses.tolist(),
+            "dt": self.config.dt,
+            "method": method,
+            "scheme": self.scheme.name,
+            "output_interval": self.config.output_interval,
         }
+        if self.autotune is not None:
+            header["autotune"] = self.autotune
+        if self.config.adaptive:
+            # Frames of adaptive runs lie on the output grid rather than at dt + k * output_interval
+            header["adaptive"] = True
+        
+        export_file = export_path(output_file_path) if self.config.export else None
+        
+        cache = None
+        if self.config.cache_dir is not None and checkpoint is None:
+            cache = ResultCache(self.config.cache_dir, self.config.cache_max_bytes)
+            cache_key = result_key(initial_condition, method, cache_config or self.config)
+            if not self.config.force:
+                statistics = cache.materialize(cache_key, output_file_path)
+                if statistics is not None:
+                    self._log(f"Using cached result for {initial_condition.name} (method {method})")
+                    if export_file is not None:
+                        statistics = dict(statistics, export_file=self._export(output_file_path, header))
+                    if progress is not None:
+                        progress(self.config.num_integration_steps)
+                    return statistics
+        
+        # Forces at the current positions, shared by the integrator and the diagnostics
+        self.backend = get_backend(self.config.backend, softening=self.config.softening,
+                                   force_solver=self.config.force_solver, theta=self.config.theta,
+                                   quadrupole=self.config.quadrupole)
+        instrumentation = self.instrumentation
+        evaluate = self.backend.evaluate
+        if instrumentation is not None:
+            # Compiled step loops evaluate forces internally; their time counts as integrate
+            evaluate = instrumentation.timed("forces", evaluate)
+        self.force_cache = ForceCache(evaluate)
+        
+        # Adaptive runs step in a transformed time; dt is the length of the first step
+        self.stepper = TimeTransformedStepper() if self.config.adaptive else None
+        if self.stepper is not None:
+            self.stepper.start(self.state, self.force_cache, self.config.dt)
+        
+        # Streaming energy and momentum statistics, constant memory unless history is requested
+        self.diagnostics = Diagnostics(self.config.diagnostics_every, self.config.keep_history)
         
         current_time = 0.0
+        status = "completed"
+        steps_completed = 0
+        if checkpoint is not None:
+            current_time, steps_completed, status = self._restore_checkpoint(checkpoint)
+            self._log(f"Resuming from step {steps_completed} (t = {current_time:.4f})")
+        resumed_from = steps_completed
+        
+        # Schemes selected by name get their own output directories
+        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+        if checkpoint is not None:
+            # Drop any frames written after the checkpoint, then append
+            with open(output_file_path, "r+b") as f:
+                f.truncate(checkpoint["output_bytes"])
+        writer = open_trajectory_writer(output_file_path, self.config.output_format, header,
+                                        mode="a" if checkpoint is not None else "w")
+        if export_file is not None and checkpoint is None:
+            # A fresh run streams its export; a resumed one re-exports the whole trajectory below
+            writer = TeeTrajectoryWriter(writer, ChunkedTrajectoryWriter(
+                export_file, header, self.config.export, self.config.export_max_error,
+                self.config.export_chunk_frames))
+        if self.frame_sinks:
+            writer = TeeTrajectoryWriter(writer, *self.frame_sinks)
+        if self.config.output_buffer_frames:
+            writer = BufferedTrajectoryWriter(writer, self.n_particles, self.config.output_buffer_frames)
+        
+        self.event_detector = None
+        events_path = os.path.splitext(output_file_path)[0] + EVENT_LOG_SUFFIX
+        if self.config.events:
+            if checkpoint is not None:
+                with open(events_path, "r+b") as f:
+                    f.truncate(checkpoint["events"]["bytes"])
+            self.event_detector = EventDetector(self.config.events, self.state.masses, events_path, self.state.labels,
+                                                mode="a" if checkpoint is not None else "w")
+            if checkpoint is not None:
+                self.event_detector.counts = list(checkpoint["events"]["counts"])
+            self.event_detector.start(self.state.positions, self.state.velocities)
+        
+        if instrumentation is not None:
+            initial_bytes = os.path.getsize(output_file_path)
+            instrumentation.gauge("force_evaluations", lambda: self.force_cache.evaluations)
+            instrumentation.gauge("frames", lambda: self.frames_written)
+            instrumentation.gauge("bytes_written", lambda: os.path.getsize(output_file_path) - initial_bytes)
         
-        with open(output_file_path, "w") as output_file:
-            # Write initial state
-            self._record_state(0, momentum_history, energy, 0.0, output_file)
+        with writer, (self.event_detector or contextlib.nullcontext()):
+            if checkpoint is None:
+                # Write initial state
+                _, initial_potential, _ = self.force_cache.evaluate(self.state)
+                self._record_state(0.0, initial_potential, writer)
+                if self.stepper is not None:
+                    self.next_output_time = self.config.output_interval
             
-            for step in tqdm(range(self.config.num_integration_steps), 
-                           desc=f"Simulating {initial_condition.name} (method {method})",
-                           ncols=100):
-                current_time = self._run_step(method, step, current_time, momentum_history, times, energy, output_file)
-                if current_time is None:  # Simulation terminated early
-                    print(f"\nSimulation terminated early for {initial_condition.name} with method {method}")
+            total_steps = self.config.num_integration_steps
+            reported_steps = self._progress_position(steps_completed, current_time)
+            progress_bar = None
+            if progress is None:
+                progress_bar = tqdm(total=total_steps, initial=reported_steps,
+                                    desc=f"Simulating {initial_condition.name} (method {method})", ncols=100)
+                progress = progress_bar.update
+            elif reported_steps:
+                # Steps done before the checkpoint count towards the caller's total
+                progress(reported_steps)
+            checkpointed_frames = self.frames_written
+            
+            while status == "completed" and not self._finished(steps_completed, current_time):
+                # Advance to the next diagnostics sample or output frame, whichever comes first
+                max_steps = self.diagnostics.steps_to_next_sample(steps_completed)
+                if self.event_detector is not None:
+                    # Events are checked between every pair of consecutive steps
+                    max_steps = 1
+                if self.stepper is None:
+                    max_steps = min(total_steps - steps_completed, max_steps)
+                current_time, steps_taken, terminated = self._run_steps(method, steps_completed, max_steps, current_time, writer)
+                steps_completed += steps_taken
+                if instrumentation is not None:
+                    instrumentation.count("steps", steps_taken)
+                    instrumentation.tick()
+                position = self._progress_position(steps_completed, current_time)
+                if position - reported_steps >= self.PROGRESS_INTERVAL:
+                    progress(position - reported_steps)
+                    reported_steps = position
+                if terminated:  # Simulation terminated early
+                    self._log(f"\nSimulation terminated early for {initial_condition.name} with method {method}")
+                    status = "terminated"
                     break
+                if self.config.checkpoint_every and \
+                        self.frames_written - checkpointed_frames >= self.config.checkpoint_every:
+                    self._save_checkpoint(checkpoint_file, writer, method, current_time, steps_completed, status)
+                    checkpointed_frames = self.frames_written
+            position = self._progress_position(steps_completed, current_time)
+            if position > reported_steps:
+                progress(position - reported_steps)
+            if progress_bar is not None:
+                progress_bar.close()
+            if self.config.checkpoint_every:
+                self._save_checkpoint(checkpoint_file, writer, method, current_time, steps_completed, status)
+            if instrumentation is not None:
+                # Charge the write-out of buffered frames to output before the writer closes
+                instrumentation.push("output")
+                writer.flush()
+                instrumentation.pop()
+        
+        # Keep the Particle3D view in step with the integrated arrays
+        self.state.sync_particles(self.particles)
+        if export_file is not None and checkpoint is not None:
+            self._export(output_file_path, header)
         
         # Verify file was written
+        file_size = None
         try:
             file_size = os.path.getsize(output_file_path)
-            print(f"File size for {initial_condition.name} (method {method}): {file_size} bytes")
+            self._log(f"File size for {initial_condition.name} (method {method}): {file_size} bytes")
         except OSError as e:
-            print(f"Error checking file {output_file_path}: {e}")
-            
-        self._print_statistics(initial_condition.name, energy, momentum_history, output_file_path)
+            self._log(f"Error checking file {output_file_path}: {e}")
+        
+        statistics = {
+            "name": initial_condition.name,
+            "method": method,
+            "dt": self.config.dt,
+            "status": status,
+            "steps_completed": steps_completed,
+            "output_file": output_file_path,
+            "file_size": file_size,
+            "force_evaluations": self.force_cache.evaluations,
+        }
+        if self.stepper is not None:
+            statistics["adaptive"] = True
+        if export_file is not None:
+            statistics["export_file"] = export_file
+        if self.autotune is not None:
+            statistics["autotune"] = self.autotune
+        if self.event_detector is not None:
+            statistics["events"] = self.event_detector.summary()
+            statistics["events_file"] = events_path
+        if checkpoint is not None:
+            statistics["resumed_from_step"] = resumed_from
+        statistics.update(self.diagnostics.summary())
+        if self.autotune is not None:
+            self._check_tolerance(statistics, header, output_file_path)
+        if self.config.keep_history:
+            history_path = os.path.splitext(output_file_path)[0] + ".diagnostics.npz"
+            np.savez(history_path, **self.diagnostics.history_arrays())
+            statistics["history_file"] = history_path
+        if cache is not None:
+            cache.store(cache_key, statistics, replace=self.config.force)
+        if self.verbose:
+            self._print_statistics(initial_condition.name, statistics, output_file_path)
+        return statistics
+    
+    def _check_tolerance(self, statistics: Dict, header: Dict, output_file_path: str) -> None:
+        """
+        Compare the energy deviation of a tuned run with the tolerance, recording the outcome in
+        the statistics and, for binary output, the trajectory header, and warning if it was missed
+        """
+        tolerance = self.config.energy_tolerance
+        deviation = statistics["energy_deviation"]
+        tolerance_met = bool(deviation <= tolerance)
+        statistics["tolerance_met"] = tolerance_met
+        if not tolerance_met:
+            statistics["warning"] = (f"energy deviation {deviation:.2e} of {statistics['name']} (method "
+                                     f"{statistics['method']}) exceeds the tolerance {tolerance:g}")
+            warnings.warn(statistics["warning"], RuntimeWarning)
+        if self.config.output_format == "binary":
+            header["tolerance_met"] = tolerance_met
+            update_header(output_file_path, header)
+    
+    def _export(self, output_file_path: str, header: Dict) -> str:
+        """Write the chunked export of a finished trajectory file, returning its path"""
+        return export_trajectory(output_file_path, export_path(output_file_path), self.config.export,
+                                 self.config.export_max_error, self.config.export_chunk_frames, header)
+    
+    def _save_checkpoint(self, path: str, writer, method: int, current_time: float, steps_completed: int,
+                         status: str) -> None:
+        """Flush the trajectory and checkpoint the run at the current step"""
+        if self.instrumentation is not None:
+            self.instrumentation.push("checkpoint")
+        writer.flush()
+        run = {
+            "method": method,
+            "dt": self.config.dt,
+            "current_time": current_time,
+            "next_output_time": self.next_output_time,
+            "steps_completed": steps_completed,
+            "frames_written": self.frames_written,
+            "status": status,
+            "output_bytes": os.path.getsize(writer.path),
+            "force_evaluations": self.force_cache.evaluations,
+        }
+        if self.stepper is not None:
+            run["stepper"] = {"ds": self.stepper.ds, "w": self.stepper.w}
+        if self.autotune is not None:
+            run["autotune"] = self.autotune
+        if self.event_detector is not None:
+            self.event_detector.flush()
+            run["events"] = {"counts": self.event_detector.counts,
+                             "bytes": os.path.getsize(self.event_detector.log_path)}
+        save_checkpoint(path, self.state, self.force_cache, self.diagnostics, run)
+        if self.instrumentation is not None:
+            self.instrumentation.pop()
+    
+    def _restore_checkpoint(self, checkpoint: Dict) -> Tuple[float, int, str]:
+        """Load the state of a checkpoint, returning the time, step index and status"""
+        self.state.positions[...] = checkpoint["positions"]
+        self.state.velocities[...] = checkpoint["velocities"]
+        self.next_output_time = checkpoint["next_output_time"]
+        self.frames_written = checkpoint["frames_written"]
+        self.diagnostics.load_state_dict(checkpoint["diagnostics"])
+        self.force_cache.invalidate()
+        if "forces" in checkpoint:
+            self.force_cache.store(checkpoint["forces"], checkpoint["potential"], checkpoint["distances"])
+        self.force_cache.evaluations = checkpoint["force_evaluations"]
+        if self.stepper is not None:
+            if "stepper" not in checkpoint:
+                raise ValueError("Cannot resume a fixed-step checkpoint in adaptive mode")
+            self.stepper.ds = checkpoint["stepper"]["ds"]
+            self.stepper.w = checkpoint["stepper"]["w"]
+        return checkpoint["current_time"], checkpoint["steps_completed"], checkpoint["status"]
+    
+    def _finished(self, steps_completed: int, current_time: float) -> bool:
+        """Whether the run has reached its end: a step count, or for adaptive runs the final output time"""
+        if self.stepper is not None:
+            return current_time >= self.config.total_time
+        return steps_completed >= self.config.num_integration_steps
+    
+    def _progress_position(self, steps_completed: int, current_time: float) -> int:
+        """Progress in integration steps; adaptive runs count the fixed steps of length dt covered"""
+        if self.stepper is not None:
+            return min(int(current_time / self.config.dt), self.config.num_integration_steps)
+        return steps_completed
     
     def _initialize_system(self) -> None:
         """Initialize the system by correcting center of mass velocity"""
-        com_velocity = Particle3D.com_velocity(self.particles)
-        for particle in self.particles:
-            particle.velocity -= com_velocity
-    
-    def _calculate_momentum(self) -> Tuple[float, float, float, float]:
-        """Calculate system momentum components"""
-        momentum = np.zeros(3)
-        for particle in self.particles:
-            momentum += particle.velocity * particle.mass
-        return (*momentum, np.sum(momentum))
-    
-    def _run_step(self, method: int, step: int, current_time: float, momentum_history: Dict, times: np.ndarray, energy: np.ndarray, output_file) -> float:
-        """Run a single simulation step"""
-        times[step] = current_time
-        current_time += self.config.dt
-        
-        # Integration step
-        steps = method
-        Integrator.symplectic_step(self.particles, self.config.dt, Integrator.COEFFICIENTS[method], steps)
-        
-        # Update system state
-        separations = Forces_and_Separations.compute_separations(self.particles)
-        if self._check_proximity(separations):
-            # Record final state before terminating
-            _, potential = Forces_and_Separations.compute_forces_potential(self.particles, separations)
-            kinetic = Particle3D.total_kinetic_energy(self.particles)
-            energy[step] = kinetic + potential
-            mx, my, mz, mt = self._calculate_momentum()
-            for key, value in zip(['x', 'y', 'z', 'total'], [mx, my, mz, mt]):
-                momentum_history[key].append(value)
-            
-            # self._plot_results(times[:step + 1], momentum_history)
-            return None
-            
-        _, potential = Forces_and_Separations.compute_forces_potential(self.particles, separations)
-        
-        # Always record energy and momentum for every step
-        kinetic = Particle3D.total_kinetic_energy(self.particles)
-        energy[step] = kinetic + potential
-        mx, my, mz, mt = self._calculate_momentum()
-        for key, value in zip(['x', 'y', 'z', 'total'], [mx, my, mz, mt]):
-            momentum_history[key].append(value)
-        
-        # Write to file only at specified intervals
-        if current_time >= self.next_output_time:
-            self._record_state(step, momentum_history, energy, potential, output_file)
-            self.next_output_time = current_time + self.config.output_interval
-        
-        return current_time
-    
-    def _check_proximity(self, separations: np.ndarray) -> bool:
-        """Check if particles exceed proximity threshold"""
-        for i in range(self.n_particles):
-            for j in range(i + 1, self.n_particles):
-                if np.linalg.norm(separations[i, j]) > self.config.proximity_threshold:
-                    return True
-        return False
-    
-    def _record_state(self, step: int, momentum_history: Dict, energy: np.ndarray, 
-                     potential: float, output_file) -> None:
-        """Record the current state of the system"""
-        # Calculate current momentum and energy
-        mx, my, mz, mt = self._calculate_momentum()
-        kinetic = Particle3D.total_kinetic_energy(self.particles)
-        current_energy = kinetic + potential
-        energy[step] = current_energy
-        
-        # Calculate changes from previous step
-        if step > 0:
-            d_mx = mx - momentum_history['x'][-1]
-            d_my = my - momentum_history['y'][-1]
-            d_mz = mz - momentum_history['z'][-1]
-            d_energy = current_energy - energy[step-1]
+        self.state.remove_com_velocity()
+    
+    def _run_steps(self, method: Union[int, str], step: int, max_steps: int, current_time: float, writer) -> Tuple[float, int, bool]:
+        """
+        Run up to max_steps integration steps starting at integration step `step`, stopping after
+        the step that reaches the next output time or violates the proximity threshold.
+        Returns the new time, the number of steps taken and whether the run terminated.
+        """
+        # Integration steps, including the proximity check after each one
+        coeffs = self.scheme.coefficients
+        steps = self.scheme.stages
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            instrumentation.push("integrate")
+        if self.event_detector is not None:
+            start_time = current_time
+            start_forces, _, _ = self.force_cache.evaluate(self.state)
+            start_positions = self.state.positions.copy()
+            start_velocities = self.state.velocities.copy()
+        if self.stepper is not None:
+            steps_taken, current_time, terminated = self.stepper.advance(
+                self.state, self.force_cache, coeffs, steps,
+                current_time, max_steps, self.next_output_time, self.config.proximity_threshold)
         else:
-            d_mx = d_my = d_mz = d_energy = 0.0
-        
-        # Store current values in history
-        for key, value in zip(['x', 'y', 'z', 'total'], [mx, my, mz, mt]):
-            momentum_history[key].append(value)
-        
-        # Write momentum and energy changes
-        output_file.write(f"dMomentum = {d_mx:.6e} {d_my:.6e} {d_mz:.6e}\n")
-        output_file.write(f"dEnergy = {d_energy:.6e}\n")
-        # Write particle states
-        for particle in self.particles:
-            output_file.write(f"{particle.label} {' '.join(map(str, particle.position))} "
-                            f"{' '.join(map(str, particle.velocity))}\n")
-    
-    def _plot_results(self, times: np.ndarray, momentum_history: Dict) -> None:
-        """Plot simulation results"""
+            steps_taken, current_time, terminated = self.backend.advance(
+                self.state, self.force_cache, self.config.dt, coeffs, steps,
+                current_time, max_steps, self.next_output_time, self.config.proximity_threshold)
+        
+        # The cached evaluation at the new positions serves the diagnostics and the
+        # first stage of the next step
+        forces, potential, _ = self.force_cache.evaluate(self.state)
+        if instrumentation is not None:
+            instrumentation.pop()
+        
+        if self.event_detector is not None:
+            if instrumentation is not None:
+                instrumentation.push("events")
+            masses = self.state.masses[:, np.newaxis]
+            if self.event_detector.check(start_time, start_positions, start_velocities, start_forces / masses,
+                                         current_time, self.state.positions, self.state.velocities, forces / masses):
+                terminated = True
+            if instrumentation is not None:
+                instrumentation.pop()
+        write_output = not terminated and current_time >= self.next_output_time
+        
+        # Output frames and the final state are always sampled, other steps at the diagnostics cadence
+        if terminated:
+            self._sample_diagnostics(current_time, potential)
+        elif write_output:
+            self._record_state(current_time, potential, writer)
+            if self.stepper is not None:
+                # Adaptive runs land on the grid, so index it instead of accumulating rounding
+                self.next_output_time = (round(current_time / self.config.output_interval) + 1) * self.config.output_interval
+            else:
+                self.next_output_time = current_time + self.config.output_interval
+        elif self.diagnostics.should_sample(step + steps_taken - 1):
+            self._sample_diagnostics(current_time, potential)
+        
+        return current_time, steps_taken, terminated
+    
+    def _sample_diagnostics(self, current_time: float, potential: float) -> Tuple[float, float, np.ndarray]:
+        """Record the current energy and momentum, returning the energy and the changes since the last sample"""
+        if self.instrumentation is not None:
+            self.instrumentation.push("diagnostics")
+        energy = self.state.kinetic_energy() + potential
+        momentum = self.state.momentum()
+        d_energy, d_momentum = self.diagnostics.record(current_time, energy, momentum)
+        if self.instrumentation is not None:
+            self.instrumentation.pop()
+        return energy, d_energy, d_momentum
+    
+    def _record_state(self, current_time: float, potential: float, writer) -> None:
+        """Record the current state of the system"""
+        current_energy, d_energy, d_momentum = self._sample_diagnostics(current_time, potential)
+        self.frames_written += 1
+        
+        # Write the frame with its momentum and energy changes
+        if self.instrumentation is not None:
+            self.instrumentation.push("output")
+        writer.write_frame(current_time, self.state.positions, self.state.velocities, current_energy,
+                           self.diagnostics.last_momentum, d_energy, tuple(d_momentum))
+        if self.instrumentation is not None:
+            self.instrumentation.pop()
+    
+    def _plot_results(self) -> None:
+        """Plot the momentum history of a run made with keep_history"""
+        history = self.diagnostics.history_arrays()
         plt.figure()
-        for component in ['x', 'y', 'total']:
-            plt.plot(times, momentum_history[component], 
+        for component, values in zip(['x', 'y'], history["momentum"].T):
+            plt.plot(history["times"], values, 
                     label=f'Momentum in {component} direction')
+        plt.plot(history["times"], np.sum(history["momentum"], axis=1), label='Momentum in total direction')
         plt.legend()
         plt.xlabel('Time')
         plt.ylabel('Momentum')
         plt.title('Momentum vs Time')
         plt.show()
     
-    def _print_statistics(self, config_name: str, energy: np.ndarray, 
-                         momentum_history: Dict, output_file_path: str) -> None:
+    def _print_statistics(self, config_name: str, statistics: Dict, output_file_path: str) -> None:
         """Print statistics for a specific configuration"""
-        energy_list = energy[energy != 0]
-        if len(energy_list) > 0:  # Only calculate if we have data
-            energy_deviation = np.abs((np.max(energy_list) - np.min(energy_list)) / energy_list[0])
-            momentum_diff_x = np.abs(np.max(momentum_history['x']) - np.min(momentum_history['x']))
-            momentum_diff_y = np.abs(np.max(momentum_history['y']) - np.min(momentum_history['y']))
-            
+        if "energy_deviation" in statistics:
             print(f"\nStatistics for {config_name}:")
-            print(f"Energy Deviation: {energy_deviation:.6e}")
-            print(f"Maximum Difference in Momentum (x-direction): {momentum_diff_x:.6e}")
-            print(f"Maximum Difference in Momentum (y-direction): {momentum_diff_y:.6e}")
+            print(f"Energy Deviation: {statistics['energy_deviation']:.6e}")
+            if "autotune" in statistics:
+                print(f"Auto-tuned dt: {statistics['dt']:.6g} (predicted energy deviation "
+                      f"{statistics['autotune']['predicted_error']:.6e}, tolerance "
+                      f"{'met' if statistics.get('tolerance_met') else 'NOT met'})")
+            print(f"Maximum Difference in Momentum (x-direction): {statistics['momentum_diff_x']:.6e}")
+            print(f"Maximum Difference in Momentum (y-direction): {statistics['momentum_diff_y']:.6e}")
+            if "events" in statistics:
+                print("Events: " + ", ".join(f"{name} {count}" for name, count in statistics["events"].items()))
             print(f"Data saved to {output_file_path}")
 
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Simulate the configurations in an initial conditions file",
+        epilog="Note: num_output_steps represents how many 0.05 time intervals to simulate")
+    parser.add_argument("num_output_steps", type=int)
+    parser.add_argument("dt", type=float)
+    parser.add_argument("input_file")
+    parser.add_argument("--methods", "--schemes", dest="methods", type=parse_method, nargs="+",
+                        default=[1, 2, 3, 4], metavar="METHOD",
+                        help="Symplectic integrator orders (1-4) or scheme names to run: " + ", ".join(SCHEMES))
+    parser.add_argument("--ensemble", action="store_true",
+                        help="Advance all configurations and methods together as one batch")
+    parser.add_argument("--output-format", choices=sorted(FORMATS), default="text",
+                        help="Trajectory file format")
+    parser.add_argument("--diagnostics-every", type=int, default=1,
+                        help="Integration steps between energy and momentum samples")
+    parser.add_argument("--keep-history", action="store_true",
+                        help="Save every diagnostics sample next to the trajectory")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="numpy",
+                        help="Compute backend; numba falls back to numpy if it is not installed")
+    parser.add_argument("--softening", type=float, default=0.0,
+                        help="Plummer softening length (default 0, exact Newtonian gravity)")
+    parser.add_argument("--force-solver", choices=FORCE_SOLVERS, default="direct",
+                        help="Direct summation, or a Barnes-Hut tree for large systems")
+    parser.add_argument("--theta", type=float, default=0.5,
+                        help="Barnes-Hut opening parameter (smaller is more accurate)")
+    parser.add_argument("--quadrupole", action="store_true",
+                        help="Add quadrupole terms to the Barnes-Hut multipoles")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Directory of the result cache of unchanged runs")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 2,
+                        help="Result cache size limit in MiB; least recently used results are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the result cache")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-run every simulation even if a cached result exists, and refresh the cache")
+    parser.add_argument("--checkpoint-every", type=int, default=0,
+                        help="Output frames between checkpoints (default 0, no checkpoints)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue each run from its checkpoint, extending finished runs to num_output_steps")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Adaptive time-transformed steps; dt is the initial step length")
+    parser.add_argument("--event", dest="events", action="append", type=parse_event_spec, default=[],
+                        metavar="SPEC",
+                        help="Detect an event: escape,radius=R | collision,distance=D | syzygy[,axis=z] | "
+                             "plane[,particle=P,axis=A,offset=X,direction=1]; add action=record|count|terminate. Repeatable")
+    parser.add_argument("--energy-tolerance", type=float,
+                        help="Choose dt per configuration and method to keep the relative energy deviation "
+                             "within this tolerance; dt is then the largest step allowed")
+    parser.add_argument("--export", choices=ENCODINGS,
+                        help="Also write a compressed, chunked copy of each trajectory with this encoding")
+    parser.add_argument("--export-max-error", type=float, default=DEFAULT_MAX_ERROR,
+                        help="Largest absolute coordinate error of the quantized export")
+    parser.add_argument("--export-chunk-frames", type=int, default=DEFAULT_CHUNK_FRAMES,
+                        help="Frames per chunk of the export")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time each phase of every run and print a report per run")
+    parser.add_argument("--profile-log",
+                        help="Append per-run profiles and periodic snapshots to this file as JSON lines")
+    parser.add_argument("--profile-interval", type=float, default=10.0,
+                        help="Seconds between the snapshots in the profile log")
+    parser.add_argument("--orbits", nargs="+",
+                        help="Simulate only these configurations of the input file, read through its catalog index")
+    parser.add_argument("--shard", type=parse_shard,
+                        help="Simulate only shard I/N of the input file (every N-th configuration from the I-th)")
+    parser.add_argument("--workers", type=int,
+                        help="Run the configuration x method sweep on a process pool with this many workers")
+    parser.add_argument("--summary", help="Write the sweep statistics to this JSON file")
+    return parser.parse_args(argv)
+
 def main():
-    if len(sys.argv) != 4:
-        print("Usage: python script.py <num_output_steps> <dt> <input_file>")
-        print("Note: num_output_steps represents how many 0.01 time intervals to simulate")
-        sys.exit(1)
+    args = parse_arguments()
     
-    if float(sys.argv[2]) > 0.05:
+    if args.dt > 0.05:
         print("Usage: Maximum dt 0.05")
         sys.exit(1)
+    if args.adaptive and args.ensemble:
+        print("Usage: --adaptive runs each configuration on its own time steps and cannot be used with --ensemble")
+        sys.exit(1)
+    if args.ensemble and args.force_solver != "direct":
+        print("Usage: --ensemble evaluates stacked configurations by direct summation and cannot be used with --force-solver tree")
+        sys.exit(1)
+    if args.ensemble and args.events:
+        print("Usage: --event checks each run between its own steps and cannot be used with --ensemble")
+        sys.exit(1)
+    if args.ensemble and (args.checkpoint_every or args.resume):
+        print("Usage: ensembles are not checkpointed; --checkpoint-every and --resume cannot be used with --ensemble")
+        sys.exit(1)
+    if args.ensemble and args.workers:
+        print("Usage: --ensemble advances all runs together in one process and cannot be used with --workers")
+        sys.exit(1)
+    if args.ensemble and (args.profile or args.profile_log):
+        print("Usage: ensembles are not instrumented; --profile and --profile-log cannot be used with --ensemble")
+        sys.exit(1)
+    if args.energy_tolerance is not None and (args.adaptive or args.ensemble):
+        print("Usage: --energy-tolerance chooses a fixed dt per run and cannot be used with --adaptive or --ensemble")
+        sys.exit(1)
     
     start_time = time.time()
     
     config = SimulationConfig(
-        num_steps=int(sys.argv[1]),
-        dt=float(sys.argv[2]),
+        num_steps=args.num_output_steps,
+        dt=args.dt,
+        output_format=args.output_format,
+        diagnostics_every=args.diagnostics_every,
+        keep_history=args.keep_history,
+        backend=args.backend,
+        softening=args.softening,
+        force_solver=args.force_solver,
+        theta=args.theta,
+        quadrupole=args.quadrupole,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_max_bytes=int(args.cache_size * 1024 ** 2),
+        force=args.force,
+        checkpoint_every=args.checkpoint_every,
+        adaptive=args.adaptive,
+        events=args.events,
+        energy_tolerance=args.energy_tolerance,
+        export=args.export,
+        export_max_error=args.export_max_error,
+        export_chunk_frames=args.export_chunk_frames,
+        profile=args.profile,
+        profile_log=args.profile_log,
+        profile_interval=args.profile_interval,
     )
     
     # Parse initial conditions file
-    input_file = sys.argv[3]
+    input_file = args.input_file
     try:
-        initial_conditions = parse_initial_conditions(input_file)
+        if args.orbits or args.shard:
+            initial_conditions = list(Catalog(input_file).initial_conditions(args.orbits, args.shard))
+        else:
+            initial_conditions = parse_initial_conditions(input_file)
     except FileNotFoundError as e:
         print(f"Error: {e}")
         sys.exit(1)
+    except (KeyError, ValueError) as e:
+        print(f"Error: {e.args[0]}")
+        sys.exit(1)
     
-    simulation = NBodySimulation(config)
-
     # Print simulation information
     print(f"Found {len(initial_conditions)} configurations in {input_file}")
     print(f"Will simulate for {config.total_time} time units")
-    print(f"Using {config.num_integration_steps} integration steps with dt={config.dt}")
+    if config.energy_tolerance is not None:
+        print(f"Choosing dt up to {config.dt} per run for a relative energy deviation of {config.energy_tolerance:g}")
+    else:
+        print(f"Using {config.num_integration_steps} integration steps with dt={config.dt}")
     
-    for initial_condition in initial_conditions:
-        for method in [1, 2, 3, 4]:
-            simulation.run_simulation(initial_condition=initial_condition, method=method)
+    if args.ensemble:
+        from ensemble import EnsembleSimulation
+        if config.cache_dir is not None:
+            print("Ensemble runs are integrated together and do not use the result cache")
+        EnsembleSimulation(config).run_ensemble(initial_conditions, args.methods)
+    elif args.workers:
+        import sweep
+        jobs = sweep.make_jobs(initial_conditions, args.methods, [config.dt], args.num_output_steps,
+                               config.proximity_threshold, config.output_dir, resume=args.resume,
+                               output_format=config.output_format, diagnostics_every=config.diagnostics_every,
+                               keep_history=config.keep_history, backend=config.backend,
+                               softening=config.softening, force_solver=config.force_solver,
+                               theta=config.theta, quadrupole=config.quadrupole, cache_dir=config.cache_dir,
+                               cache_max_bytes=config.cache_max_bytes, force=config.force,
+                               checkpoint_every=config.checkpoint_every, adaptive=config.adaptive,
+                               events=config.events, energy_tolerance=config.energy_tolerance,
+                               export=config.export, export_max_error=config.export_max_error,
+                               export_chunk_frames=config.export_chunk_frames, profile=config.profile,
+                               profile_log=config.profile_log, profile_interval=config.profile_interval)
+        summary = sweep.SweepRunner(args.workers).run(jobs)
+        sweep.print_summary(summary)
+        if args.summary:
+            sweep.write_summary(summary, args.summary)
+    else:
+        simulation = NBodySimulation(config)
+        for initial_condition in initial_conditions:
+            for method in args.methods:
+                simulation.run_simulation(initial_condition=initial_condition, method=method, resume=args.resume)
     
     print(f"\nTotal run time: {time.time() - start_time:.2f} seconds")
 
@@ -0,0 +1,370 @@
+"""
+Search for periodic three-body orbits over the initial velocity plane.
+
+The orbits in the initial conditions file follow the layout of Suvakov and Dmitrasinovic:
+equal masses at (-1,0,0), (1,0,0) and (0,0,0), the outer two with velocity (vx, vy, 0) and the
+middle one with (-2vx, -2vy, 0), so that the total momentum vanishes. An orbit is periodic
+with period T when the phase-space state returns to its start,
+
+    d(T) = sqrt( sum_i |r_i(T) - r_i(0)|^2 + |v_i(T) - v_i(0)|^2 ) = 0.
+
+The search has two stages.
+
+Scan: every (vx, vy) of a grid is integrated up to t_max and scored by its minimum return
+distance over t_min <= t <= t_max. Candidates are advanced in batches as stacked (B,3,3)
+states, one vectorised force evaluation per stage for the whole batch, and the batches are
+spread over a process pool. Most of the plane never returns, so candidates are rejected as
+early as possible: unbound ones (E >= 0) are not integrated at all, and ones that escape
+(a pair further apart than escape_distance) or collide (a pair closer than
+collision_distance, where a fixed step is meaningless anyway) are dropped as soon as it
+happens. The batch is compacted whenever half of it has been dropped, so the cost follows the
+surviving candidates.
+
+Refine: the local minima of the score grid below a threshold are polished by
+Levenberg-Marquardt shooting on (vx, vy, T), with the residual X(T) - X(0). The Jacobian takes
+central differences in vx and vy, integrated as one batch of five systems, and the exact
+derivative dX/dT = (v, a) for the period. Converged orbits are de-duplicated and written in
+the parse_initial_conditions format.
+"""
+import argparse
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from typing import Dict, List, Optional, Tuple, Union
+
+from system_state import SystemState
+from force_cache import ForceCache
+from backends import NumpyBackend
+from schemes import SCHEMES, get_scheme, parse_method
+from catalog import scan_blocks
+
+# Candidate status in the scan
+SCANNED = 0
+UNBOUND = 1
+ESCAPED = 2
+COLLIDED = 3
+STATUS_NAMES = {SCANNED: "scanned", UNBOUND: "unbound", ESCAPED: "escaped", COLLIDED: "collided"}
+
+ESCAPE_DISTANCE = 5.0
+COLLISION_DISTANCE = 1e-3
+# A batch is compacted once the fraction of candidates still integrating drops below this
+COMPACT_FRACTION = 0.5
+
+def initial_arrays(vx: np.ndarray, vy: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Stacked [B,3,3] positions and velocities of the (vx, vy) layout"""
+    vx = np.atleast_1d(np.asarray(vx, dtype=float))
+    vy = np.atleast_1d(np.asarray(vy, dtype=float))
+    positions = np.zeros((len(vx), 3, 3))
+    positions[:, 0, 0] = -1.0
+    positions[:, 1, 0] = 1.0
+    velocities = np.zeros((len(vx), 3, 3))
+    velocities[:, 0, 0] = velocities[:, 1, 0] = vx
+    velocities[:, 0, 1] = velocities[:, 1, 1] = vy
+    velocities[:, 2, 0] = -2 * vx
+    velocities[:, 2, 1] = -2 * vy
+    return positions, velocities
+
+def initial_state(vx: np.ndarray, vy: np.ndarray) -> SystemState:
+    """Stacked SystemState of the (vx, vy) layout with unit masses"""
+    positions, velocities = initial_arrays(vx, vy)
+    return SystemState(["0", "1", "2"], np.ones((len(positions), 3)), positions, velocities)
+
+def return_distance(state: SystemState, positions0: np.ndarray, velocities0: np.ndarray) -> np.ndarray:
+    """Phase-space distance of each member of a stacked state from its start"""
+    return np.sqrt(np.sum((state.positions - positions0) ** 2, axis=(-2, -1))
+                   + np.sum((state.velocities - velocities0) ** 2, axis=(-2, -1)))
+
+def scan_batch(vx: np.ndarray, vy: np.ndarray, t_max: float, t_min: float = 1.0, dt: float = 0.005,
+               method: Union[int, str] = 2, escape_distance: float = ESCAPE_DISTANCE,
+               collision_distance: float = COLLISION_DISTANCE) -> Dict[str, np.ndarray]:
+    """
+    Score one batch of candidates by their minimum return distance.
+
+    Parameters
+    ----------
+    vx, vy: [B] arrays of initial velocity parameters
+    t_max: float
+        integration time
+    t_min: float
+        earliest return time considered, so that the start itself does not count
+    dt: float
+        fixed time step
+    method: method number or scheme name
+    escape_distance, collision_distance: float
+        pair separations at which a candidate is rejected
+
+    Returns
+    -------
+    dict of [B] arrays: distance (minimum return distance, inf if never scored), time (when
+    it was reached) and status (SCANNED, UNBOUND, ESCAPED or COLLIDED)
+    """
+    scheme = get_scheme(method)
+    backend = NumpyBackend()
+    state = initial_state(vx, vy)
+    count = len(state.masses)
+    distance = np.full(count, np.inf)
+    time = np.full(count, np.nan)
+    status = np.full(count, SCANNED, dtype=np.uint8)
+
+    cache = ForceCache(backend.evaluate)
+    _, potential, _ = cache.evaluate(state)
+    status[state.kinetic_energy() + potential >= 0] = UNBOUND
+
+    # Members still integrating, as indices into the batch
+    index = np.flatnonzero(status == SCANNED)
+    state = SystemState(state.labels, state.masses[index], state.positions[index], state.velocities[index])
+    positions0, velocities0 = state.positions.copy(), state.velocities.copy()
+    cache.invalidate()
+    running = np.ones(len(index), dtype=bool)
+    for step in range(1, int(t_max / dt + 1e-9) + 1):
+        if not len(index):
+            break
+        backend.symplectic_step(state, dt, scheme.coefficients, scheme.stages, cache)
+        t = step * dt
+        _, _, distances = cache.evaluate(state)
+        separation = distances.reshape(len(index), -1)
+        escaped = running & (np.max(separation, axis=1) > escape_distance)
+        # The diagonal of the distance matrices is zero; only the three pairs count
+        collided = running & ~escaped & (np.min(distances[:, [0, 0, 1], [1, 2, 2]], axis=1) < collision_distance)
+        status[index[escaped]] = ESCAPED
+        status[index[collided]] = COLLIDED
+        running &= ~(escaped | collided)
+
+        if t >= t_min:
+            d = return_distance(state, positions0, velocities0)
+            better = running & (d < distance[index])
+            distance[index[better]] = d[better]
+            time[index[better]] = t
+
+        if np.count_nonzero(running) < COMPACT_FRACTION * len(index):
+            keep = np.flatnonzero(running)
+            forces, potential, distances = cache.evaluate(state)
+            index = index[keep]
+            state = SystemState(state.labels, state.masses[keep], state.positions[keep], state.velocities[keep])
+            positions0, velocities0 = positions0[keep], velocities0[keep]
+            cache.invalidate()
+            cache.store(forces[keep], potential[keep], distances[keep])
+            running = running[keep]
+    # Rejected candidates keep no score
+    distance[status != SCANNED] = np.inf
+    time[status != SCANNED] = np.nan
+    return {"distance": distance, "time": time, "status": status}
+
+def _scan_chunk(arguments: Tuple) -> Dict[str, np.ndarray]:
+    """Process pool entry point: scan one chunk of candidates"""
+    vx, vy, options = arguments
+    return scan_batch(vx, vy, **options)
+
+def scan_grid(vx_values: np.ndarray, vy_values: np.ndarray, t_max: float, workers: Optional[int] = None,
+              batch_size: int = 4096, progress: bool = True, **options) -> Dict[str, np.ndarray]:
+    """
+    Scan the grid vx_values x vy_values in batches of batch_size candidates on a process pool
+    of workers processes (all cores by default, 1 to scan in this process). Further keyword
+    arguments are passed to scan_batch. Returns the scan_batch arrays reshaped to the grid,
+    with the grid axes vx and vy added.
+    """
+    vx, vy = np.meshgrid(vx_values, vy_values, indexing="ij")
+    vx, vy = vx.ravel(), vy.ravel()
+    options = dict(options, t_max=t_max)
+    chunks = [(vx[start:start + batch_size], vy[start:start + batch_size], options)
+              for start in range(0, len(vx), batch_size)]
+    workers = workers or os.cpu_count() or 1
+    with tqdm(total=len(vx), desc=f"Scanning {len(vx)} candidates", ncols=100, disable=not progress) as bar:
+        if workers == 1:
+            results = []
+            for chunk in chunks:
+                results.append(_scan_chunk(chunk))
+                bar.update(len(chunk[0]))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = []
+                # map keeps chunk order, so the results line up with the grid
+                for chunk, result in zip(chunks, executor.map(_scan_chunk, chunks)):
+                    results.append(result)
+                    bar.update(len(chunk[0]))
+    shape = (len(vx_values), len(vy_values))
+    scan = {name: np.concatenate([result[name] for result in results]).reshape(shape)
+            for name in ("distance", "time", "status")}
+    scan["vx"] = np.asarray(vx_values, dtype=float)
+    scan["vy"] = np.asarray(vy_values, dtype=float)
+    return scan
+
+def candidate_cells(scan: Dict[str, np.ndarray], threshold: float, count: int) -> List[Tuple[float, float, float, float]]:
+    """
+    The count best local minima of the scan distance (no lower among the 8 neighbours) below
+    threshold, as (vx, vy, return time, distance), best first.
+    """
+    distance = scan["distance"]
+    padded = np.pad(distance, 1, constant_values=np.inf)
+    minimum = distance < threshold
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di or dj:
+                neighbour = padded[1 + di:1 + di + distance.shape[0], 1 + dj:1 + dj + distance.shape[1]]
+                minimum &= distance <= neighbour
+    cells = np.argwhere(minimum)
+    cells = cells[np.argsort(distance[minimum])][:count]
+    return [(float(scan["vx"][i]), float(scan["vy"][j]), float(scan["time"][i, j]), float(distance[i, j]))
+            for i, j in cells]
+
+def shoot(vx: np.ndarray, vy: np.ndarray, period: float, dt: float, method: Union[int, str]) -> Tuple[SystemState, np.ndarray, np.ndarray]:
+    """
+    Integrate a batch of (vx, vy) candidates for exactly period time units: whole steps of dt
+    and one final shorter step. Returns the final state, the accelerations there and the
+    initial phase-space state [B,2,3,3].
+    """
+    scheme = get_scheme(method)
+    backend = NumpyBackend()
+    state = initial_state(vx, vy)
+    start = np.stack([state.positions.copy(), state.velocities.copy()], axis=1)
+    cache = ForceCache(backend.evaluate)
+    steps = int(period / dt)
+    for _ in range(steps):
+        backend.symplectic_step(state, dt, scheme.coefficients, scheme.stages, cache)
+    remainder = period - steps * dt
+    if remainder > 0:
+        backend.symplectic_step(state, remainder, scheme.coefficients, scheme.stages, cache)
+    forces, _, _ = cache.evaluate(state)
+    return state, forces / state.masses[..., np.newaxis], start
+
+def refine(vx: float, vy: float, period: float, dt: float = 2e-3, method: Union[int, str] = "yoshida6",
+           tolerance: float = 1e-9, max_iterations: int = 50, step: float = 1e-6) -> Dict:
+    """
+    Levenberg-Marquardt shooting for a periodic orbit from an estimate of (vx, vy, T).
+
+    The residual R = X(T) - X(0) over the positions and velocities of all bodies is driven to
+    zero; tolerance applies to |R|. Returns the final vx, vy, period and |R| with the number of
+    iterations and whether it converged.
+    """
+    parameters = np.array([vx, vy, period], dtype=float)
+    damping = 1e-3
+    offsets = np.array([[0, 0], [step, 0], [-step, 0], [0, step], [0, -step]])
+
+    def evaluate(p):
+        members = p[:2] + offsets
+        state, accelerations, start = shoot(members[:, 0], members[:, 1], p[2], dt, method)
+        residuals = (np.stack([state.positions, state.velocities], axis=1) - start).reshape(len(members), -1)
+        jacobian = np.stack([(residuals[1] - residuals[2]) / (2 * step),
+                             (residuals[3] - residuals[4]) / (2 * step),
+                             np.stack([state.velocities[0], accelerations[0]]).ravel()], axis=1)
+        return residuals[0], jacobian
+
+    residual, jacobian = evaluate(parameters)
+    norm = float(np.linalg.norm(residual))
+    iterations = 0
+    while norm > tolerance and iterations < max_iterations:
+        iterations += 1
+        normal = jacobian.T @ jacobian
+        gradient = jacobian.T @ residual
+        delta = np.linalg.solve(normal + damping * np.diag(np.diag(normal)), -gradient)
+        trial = parameters + delta
+        if trial[2] <= 0:
+            damping *= 10
+            continue
+        trial_residual, trial_jacobian = evaluate(trial)
+        trial_norm = float(np.linalg.norm(trial_residual))
+        if trial_norm < norm:
+            parameters, residual, jacobian, norm = trial, trial_residual, trial_jacobian, trial_norm
+            damping = max(damping / 10, 1e-12)
+        else:
+            damping *= 10
+            if damping > 1e12:
+                break
+    return {"vx": float(parameters[0]), "vy": float(parameters[1]), "period": float(parameters[2]),
+            "residual": norm, "iterations": iterations, "converged": norm <= tolerance}
+
+def unique_orbits(orbits: List[Dict], separation: float = 1e-6) -> List[Dict]:
+    """Converged orbits with distinct (vx, vy), keeping the shortest period of repeats"""
+    kept: List[Dict] = []
+    for orbit in sorted((o for o in orbits if o["converged"]), key=lambda o: o["period"]):
+        if all(abs(orbit["vx"] - other["vx"]) > separation or abs(orbit["vy"] - other["vy"]) > separation
+               for other in kept):
+            kept.append(orbit)
+    return kept
+
+def format_initial_condition(name: str, vx: float, vy: float) -> str:
+    """One configuration in the initial conditions file format"""
+    positions, velocities = initial_arrays(vx, vy)
+    lines = [name]
+    for i, (position, velocity) in enumerate(zip(positions[0], velocities[0])):
+        lines.append(f"{i} 1.0 " + " ".join(repr(float(value)) for value in (*position, *velocity)))
+    return "\n".join(lines) + "\n"
+
+def first_free_index(path: Optional[str], prefix: str) -> int:
+    """Number following the highest <prefix><number> configuration name already in the file, 1 if none"""
+    if not path or not os.path.exists(path):
+        return 1
+    numbers = [int(entry.name[len(prefix):]) for entry, _ in scan_blocks(path)
+               if entry.name.startswith(prefix) and entry.name[len(prefix):].isdigit()]
+    return max(numbers, default=0) + 1
+
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description="Search the (vx, vy) plane for periodic three-body orbits")
+    parser.add_argument("--vx", type=float, nargs=2, default=[0.0, 1.0], metavar=("MIN", "MAX"))
+    parser.add_argument("--vy", type=float, nargs=2, default=[0.0, 1.0], metavar=("MIN", "MAX"))
+    parser.add_argument("--grid", type=int, nargs=2, default=[200, 200], metavar=("NX", "NY"),
+                        help="Grid points in vx and vy")
+    parser.add_argument("--t-max", type=float, default=20.0, help="Longest period searched")
+    parser.add_argument("--t-min", type=float, default=1.0, help="Shortest period searched")
+    parser.add_argument("--dt", type=float, default=0.005, help="Time step of the scan")
+    parser.add_argument("--method", type=parse_method, default=2,
+                        help="Scheme of the scan: " + ", ".join(SCHEMES))
+    parser.add_argument("--escape-distance", type=float, default=ESCAPE_DISTANCE,
+                        help="Pair separation at which a candidate is rejected as escaping")
+    parser.add_argument("--collision-distance", type=float, default=COLLISION_DISTANCE,
+                        help="Pair separation at which a candidate is rejected as colliding")
+    parser.add_argument("--batch-size", type=int, default=4096, help="Candidates integrated together")
+    parser.add_argument("--workers", type=int, help="Scan processes (default: all cores)")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Largest return distance of a cell worth refining")
+    parser.add_argument("--refine", type=int, default=20, help="Number of candidate cells to refine")
+    parser.add_argument("--refine-dt", type=float, default=2e-3, help="Time step of the shooting")
+    parser.add_argument("--refine-method", type=parse_method, default="yoshida6",
+                        help="Scheme of the shooting")
+    parser.add_argument("--tolerance", type=float, default=1e-9, help="Return residual of a converged orbit")
+    parser.add_argument("--prefix", default="search", help="Name prefix of the new configurations")
+    parser.add_argument("--output", help="Append the orbits found to this initial conditions file")
+    parser.add_argument("--scan-output", help="Save the scan grid to this .npz file")
+    parser.add_argument("--summary", help="Write the refined orbits as JSON to this file")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_arguments()
+    vx_values = np.linspace(*args.vx, args.grid[0])
+    vy_values = np.linspace(*args.vy, args.grid[1])
+    scan = scan_grid(vx_values, vy_values, args.t_max, workers=args.workers, batch_size=args.batch_size,
+                     t_min=args.t_min, dt=args.dt, method=args.method, escape_distance=args.escape_distance,
+                     collision_distance=args.collision_distance)
+    print(", ".join(f"{int(np.count_nonzero(scan['status'] == flag))} {name}" for flag, name in STATUS_NAMES.items()))
+    if args.scan_output:
+        np.savez(args.scan_output, **scan)
+
+    cells = candidate_cells(scan, args.threshold, args.refine)
+    print(f"Refining {len(cells)} candidate cells")
+    orbits = []
+    for vx, vy, period, distance in tqdm(cells, desc="Refining", ncols=100):
+        orbit = refine(vx, vy, period, args.refine_dt, args.refine_method, args.tolerance)
+        orbit["scan_distance"] = distance
+        orbits.append(orbit)
+    found = unique_orbits(orbits)
+
+    print(f"\n{'name':<12}{'vx':>20}{'vy':>20}{'period':>14}{'residual':>12}")
+    entries = []
+    # Names continue after those already in the output file, so that lookups by name stay unique
+    for k, orbit in enumerate(found, first_free_index(args.output, args.prefix)):
+        orbit["name"] = f"{args.prefix}{k}"
+        print(f"{orbit['name']:<12}{orbit['vx']:>20.15f}{orbit['vy']:>20.15f}{orbit['period']:>14.8f}{orbit['residual']:>12.2e}")
+        entries.append(format_initial_condition(orbit["name"], orbit["vx"], orbit["vy"]))
+    if args.output and entries:
+        with open(args.output, "a") as output_file:
+            output_file.write("".join(entries))
+        print(f"Appended {len(entries)} configurations to {args.output}")
+    if args.summary:
+        with open(args.summary, "w") as summary_file:
+            json.dump(orbits, summary_file, indent=2)
+
+if __name__ == "__main__":
+    main()
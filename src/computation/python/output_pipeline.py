@@ -0,0 +1,154 @@
+"""
+Buffered, asynchronous trajectory output.
+
+BufferedTrajectoryWriter wraps any trajectory writer that implements write_frames. Frames are
+copied into preallocated structured buffers; a full buffer is handed to a background thread
+that writes it through the wrapped writer while integration continues. Buffers are recycled
+from a fixed pool, so memory is bounded and the simulation blocks (backpressure) only when
+the writer thread falls a whole pool behind. Closing the writer, including on an exception or
+early termination, flushes every frame recorded so far.
+
+TeeTrajectoryWriter writes the same frames to several writers, e.g. a trajectory file and its
+chunked export (see chunked_export.py), and can itself be wrapped in a BufferedTrajectoryWriter.
+"""
+import contextlib
+import queue
+import threading
+import numpy as np
+from typing import Tuple
+
+from trajectory import buffer_dtype
+
+class BufferedTrajectoryWriter:
+    """
+    Wraps a trajectory writer with chunked, background-thread output.
+
+    Parameters
+    ----------
+    sink: writer with write_frames(frames) and close(), e.g. from open_trajectory_writer
+    n_particles: int
+        number of particles per frame
+    chunk_frames: int
+        frames per buffer handed to the writer thread
+    max_pending_chunks: int
+        buffers that may be queued or in flight before write_frame blocks
+    """
+
+    def __init__(self, sink, n_particles: int, chunk_frames: int = 1024, max_pending_chunks: int = 4):
+        self.sink = sink
+        self.path = getattr(sink, "path", None)
+        self.chunk_frames = chunk_frames
+        self._free = queue.Queue()
+        for _ in range(max_pending_chunks + 1):
+            self._free.put(np.zeros(chunk_frames, dtype=buffer_dtype(n_particles)))
+        self._pending = queue.Queue()
+        self._buffer = self._free.get()
+        self._count = 0
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._drain, name="trajectory-writer", daemon=True)
+        self._thread.start()
+
+    def write_frame(self, time: float, positions: np.ndarray, velocities: np.ndarray, energy: float,
+                    momentum: np.ndarray, d_energy: float = 0.0, d_momentum: Tuple[float, float, float] = (0.0, 0.0, 0.0)) -> None:
+        """Copy one frame into the current buffer, submitting the buffer when it is full"""
+        if self._error is not None:
+            raise self._error
+        frame = self._buffer[self._count]
+        frame["time"] = time
+        frame["positions"] = positions
+        frame["velocities"] = velocities
+        frame["energy"] = energy
+        frame["momentum"] = momentum
+        frame["d_energy"] = d_energy
+        frame["d_momentum"] = d_momentum
+        self._count += 1
+        if self._count == self.chunk_frames:
+            self._submit()
+
+    def _submit(self) -> None:
+        """Hand the current buffer to the writer thread and take a free one, blocking if none is free"""
+        if self._count == 0:
+            return
+        self._pending.put((self._buffer, self._count))
+        self._buffer = self._free.get()
+        self._count = 0
+
+    def _drain(self) -> None:
+        """Writer thread: write submitted buffers in order until the stop sentinel arrives"""
+        while True:
+            item = self._pending.get()
+            try:
+                if item is None:
+                    return
+                buffer, count = item
+                if self._error is None:
+                    try:
+                        self.sink.write_frames(buffer[:count])
+                    except BaseException as e:
+                        self._error = e
+                self._free.put(buffer)
+            finally:
+                self._pending.task_done()
+
+    def flush(self) -> None:
+        """Submit the partial buffer and wait until everything submitted has been written"""
+        self._submit()
+        self._pending.join()
+        if hasattr(self.sink, "flush"):
+            self.sink.flush()
+        if self._error is not None:
+            raise self._error
+
+    def close(self) -> None:
+        """Flush all frames, stop the writer thread and close the wrapped writer"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._submit()
+            self._pending.put(None)
+            self._thread.join()
+        finally:
+            self.sink.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class TeeTrajectoryWriter:
+    """
+    Writes every frame to each of several trajectory writers; path is the path of the first.
+    Closing closes every writer, even if closing one of them fails.
+    """
+
+    def __init__(self, *writers):
+        self.writers = list(writers)
+        self.path = getattr(self.writers[0], "path", None)
+
+    def write_frame(self, *args, **kwargs) -> None:
+        for writer in self.writers:
+            writer.write_frame(*args, **kwargs)
+
+    def write_frames(self, frames: np.ndarray) -> None:
+        for writer in self.writers:
+            writer.write_frames(frames)
+
+    def flush(self) -> None:
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self) -> None:
+        with contextlib.ExitStack() as stack:
+            for writer in reversed(self.writers):
+                stack.callback(writer.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
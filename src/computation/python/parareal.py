@@ -0,0 +1,320 @@
+"""
+Parallel-in-time integration of a single orbit with Parareal (Lions, Maday & Turinici 2001).
+
+The run is split into S time slices at output frame boundaries. A cheap coarse propagator G
+(a low-order scheme at a large step) and the accurate fine propagator F (the requested scheme
+and dt) map the state at the start of a slice to the state at its end. Starting from a serial
+coarse sweep U_n^0, each iteration runs the fine propagator on every unconverged slice at
+once on a process pool, then corrects the slice boundaries serially,
+
+    U_{n+1}^{k+1} = G(U_n^{k+1}) + F(U_n^k) - G(U_n^k),
+
+until the largest change of a boundary state between iterations is below tolerance. After
+k iterations the first k boundaries are exact, so at most S iterations reproduce the serial
+fine run, and slices before the first unconverged boundary are not recomputed. With K
+iterations the wall time is roughly K/S of the serial run plus the coarse sweeps, so the
+speed-up grows with the number of cores as long as the coarse propagator is good enough for
+K to stay small; chaotic orbits need more iterations than regular ones.
+
+Slices are made of the frame intervals of the serial run (see trajectory.output_frames: the
+initial state, the first step, then about every output interval), each integrated with the
+same number of fine steps as in the serial run, so the fine slices record the frames of the
+serial run and the trajectory written at the end, from the last fine sweep, matches it to the
+tolerance. The coarse propagator spans the same intervals with steps of about coarse_dt. Energies and momenta are sampled at the output frames rather than every step. The
+proximity check is not applied.
+"""
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from system_state import SystemState
+from force_cache import ForceCache
+from backends import get_backend, BACKENDS
+from schemes import SCHEMES, get_scheme, parse_method
+from diagnostics import Diagnostics
+from trajectory import open_trajectory_writer, output_frames, TrajectoryReader, FORMATS
+from integration_loop_refactored import SimulationConfig, InitialCondition, NBodySimulation, parse_initial_conditions
+
+def frame_schedule(config: SimulationConfig) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Times of the frames a serial fixed-step run of config writes, and the number of
+    integration steps between consecutive frames
+    """
+    steps, times = [], []
+    for step, frame_time in output_frames(config.dt, config.output_interval):
+        if step > config.num_integration_steps:
+            break
+        steps.append(step)
+        times.append(frame_time)
+    return np.array(times), np.diff(steps)
+
+def propagate(positions: np.ndarray, velocities: np.ndarray, masses: np.ndarray, frame_steps: Sequence[int], dt: float,
+              method: Union[int, str], backend_options: Dict,
+              record: bool = False) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """
+    Integrate one slice of len(frame_steps) frames, frame i taking frame_steps[i] fixed steps of
+    dt, returning the final positions and velocities and, with record, the [frames,2,N,3]
+    positions and velocities at the end of every frame. The step loop is the backend's
+    advance, as in a serial run.
+    """
+    state = SystemState([str(i) for i in range(len(masses))], masses, positions.copy(), velocities.copy())
+    backend = get_backend(**backend_options)
+    cache = ForceCache(backend.evaluate)
+    scheme = get_scheme(method)
+    recorded = np.empty((len(frame_steps), 2) + positions.shape) if record else None
+    for frame, steps in enumerate(frame_steps):
+        backend.advance(state, cache, dt, scheme.coefficients, scheme.stages, 0.0, int(steps), np.inf, np.inf)
+        if record:
+            recorded[frame, 0] = state.positions
+            recorded[frame, 1] = state.velocities
+    return state.positions, state.velocities, recorded
+
+def _propagate(arguments: Tuple):
+    """Process pool entry point"""
+    return propagate(*arguments)
+
+class PararealIntegrator:
+    """
+    Parareal integration of single configurations.
+
+    Parameters
+    ----------
+    config: SimulationConfig
+        run length, fine dt, output settings and backend
+    method: method number or scheme name of the fine propagator
+    coarse_method: method number or scheme name of the coarse propagator
+    coarse_dt: float
+        approximate coarse step, by default the output interval divided by 10
+    slices: int
+        number of time slices, by default the number of workers
+    workers: int
+        fine propagators run concurrently, by default the number of cores
+    tolerance: float
+        largest change of a slice boundary state (positions and velocities) between
+        iterations at which the iteration stops
+    max_iterations: int
+        by default the number of slices, at which the result is the serial fine run
+    """
+
+    def __init__(self, config: SimulationConfig, method: Union[int, str] = 4, coarse_method: Union[int, str] = 2,
+                 coarse_dt: Optional[float] = None, slices: Optional[int] = None, workers: Optional[int] = None,
+                 tolerance: float = 1e-8, max_iterations: Optional[int] = None, verbose: bool = True):
+        self.config = config
+        self.method = method
+        self.coarse_method = coarse_method
+        self.coarse_dt = coarse_dt or config.output_interval / 10
+        self.workers = workers or os.cpu_count() or 1
+        self.slices = slices or self.workers
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations or self.slices
+        self.verbose = verbose
+        self.backend_options = {"name": config.backend, "softening": config.softening,
+                                "force_solver": config.force_solver, "theta": config.theta,
+                                "quadrupole": config.quadrupole}
+
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    def _coarse(self, start: Tuple[np.ndarray, np.ndarray], masses: np.ndarray,
+                frame_steps: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The coarse propagator over the fine steps of a slice, in equal steps of about coarse_dt"""
+        span = int(np.sum(frame_steps)) * self.config.dt
+        steps = max(1, int(round(span / self.coarse_dt)))
+        positions, velocities, _ = propagate(start[0], start[1], masses, [steps], span / steps, self.coarse_method,
+                                             self.backend_options)
+        return positions, velocities
+
+    def integrate(self, state: SystemState, executor=None) -> Tuple[np.ndarray, np.ndarray, Dict]:
+        """
+        Parareal integration of state over the configured run length. Returns the times and the
+        [F,2,N,3] positions and velocities of every output frame of the serial run, the initial
+        state included, and a record of the iteration.
+        """
+        times, frame_steps = frame_schedule(self.config)
+        total_frames = len(frame_steps)
+        boundaries = np.linspace(0, total_frames, min(self.slices, total_frames) + 1).round().astype(int)
+        spans = [frame_steps[boundaries[n]:boundaries[n + 1]] for n in range(len(boundaries) - 1)]
+        slices = len(spans)
+        masses = state.masses
+
+        # Serial coarse sweep for the initial boundary states
+        start = [(state.positions.copy(), state.velocities.copy())]
+        coarse = []
+        for n in range(slices):
+            coarse.append(self._coarse(start[n], masses, spans[n]))
+            start.append(coarse[n])
+
+        fine: List = [None] * slices
+        corrections = []
+        first_open = 0
+        iterations = 0
+        while first_open < slices and iterations < self.max_iterations:
+            iterations += 1
+            jobs = [(start[n][0], start[n][1], masses, spans[n], self.config.dt, self.method, self.backend_options, True)
+                    for n in range(first_open, slices)]
+            results = list(executor.map(_propagate, jobs)) if executor is not None else [_propagate(job) for job in jobs]
+            for n, result in zip(range(first_open, slices), results):
+                fine[n] = result
+
+            # Serial correction sweep; the boundary after the first open slice is now exact
+            correction = 0.0
+            new_start = start[:first_open + 1]
+            for n in range(first_open, slices):
+                if n == first_open:
+                    positions, velocities = fine[n][0], fine[n][1]
+                else:
+                    predicted = self._coarse(new_start[n], masses, spans[n])
+                    positions = predicted[0] + fine[n][0] - coarse[n][0]
+                    velocities = predicted[1] + fine[n][1] - coarse[n][1]
+                    coarse[n] = predicted
+                correction = max(correction, float(np.max(np.abs(positions - start[n + 1][0]))),
+                                 float(np.max(np.abs(velocities - start[n + 1][1]))))
+                new_start.append((positions, velocities))
+            start = new_start
+            corrections.append(correction)
+            self._log(f"Parareal iteration {iterations}: largest boundary correction {correction:.3e}")
+
+            first_open += 1
+            if correction < self.tolerance:
+                break
+
+        frames = np.concatenate([np.stack([state.positions, state.velocities])[np.newaxis]]
+                                + [fine[n][2] for n in range(slices)])
+        record = {"slices": slices, "iterations": iterations, "corrections": corrections,
+                  "converged": bool(corrections and corrections[-1] < self.tolerance) or first_open >= slices,
+                  "coarse_method": self.coarse_method, "coarse_dt": self.coarse_dt, "tolerance": self.tolerance}
+        return times, frames, record
+
+    def run(self, initial_condition: InitialCondition, executor=None) -> Dict:
+        """
+        Integrate one configuration and write its trajectory to the usual output path.
+        Returns statistics like NBodySimulation.run_simulation, with the parareal record.
+        """
+        state = SystemState.from_particles(initial_condition.particles)
+        state.remove_com_velocity()
+        self._log(f"\nParareal integration of {initial_condition.name} with method {self.method}")
+        wall_start = time.time()
+        times, frames, record = self.integrate(state, executor)
+        record["wall_time"] = time.time() - wall_start
+        # Kept for comparisons with a serial run
+        self.times, self.frames = times, frames
+
+        output_file_path = self.config.output_path(initial_condition.name, self.method)
+        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+        header = {
+            "labels": state.labels,
+            "masses": state.masses.tolist(),
+            "dt": self.config.dt,
+            "method": self.method,
+            "scheme": get_scheme(self.method).name,
+            "output_interval": self.config.output_interval,
+            "parareal": record,
+        }
+        backend = get_backend(**self.backend_options)
+        diagnostics = Diagnostics()
+        with open_trajectory_writer(output_file_path, self.config.output_format, header) as writer:
+            for current_time, (positions, velocities) in zip(times, frames):
+                _, potential, _ = backend.evaluate(positions, state.masses)
+                state.positions[...], state.velocities[...] = positions, velocities
+                energy = state.kinetic_energy() + potential
+                momentum = state.momentum()
+                d_energy, d_momentum = diagnostics.record(current_time, energy, momentum)
+                writer.write_frame(current_time, positions, velocities, energy, momentum, d_energy, tuple(d_momentum))
+
+        statistics = {
+            "name": initial_condition.name,
+            "method": self.method,
+            "dt": self.config.dt,
+            "status": "completed" if record["converged"] else "not converged",
+            "output_file": output_file_path,
+            "file_size": os.path.getsize(output_file_path),
+            "parareal": record,
+        }
+        statistics.update(diagnostics.summary())
+        if self.verbose:
+            print(f"Parareal {statistics['status']} after {record['iterations']} iterations over "
+                  f"{record['slices']} slices in {record['wall_time']:.2f} s")
+            print(f"Energy Deviation (output frames): {statistics['energy_deviation']:.6e}")
+            print(f"Data saved to {output_file_path}")
+        return statistics
+
+def serial_frames(initial_condition: InitialCondition, config: SimulationConfig,
+                  method: Union[int, str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The frame times and [F,2,N,3] positions and velocities of the same run made by
+    NBodySimulation, written to a temporary directory without the result cache
+    """
+    with tempfile.TemporaryDirectory() as output_dir:
+        serial_config = copy.copy(config)
+        serial_config.output_dir = output_dir
+        serial_config.output_format = "binary"
+        serial_config.cache_dir = None
+        statistics = NBodySimulation(serial_config, verbose=False).run_simulation(initial_condition, method)
+        reader = TrajectoryReader(statistics["output_file"])
+        times = np.array(reader.times())
+        frames = np.stack([np.array(reader.positions()), np.array(reader.velocities())], axis=1)
+    return times, frames
+
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Integrate long single orbits in parallel in time with Parareal",
+        epilog="Note: num_output_steps represents how many 0.05 time intervals to simulate")
+    parser.add_argument("num_output_steps", type=int)
+    parser.add_argument("dt", type=float, help="Step of the fine propagator")
+    parser.add_argument("input_file")
+    parser.add_argument("--config", help="Configuration to run (default: all)")
+    parser.add_argument("--method", "--scheme", dest="method", type=parse_method, default=4,
+                        help="Fine scheme: " + ", ".join(SCHEMES))
+    parser.add_argument("--coarse-method", type=parse_method, default=2, help="Coarse scheme")
+    parser.add_argument("--coarse-dt", type=float, help="Step of the coarse propagator (default 0.005)")
+    parser.add_argument("--slices", type=int, help="Number of time slices (default: the number of workers)")
+    parser.add_argument("--workers", type=int, help="Concurrent fine propagators (default: all cores)")
+    parser.add_argument("--tolerance", type=float, default=1e-8,
+                        help="Largest boundary correction at which the iteration stops")
+    parser.add_argument("--max-iterations", type=int, help="Iteration limit (default: the number of slices)")
+    parser.add_argument("--output-format", choices=sorted(FORMATS), default="text", help="Trajectory file format")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="numpy", help="Compute backend")
+    parser.add_argument("--softening", type=float, default=0.0,
+                        help="Plummer softening length (default 0, exact Newtonian gravity)")
+    parser.add_argument("--check", action="store_true",
+                        help="Also integrate serially and report the largest difference and the speed-up")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_arguments()
+    config = SimulationConfig(num_steps=args.num_output_steps, dt=args.dt, output_format=args.output_format,
+                              backend=args.backend, softening=args.softening)
+    initial_conditions = parse_initial_conditions(args.input_file)
+    if args.config is not None:
+        initial_conditions = [ic for ic in initial_conditions if ic.name == args.config]
+        if not initial_conditions:
+            print(f"Error: configuration {args.config!r} not found in {args.input_file}")
+            sys.exit(1)
+
+    integrator = PararealIntegrator(config, args.method, args.coarse_method, args.coarse_dt, args.slices,
+                                    args.workers, args.tolerance, args.max_iterations)
+    with ProcessPoolExecutor(max_workers=integrator.workers) as executor:
+        for initial_condition in initial_conditions:
+            statistics = integrator.run(initial_condition, executor)
+            if args.check:
+                serial_start = time.time()
+                times, reference = serial_frames(initial_condition, config, args.method)
+                serial_time = time.time() - serial_start
+                if len(reference) != len(integrator.frames):
+                    print(f"The serial run wrote {len(reference)} frames, parareal {len(integrator.frames)}; "
+                          f"the serial run ended early")
+                    continue
+                print(f"Largest difference from the serial run: {np.max(np.abs(integrator.frames - reference)):.3e} "
+                      f"(times {np.max(np.abs(integrator.times - times)):.1e}); "
+                      f"serial {serial_time:.2f} s, parareal {statistics['parareal']['wall_time']:.2f} s")
+
+if __name__ == "__main__":
+    main()
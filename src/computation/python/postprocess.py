@@ -0,0 +1,351 @@
+"""
+Derived orbit quantities computed from whole trajectories.
+
+Every frame of a trajectory is reduced to the geometric and conserved quantities used by the
+analysis views, computed with array operations over blocks of frames instead of per frame:
+
+    time               frame time
+    jacobi (2,3)       mass-weighted Jacobi vectors of a three-body system,
+                       rho1 = sqrt(mu1) (r3 - r2), rho2 = sqrt(mu2) (r1 - (m2 r2 + m3 r3) / (m2 + m3))
+    shape (3)          point on the shape sphere, the normalised Hopf map of the Jacobi vectors
+                       (|rho1|^2 - |rho2|^2, 2 rho1.rho2, 2 (rho1 x rho2)_z) / (|rho1|^2 + |rho2|^2)
+    hyperradius        sqrt of the moment of inertia
+    inertia            moment of inertia about the centre of mass, sum m |r - r_cm|^2
+    angular_momentum   total angular momentum sum m r x v
+    energy_error       relative energy error (E - E0) / |E0| with respect to the first frame
+
+For unit masses the Jacobi vectors and shape sphere points are those the frontend's
+ShapeSpherePlotter computes; the shape sphere is independent of a common mass scale. The
+Jacobi and shape fields are only present for three-body trajectories.
+
+The results are written next to each trajectory as <stem>.derived, a binary file with the
+header layout of binary trajectories (magic b"TBDERV01", JSON header listing the fields) and
+fixed-stride little-endian records, float64 times and float32 quantities. DerivedReader
+memory-maps it. Trajectories are read and processed in blocks of chunk_frames frames, so memory
+stays bounded for trajectories of any length, and whole output directories (every orbit and
+method) are processed on a process pool. Derived files newer than their trajectory are kept.
+"""
+import argparse
+import itertools
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from trajectory import TrajectoryReader, FORMATS, MAGIC as TRAJECTORY_MAGIC, encode_header, read_header, \
+    system_energy_momentum, output_frames
+
+MAGIC = b"TBDERV01"
+DERIVED_SUFFIX = ".derived"
+DEFAULT_CHUNK_FRAMES = 65536
+
+def derived_dtype(n_particles: int) -> np.dtype:
+    """Record layout of one derived frame"""
+    fields = [("time", "<f8")]
+    if n_particles == 3:
+        fields += [("jacobi", "<f4", (2, 3)), ("shape", "<f4", (3,))]
+    fields += [
+        ("hyperradius", "<f4"),
+        ("inertia", "<f4"),
+        ("angular_momentum", "<f4", (3,)),
+        ("energy_error", "<f4"),
+    ]
+    return np.dtype(fields)
+
+def derived_path(trajectory_path: str) -> str:
+    """Derived file belonging to a trajectory file"""
+    return os.path.splitext(trajectory_path)[0] + DERIVED_SUFFIX
+
+def jacobi_coordinates(masses: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Mass-weighted Jacobi vectors [..., 2, 3] of three-body positions [..., 3, 3]"""
+    m1, m2, m3 = masses
+    mu1 = m2 * m3 / (m2 + m3)
+    mu2 = m1 * (m2 + m3) / (m1 + m2 + m3)
+    x1, x2, x3 = positions[..., 0, :], positions[..., 1, :], positions[..., 2, :]
+    rho1 = np.sqrt(mu1) * (x3 - x2)
+    rho2 = np.sqrt(mu2) * (x1 - (m2 * x2 + m3 * x3) / (m2 + m3))
+    return np.stack([rho1, rho2], axis=-2)
+
+def shape_sphere(jacobi: np.ndarray) -> np.ndarray:
+    """
+    Shape sphere points [..., 3] of Jacobi vectors [..., 2, 3]; the point is undefined (NaN)
+    at a total collision.
+    """
+    rho1, rho2 = jacobi[..., 0, :], jacobi[..., 1, :]
+    norm1 = np.sum(rho1 * rho1, axis=-1)
+    norm2 = np.sum(rho2 * rho2, axis=-1)
+    u = np.stack([norm1 - norm2,
+                  2 * np.sum(rho1 * rho2, axis=-1),
+                  2 * (rho1[..., 0] * rho2[..., 1] - rho1[..., 1] * rho2[..., 0])], axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return u / np.linalg.norm(u, axis=-1, keepdims=True)
+
+def moment_of_inertia(masses: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Moment of inertia about the centre of mass of each frame of positions [..., N, 3]"""
+    centre = np.sum(masses[:, np.newaxis] * positions, axis=-2, keepdims=True) / np.sum(masses)
+    return np.sum(masses * np.sum((positions - centre) ** 2, axis=-1), axis=-1)
+
+def angular_momentum(masses: np.ndarray, positions: np.ndarray, velocities: np.ndarray) -> np.ndarray:
+    """Total angular momentum [..., 3] of each frame"""
+    return np.sum(masses[:, np.newaxis] * np.cross(positions, velocities), axis=-2)
+
+def derive_frames(masses: np.ndarray, times: np.ndarray, positions: np.ndarray, velocities: np.ndarray,
+                  initial_energy: Optional[float] = None) -> Tuple[np.ndarray, float]:
+    """
+    Derived records of a block of frames. The energy error is relative to initial_energy,
+    by default the energy of the first frame of the block. Returns the records and the
+    reference energy, to be passed on with the next block.
+    """
+    records = np.zeros(len(times), dtype=derived_dtype(len(masses)))
+    records["time"] = times
+    if len(masses) == 3:
+        jacobi = jacobi_coordinates(masses, positions)
+        records["jacobi"] = jacobi
+        records["shape"] = shape_sphere(jacobi)
+    inertia = moment_of_inertia(masses, positions)
+    records["inertia"] = inertia
+    records["hyperradius"] = np.sqrt(inertia)
+    records["angular_momentum"] = angular_momentum(masses, positions, velocities)
+    energy, _ = system_energy_momentum(masses, positions, velocities)
+    if initial_energy is None and len(energy):
+        initial_energy = float(energy[0])
+    if initial_energy is not None:
+        records["energy_error"] = (energy - initial_energy) / abs(initial_energy)
+    return records, initial_energy
+
+def _text_frames(path: str, chunk_frames: int, output_interval: float, dt: Optional[float]) -> Iterator[Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]]:
+    """Stream a text trajectory in blocks of (labels, times, positions, velocities)"""
+    labels: List[str] = []
+    frames: List[List[List[float]]] = []
+    frame: List[List[float]] = []
+    first_frame = True
+    start = 0
+    # Text trajectories store no times; they are reconstructed from dt (see output_frames)
+    frame_times = None if dt is None else output_frames(dt, output_interval)
+
+    def block():
+        values = np.array(frames, dtype=float).reshape(len(frames), len(labels), 6)
+        if frame_times is None:
+            times = (start + np.arange(len(frames))) * output_interval
+        else:
+            times = np.array([time for _, time in itertools.islice(frame_times, len(frames))])
+        return labels, times, values[..., :3], values[..., 3:]
+
+    with open(path, "r") as trajectory_file:
+        for line in trajectory_file:
+            if line.startswith("dMomentum"):
+                if frame:
+                    first_frame = False
+                    frames.append(frame)
+                    frame = []
+                    if len(frames) == chunk_frames:
+                        yield block()
+                        start += len(frames)
+                        frames = []
+            elif line.startswith("dEnergy") or not line.strip():
+                continue
+            else:
+                values = line.split()
+                if first_frame:
+                    labels.append(values[0])
+                frame.append([float(value) for value in values[1:7]])
+    # A partially written last frame is ignored
+    if frame and len(frame) == len(labels):
+        frames.append(frame)
+    if frames:
+        yield block()
+
+def read_frame_blocks(path: str, chunk_frames: int = DEFAULT_CHUNK_FRAMES,
+                      output_interval: float = 0.05, dt: Optional[float] = None
+                      ) -> Iterator[Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Stream a text or binary trajectory in blocks of at most chunk_frames frames, as tuples of
+    (labels, times, positions, velocities). The times of text frames are reconstructed from
+    the run's dt (see output_frames).
+    """
+    with open(path, "rb") as trajectory_file:
+        binary = trajectory_file.read(len(TRAJECTORY_MAGIC)) == TRAJECTORY_MAGIC
+    if not binary:
+        yield from _text_frames(path, chunk_frames, output_interval, dt)
+        return
+    reader = TrajectoryReader(path)
+    for start in range(0, reader.n_frames, chunk_frames):
+        stop = start + chunk_frames
+        yield (reader.labels, np.array(reader.times(start, stop)), np.array(reader.positions(start, stop)),
+               np.array(reader.velocities(start, stop)))
+
+def trajectory_masses(path: str) -> Optional[List[float]]:
+    """Masses stored in a binary trajectory header, None for a text trajectory"""
+    try:
+        header, _ = read_header(path)
+    except ValueError:
+        return None
+    return header["masses"]
+
+def postprocess_trajectory(path: str, masses: Optional[List[float]] = None, output_path: Optional[str] = None,
+                           chunk_frames: int = DEFAULT_CHUNK_FRAMES, dt: Optional[float] = None) -> Dict:
+    """
+    Write the derived file of one trajectory.
+
+    Parameters
+    ----------
+    path: str
+        text or binary trajectory
+    masses: list of float
+        particle masses; by default those of a binary trajectory's header, or 1 for every
+        particle of a text trajectory, which stores no masses
+    output_path: str
+        derived file (default: next to the trajectory, derived_path)
+    chunk_frames: int
+        frames read and processed at a time
+    dt: float
+        time step of a text trajectory's run, which stores no times; frames are placed on
+        the output grid without it
+
+    Returns
+    -------
+    dict with the trajectory and derived paths, the number of frames, the largest absolute
+    energy error, the smallest hyperradius and the largest angular momentum drift; no derived
+    file is written for a trajectory without frames
+    """
+    output_path = output_path or derived_path(path)
+    if masses is None:
+        masses = trajectory_masses(path)
+    header = None
+    initial_energy = None
+    initial_momentum = None
+    summary = {"trajectory": path, "derived_file": output_path, "frames": 0, "max_energy_error": 0.0,
+               "min_hyperradius": np.inf, "max_angular_momentum_drift": 0.0}
+    temporary = output_path + ".tmp"
+    with open(temporary, "wb") as derived_file:
+        for labels, times, positions, velocities in read_frame_blocks(path, chunk_frames, dt=dt):
+            if header is None:
+                mass_array = np.ones(len(labels)) if masses is None else np.asarray(masses, dtype=float)
+                header = {"labels": labels, "masses": mass_array.tolist(), "trajectory": os.path.basename(path),
+                          "fields": list(derived_dtype(len(labels)).names)}
+                derived_file.write(encode_header(header, MAGIC))
+            records, initial_energy = derive_frames(mass_array, times, positions, velocities, initial_energy)
+            derived_file.write(records.tobytes())
+            if initial_momentum is None:
+                initial_momentum = records["angular_momentum"][0].astype(float)
+            summary["frames"] += len(records)
+            summary["max_energy_error"] = max(summary["max_energy_error"], float(np.max(np.abs(records["energy_error"]))))
+            summary["min_hyperradius"] = min(summary["min_hyperradius"], float(np.min(records["hyperradius"])))
+            drift = np.max(np.linalg.norm(records["angular_momentum"] - initial_momentum, axis=-1))
+            summary["max_angular_momentum_drift"] = max(summary["max_angular_momentum_drift"], float(drift))
+    if header is None:
+        # Nothing to derive from a trajectory without frames
+        os.remove(temporary)
+        summary["derived_file"] = None
+        return summary
+    # Readers never see a partially written derived file
+    os.replace(temporary, output_path)
+    return summary
+
+class DerivedReader:
+    """
+    Memory-mapped reader for derived files.
+
+    Attributes
+    ----------
+    header: dictionary with labels, masses, the trajectory file name and the fields
+    n_frames: number of frames
+    records: structured view of every frame; fields as in derived_dtype
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header, offset = read_header(path, MAGIC)
+        self.dtype = derived_dtype(len(self.header["labels"]))
+        self.n_frames = (os.path.getsize(path) - offset) // self.dtype.itemsize
+        if self.n_frames > 0:
+            self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=offset, shape=(self.n_frames,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self) -> int:
+        return self.n_frames
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self.records[field]
+
+def find_trajectories(output_dir: str, methods: Optional[List[str]] = None) -> List[str]:
+    """
+    Trajectory files in the method directories of an output directory. Where a run has both
+    a text and a binary trajectory, only the binary one, which stores masses and times, is listed.
+    """
+    paths = []
+    for method in sorted(os.listdir(output_dir)):
+        directory = os.path.join(output_dir, method)
+        if not os.path.isdir(directory) or (methods is not None and method not in methods):
+            continue
+        runs = {}
+        for name in sorted(os.listdir(directory)):
+            stem, extension = os.path.splitext(name)
+            if extension in FORMATS.values() and (stem not in runs or extension == FORMATS["binary"]):
+                runs[stem] = name
+        paths += [os.path.join(directory, runs[stem]) for stem in sorted(runs)]
+    return paths
+
+def _up_to_date(path: str) -> bool:
+    derived = derived_path(path)
+    return os.path.exists(derived) and os.path.getmtime(derived) >= os.path.getmtime(path)
+
+def _postprocess_job(job: Tuple[str, Optional[List[float]], int, Optional[float]]) -> Dict:
+    path, masses, chunk_frames, dt = job
+    return postprocess_trajectory(path, masses, chunk_frames=chunk_frames, dt=dt)
+
+def postprocess_directory(output_dir: str, methods: Optional[List[str]] = None, workers: Optional[int] = None,
+                          masses: Optional[Dict[str, List[float]]] = None, chunk_frames: int = DEFAULT_CHUNK_FRAMES,
+                          force: bool = False, dt: Optional[float] = None) -> List[Dict]:
+    """
+    Post-process every trajectory of every method in an output directory on a process pool of
+    workers processes (all cores by default, 1 to run in this process). masses maps
+    configuration names to particle masses for text trajectories. Trajectories whose derived
+    file is up to date are skipped unless force is set; dt places the frames of text
+    trajectories in time. Returns the summaries of the processed files.
+    """
+    masses = masses or {}
+    jobs = [(path, masses.get(os.path.splitext(os.path.basename(path))[0]), chunk_frames, dt)
+            for path in find_trajectories(output_dir, methods) if force or not _up_to_date(path)]
+    if workers == 1 or len(jobs) <= 1:
+        return [_postprocess_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_postprocess_job, jobs))
+
+def main():
+    from integration_loop_refactored import DEFAULT_OUTPUT_DIR, parse_initial_conditions
+
+    parser = argparse.ArgumentParser(description="Compute shape sphere points and derived orbit quantities of trajectories")
+    parser.add_argument("paths", nargs="*", help="Trajectory files (default: every trajectory in the output directory)")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="Directory of the method subdirectories")
+    parser.add_argument("--methods", nargs="+", help="Method subdirectories to process (default: all)")
+    parser.add_argument("--initial-conditions", help="Initial conditions file giving the masses of text trajectories")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: all cores)")
+    parser.add_argument("--chunk-frames", type=int, default=DEFAULT_CHUNK_FRAMES, help="Frames processed at a time")
+    parser.add_argument("--force", action="store_true", help="Recompute derived files that are up to date")
+    parser.add_argument("--dt", type=float, help="Time step of the runs of text trajectories, which store no times")
+    args = parser.parse_args()
+
+    masses = {}
+    if args.initial_conditions:
+        masses = {initial_condition.name: [particle.mass for particle in initial_condition.particles]
+                  for initial_condition in parse_initial_conditions(args.initial_conditions)}
+    if args.paths:
+        summaries = [postprocess_trajectory(path, masses.get(os.path.splitext(os.path.basename(path))[0]),
+                                            chunk_frames=args.chunk_frames, dt=args.dt) for path in args.paths]
+    else:
+        summaries = postprocess_directory(args.output_dir, args.methods, args.workers, masses, args.chunk_frames, args.force,
+                                          args.dt)
+
+    for summary in summaries:
+        if summary["derived_file"] is None:
+            print(f"{summary['trajectory']}: no frames")
+            continue
+        print(f"{summary['trajectory']}: {summary['frames']} frames, max |energy error| {summary['max_energy_error']:.3e}, "
+              f"min hyperradius {summary['min_hyperradius']:.4f}, "
+              f"max angular momentum drift {summary['max_angular_momentum_drift']:.3e}")
+    print(f"Wrote {sum(summary['derived_file'] is not None for summary in summaries)} derived files")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Content-addressed cache of simulation results.
+
+A run is identified by a SHA-256 key over everything that determines its output: the labels,
+masses, positions and velocities of the initial condition, the method, the integration and
+output settings of the SimulationConfig, and a hash of the simulation source code. A cache hit
+copies the stored trajectory (and diagnostics history and event log) to the requested output path and returns
+the stored statistics instead of integrating again.
+
+Entries live in <cache_dir>/<key[:2]>/<key>/ with a meta.json holding the statistics and file
+names. The modification time of meta.json records the last use; when the cache grows beyond
+max_bytes the least recently used entries are evicted. Entries are written to a temporary
+directory and renamed into place, so concurrent sweep workers never see a partial entry.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from typing import Dict, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "three-body")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Modules whose source determines the numerical results and the output files
+CODE_MODULES = [
+    "particle3D.py", "system_state.py", "Forces_and_Separations.py", "barnes_hut.py", "backends.py",
+    "force_cache.py", "schemes.py", "adaptive.py", "autotune.py", "events.py", "diagnostics.py", "trajectory.py", "output_pipeline.py",
+    "integration_loop_refactored.py",
+]
+
+# SimulationConfig attributes that change the output of a run
+CONFIG_FIELDS = [
+    "dt", "num_integration_steps", "output_interval", "proximity_threshold", "output_format",
+    "diagnostics_every", "keep_history", "backend", "softening", "force_solver", "theta", "quadrupole",
+    "adaptive", "energy_tolerance",
+]
+
+_code_version = None
+
+def code_version() -> str:
+    """Hash of the simulation source files, computed once per process"""
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for module in CODE_MODULES:
+            digest.update(module.encode())
+            with open(os.path.join(directory, module), "rb") as f:
+                digest.update(f.read())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+def result_key(initial_condition, method: int, config) -> str:
+    """Cache key of running an initial condition with a method and config"""
+    particles = initial_condition.particles
+    digest = hashlib.sha256()
+    settings = {field: getattr(config, field, None) for field in CONFIG_FIELDS}
+    settings["method"] = method
+    settings["labels"] = [particle.label for particle in particles]
+    settings["events"] = [event.describe() for event in getattr(config, "events", [])]
+    settings["code_version"] = code_version()
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    for values in ([particle.mass for particle in particles],
+                   [particle.position for particle in particles],
+                   [particle.velocity for particle in particles]):
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of trajectory files and run statistics.
+
+    Parameters
+    ----------
+    cache_dir: str
+        directory holding the cache entries
+    max_bytes: int
+        total size of the stored files above which least recently used entries are evicted
+    """
+
+    META = "meta.json"
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def lookup(self, key: str) -> Optional[Dict]:
+        """Metadata of an entry, marking it as recently used, or None on a miss"""
+        meta_path = os.path.join(self._entry_dir(key), self.META)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def materialize(self, key: str, output_path: str) -> Optional[Dict]:
+        """
+        Copy a cached trajectory (and history and event log, if stored) to output_path and return its
+        statistics with the file paths updated, or None on a miss.
+        """
+        meta = self.lookup(key)
+        if meta is None:
+            return None
+        entry = self._entry_dir(key)
+        statistics = dict(meta["statistics"])
+        try:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            shutil.copyfile(os.path.join(entry, meta["files"]["trajectory"]), output_path)
+            statistics["output_file"] = output_path
+            statistics["file_size"] = os.path.getsize(output_path)
+            if "history" in meta["files"]:
+                history_path = os.path.splitext(output_path)[0] + ".diagnostics.npz"
+                shutil.copyfile(os.path.join(entry, meta["files"]["history"]), history_path)
+                statistics["history_file"] = history_path
+            if "events" in meta["files"]:
+                events_path = os.path.splitext(output_path)[0] + ".events"
+                shutil.copyfile(os.path.join(entry, meta["files"]["events"]), events_path)
+                statistics["events_file"] = events_path
+        except OSError:
+            # An entry evicted or damaged underneath us is just a miss
+            return None
+        statistics["cached"] = True
+        return statistics
+
+    def store(self, key: str, statistics: Dict, replace: bool = False) -> None:
+        """
+        Add the files of a finished run to the cache, then evict down to max_bytes. An existing
+        entry for the key is kept unless replace is set.
+        """
+        entry = self._entry_dir(key)
+        if os.path.exists(entry):
+            if not replace:
+                return
+            shutil.rmtree(entry, ignore_errors=True)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.cache_dir)
+        try:
+            files = {"trajectory": "trajectory" + os.path.splitext(statistics["output_file"])[1]}
+            shutil.copyfile(statistics["output_file"], os.path.join(staging, files["trajectory"]))
+            if statistics.get("history_file"):
+                files["history"] = "history.npz"
+                shutil.copyfile(statistics["history_file"], os.path.join(staging, files["history"]))
+            if statistics.get("events_file"):
+                files["events"] = "events.bin"
+                shutil.copyfile(statistics["events_file"], os.path.join(staging, files["events"]))
+            with open(os.path.join(staging, self.META), "w") as f:
+                json.dump({"key": key, "files": files, "statistics": statistics}, f, indent=2, default=float)
+            os.rename(staging, entry)
+        except OSError:
+            # Another process stored the same key first, or the disk is full: keep running uncached
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    def entries(self):
+        """(last used, size in bytes, path) of every complete entry"""
+        result = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                try:
+                    last_used = os.path.getmtime(os.path.join(entry, self.META))
+                    size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                except OSError:
+                    continue
+                result.append((last_used, size, entry))
+        return result
+
+    def size(self) -> int:
+        """Total size in bytes of the cached entries"""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        """Remove every entry"""
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,199 @@
+"""
+Registry of symplectic splitting schemes.
+
+A scheme is a list of stages; stage k kicks the velocities by c[k]*dt*F/m and then drifts the
+positions by d[k]*dt*v, the convention of Integrator.COEFFICIENTS. Forces are only evaluated
+for kicks that follow a drift, so a scheme ending on a zero drift reuses its last force
+evaluation as the first kick of the next step (first same as last, FSAL), and its cost is the
+number of force evaluations per step rather than the number of stages.
+
+Besides the original methods 1-4 the registry holds the Yoshida 6th and 8th order
+compositions of leapfrog, with the adjacent half kicks of consecutive leapfrogs merged into
+one, McLachlan's optimised second order scheme and the Blanes-Moan optimised fourth order
+Runge-Kutta-Nystrom scheme. Each entry records its order and an error constant C, so that the
+maximum relative energy deviation is roughly C*dt^order; the constants were measured with
+measure_error_constant on one period of the figure-eight orbit. Running this module re-measures
+the orders and constants.
+"""
+import math
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Union
+
+class SplittingScheme(object):
+    """
+    One splitting scheme.
+
+    Attributes
+    ----------
+    name: registry name
+    c, d: kick and drift coefficients per stage
+    order: order of accuracy
+    error_constant: C in energy deviation ~ C*dt^order, or None if not measured
+    method: the number of the original method this scheme corresponds to, if any
+    """
+
+    def __init__(self, name: str, c: Sequence[float], d: Sequence[float], order: int,
+                 error_constant: Optional[float] = None, method: Optional[int] = None, description: str = ""):
+        if len(c) != len(d):
+            raise ValueError(f"Scheme {name}: c and d must have the same number of stages")
+        self.name = name
+        self.c = [float(value) for value in c]
+        self.d = [float(value) for value in d]
+        self.order = order
+        self.error_constant = error_constant
+        self.method = method
+        self.description = description
+
+    @property
+    def coefficients(self) -> Dict[str, List[float]]:
+        """The {"c": ..., "d": ...} table used by the integrators"""
+        return {"c": self.c, "d": self.d}
+
+    @property
+    def stages(self) -> int:
+        return len(self.c)
+
+    @property
+    def force_evaluations(self) -> int:
+        """Force evaluations per step once running: kicks preceded (cyclically) by a non-zero drift"""
+        return sum(1 for k in range(self.stages) if self.c[k] != 0 and self.d[k - 1] != 0)
+
+    def step_for_error(self, tolerance: float) -> float:
+        """Largest dt expected to keep the relative energy deviation within tolerance"""
+        if not self.error_constant:
+            raise ValueError(f"Scheme {self.name} has no error constant")
+        return (tolerance / self.error_constant) ** (1 / self.order)
+
+    def cost(self, tolerance: float) -> float:
+        """Force evaluations per unit time at the dt that meets the tolerance"""
+        return self.force_evaluations / self.step_for_error(tolerance)
+
+def compose_leapfrog(name: str, weights: Sequence[float], order: int, **kwargs) -> SplittingScheme:
+    """
+    Composition of kick-drift-kick leapfrog steps of lengths weights[i]*dt, with the final
+    half kick of each leapfrog merged into the first half kick of the next.
+    """
+    c = [weights[0] / 2] + [(a + b) / 2 for a, b in zip(weights[:-1], weights[1:])] + [weights[-1] / 2]
+    d = list(weights) + [0.0]
+    return SplittingScheme(name, c, d, order, **kwargs)
+
+def symmetric_weights(outer: Sequence[float]) -> List[float]:
+    """Weights w_n ... w_1 w_0 w_1 ... w_n of a symmetric composition, with w_0 = 1 - 2*sum(w_i)"""
+    outer = list(outer)
+    centre = 1 - 2 * sum(outer)
+    return outer[::-1] + [centre] + outer
+
+SCHEMES: Dict[str, SplittingScheme] = {}
+METHODS: Dict[int, SplittingScheme] = {}
+
+def register(scheme: SplittingScheme) -> SplittingScheme:
+    """Add a scheme to the registry, and to METHODS if it corresponds to a numbered method"""
+    SCHEMES[scheme.name] = scheme
+    if scheme.method is not None:
+        METHODS[scheme.method] = scheme
+    return scheme
+
+def get_scheme(method: Union[int, str]) -> SplittingScheme:
+    """A scheme by method number (1-4) or by registry name"""
+    if isinstance(method, (int, np.integer)):
+        if method not in METHODS:
+            raise ValueError(f"Unknown method: {method}")
+        return METHODS[method]
+    if isinstance(method, str) and method.isdigit():
+        return get_scheme(int(method))
+    if method not in SCHEMES:
+        raise ValueError(f"Unknown scheme {method!r}; choose from {', '.join(SCHEMES)}")
+    return SCHEMES[method]
+
+def parse_method(value: str) -> Union[int, str]:
+    """Command line method: a method number or a scheme name"""
+    scheme = get_scheme(value)
+    return scheme.method if value.isdigit() else scheme.name
+
+# Forest-Ruth / Yoshida fourth order triple jump
+_CBRT2 = 2 ** (1 / 3)
+
+register(SplittingScheme("euler", [1], [1], order=1, error_constant=1.8e-1, method=1,
+                         description="Symplectic Euler"))
+register(SplittingScheme("leapfrog", [1/2, 1/2], [1, 0], order=2, error_constant=5.9e-1, method=2,
+                         description="Kick-drift-kick leapfrog"))
+register(SplittingScheme("ruth3", [7/24, 3/4, -1/24], [2/3, -2/3, 1], order=3, error_constant=2.1e-2, method=3,
+                         description="Ruth's third order scheme"))
+register(SplittingScheme("forest-ruth",
+                         [1/(2*(2-_CBRT2)), (1-_CBRT2)/(2*(2-_CBRT2)), (1-_CBRT2)/(2*(2-_CBRT2)), 1/(2*(2-_CBRT2))],
+                         [1/(2-_CBRT2), (-_CBRT2)/(2-_CBRT2), 1/(2-_CBRT2), 0],
+                         order=4, error_constant=7.0e-1, method=4,
+                         description="Forest-Ruth / Yoshida fourth order triple jump"))
+
+# McLachlan (1995), two force evaluations with the second order error constant minimised
+_LAMBDA = 0.1931833275037836
+register(SplittingScheme("mclachlan2", [_LAMBDA, 1 - 2 * _LAMBDA, _LAMBDA], [1/2, 1/2, 0], order=2,
+                         error_constant=9.5e-2, description="McLachlan optimised second order"))
+
+# Blanes & Moan (2002), optimised fourth order Runge-Kutta-Nystrom scheme in its kick-first
+# form: kick b1, drift a1, kick b2, ..., drift a1, kick b1. Its seven kicks cost six force
+# evaluations per step, the last kick reusing the evaluation at the end of the step (FSAL)
+_BM_A = [0.245298957184271, 0.604872665711080]
+_BM_B = [0.0829844064174052, 0.396309801498368, -0.0390563049223486]
+_BM_A.append(1/2 - sum(_BM_A))
+_BM_B.append(1 - 2 * sum(_BM_B))
+register(SplittingScheme("blanes-moan4", _BM_B + _BM_B[2::-1], _BM_A + _BM_A[::-1] + [0], order=4,
+                         error_constant=5.7e-4, description="Blanes-Moan optimised fourth order RKN"))
+
+# Yoshida (1990) sixth order, solution A, and eighth order, solution D
+register(compose_leapfrog("yoshida6", symmetric_weights(
+    [-1.17767998417887, 0.235573213359357, 0.784513610477560]), order=6,
+    error_constant=3.8e0, description="Yoshida sixth order composition of leapfrog"))
+register(compose_leapfrog("yoshida8", symmetric_weights(
+    [0.102799849391985, -1.96061023297549, 1.93813913762276, -0.158240635368243,
+     -1.44485223686048, 0.253693336566229, 0.914844246229740]), order=8,
+    error_constant=5.0e1, description="Yoshida eighth order composition of leapfrog"))
+
+# Figure-eight orbit of Chenciner and Montgomery, the reference problem for the error constants
+FIGURE_EIGHT_PERIOD = 6.32591398
+_FIGURE_EIGHT_POSITIONS = [[0.97000436, -0.24308753, 0], [-0.97000436, 0.24308753, 0], [0, 0, 0]]
+_FIGURE_EIGHT_VELOCITIES = [[0.466203685, 0.43236573, 0], [0.466203685, 0.43236573, 0], [-0.93240737, -0.86473146, 0]]
+
+def energy_deviation(scheme: SplittingScheme, dt: float, duration: float = FIGURE_EIGHT_PERIOD) -> float:
+    """Maximum relative energy deviation of the scheme over the figure-eight orbit"""
+    from backends import NumpyBackend
+    from force_cache import ForceCache
+    from system_state import SystemState
+
+    backend = NumpyBackend()
+    state = SystemState(["a", "b", "c"], np.ones(3), np.array(_FIGURE_EIGHT_POSITIONS, dtype=float),
+                        np.array(_FIGURE_EIGHT_VELOCITIES, dtype=float))
+    cache = ForceCache(backend.evaluate)
+    _, potential, _ = cache.evaluate(state)
+    initial = state.kinetic_energy() + potential
+    deviation = 0.0
+    for _ in range(int(round(duration / dt))):
+        backend.symplectic_step(state, dt, scheme.coefficients, scheme.stages, cache)
+        _, potential, _ = cache.evaluate(state)
+        deviation = max(deviation, abs((state.kinetic_energy() + potential - initial) / initial))
+    return deviation
+
+def measure_error_constant(scheme: SplittingScheme, target: float = 1e-10) -> Dict[str, float]:
+    """
+    Observed order and error constant of a scheme: halve dt from 0.2 until the energy
+    deviation drops below target, then fit C*dt^p to the last two step sizes.
+    """
+    dt = 0.2
+    previous = energy_deviation(scheme, dt)
+    while True:
+        current = energy_deviation(scheme, dt / 2)
+        if current < target or dt < 1e-4:
+            break
+        dt, previous = dt / 2, current
+    order = math.log2(previous / current)
+    return {"dt": dt / 2, "observed_order": order, "error_constant": current / (dt / 2) ** scheme.order}
+
+if __name__ == "__main__":
+    tolerance = 1e-10
+    print(f"{'scheme':14s} {'order':>5s} {'observed':>8s} {'evals':>5s} {'C':>9s} {'measured C':>10s} "
+          f"{'dt@1e-10':>9s} {'cost@1e-10':>10s}")
+    for scheme in SCHEMES.values():
+        measured = measure_error_constant(scheme)
+        print(f"{scheme.name:14s} {scheme.order:5d} {measured['observed_order']:8.2f} {scheme.force_evaluations:5d} "
+              f"{scheme.error_constant:9.2e} {measured['error_constant']:10.2e} "
+              f"{scheme.step_for_error(tolerance):9.2e} {scheme.cost(tolerance):10.0f}")
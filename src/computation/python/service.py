@@ -0,0 +1,552 @@
+"""
+Long-lived local simulation service.
+
+Starting a simulation process imports NumPy, Matplotlib and tqdm and re-reads the input file,
+which dominates the latency of short interactive runs. The service keeps a pool of warm worker
+processes with the simulation modules imported, and accepts runs over HTTP on a TCP port or a
+Unix socket:
+
+    POST   /simulations        submit a run; the body is a JSON object with
+                                 initial_conditions  text in the initial conditions file format,
+                                                     or particles: [{label, mass, position,
+                                                     velocity}, ...] with a name
+                                 name                configuration to run (default: the first)
+                                 dt, method          time step and method number or scheme name
+                                 duration            time units to simulate, or num_output_steps
+                                 stream              default true
+                               and optionally output_format, backend, softening, adaptive,
+                               diagnostics_every and energy_tolerance.
+                               With stream, the response is newline-delimited JSON, sent as the
+                               run progresses:
+                                 {"type": "queued", "id": ..., "position": ...}
+                                 {"type": "started", "id": ..., "worker": ...}
+                                 {"type": "frame", "time": ..., "positions": ..., "velocities": ...,
+                                  "energy": ..., "d_energy": ..., "d_momentum": ...}   (per frame)
+                                 {"type": "completed" | "cancelled" | "failed", "id": ..., ...}
+                               Closing the connection cancels the run. Without stream, the
+                               response is {"id": ..., "status": "queued"}.
+    GET    /simulations/<id>   status of a run, with its statistics once completed
+    DELETE /simulations/<id>   cancel a queued or running run
+    GET    /status             workers, queue and runs
+
+Runs are queued first in, first out, with at most max_queue waiting. Runs writing the same
+trajectory file (same configuration name and method) never run at the same time. A running
+run is cancelled at its next output frame. Trajectories are written to the configured output
+directory with the usual <output_dir>/<method>/<name> layout. A worker that dies fails its
+run and is replaced.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+import numpy as np
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+DEFAULT_PORT = 8765
+QUEUE_POLL = 0.5
+# Finished runs kept for status queries
+MAX_FINISHED = 1000
+OPTIONAL_SETTINGS = ("output_format", "backend", "softening", "adaptive", "diagnostics_every", "energy_tolerance")
+
+def _parse_setting(key: str, value):
+    """Check the JSON type and range of an optional run setting, raising ValueError"""
+    from trajectory import FORMATS
+    from backends import BACKENDS
+
+    number = isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+    if key == "output_format" or key == "backend":
+        choices = FORMATS if key == "output_format" else BACKENDS
+        if value not in choices:
+            raise ValueError(f"{key} must be one of {', '.join(sorted(choices))}")
+        return value
+    if key == "adaptive":
+        if not isinstance(value, bool):
+            raise ValueError("adaptive must be true or false")
+        return value
+    if key == "diagnostics_every":
+        if not number or value != int(value) or value < 1:
+            raise ValueError("diagnostics_every must be a positive integer")
+        return int(value)
+    if key == "softening":
+        if not number or value < 0:
+            raise ValueError("softening must be a non-negative number")
+        return float(value)
+    if key == "energy_tolerance":
+        if value is None:
+            return None
+        if not number or value <= 0:
+            raise ValueError("energy_tolerance must be a positive number")
+        return float(value)
+    raise ValueError(f"Unknown setting {key}")
+
+def _json_default(value):
+    """JSON form of the NumPy scalars found in run statistics"""
+    return value.item() if hasattr(value, "item") else str(value)
+
+class Cancelled(Exception):
+    """Raised inside a worker to stop a cancelled run"""
+
+class FrameStream:
+    """
+    Frame sink of a worker's simulation: sends every frame to the service and raises
+    Cancelled once the service has flagged the run as cancelled.
+    """
+
+    def __init__(self, job_id: int, events, cancel_flag):
+        self.job_id = job_id
+        self.events = events
+        self.cancel_flag = cancel_flag
+
+    def write_frame(self, time, positions, velocities, energy, momentum, d_energy=0.0, d_momentum=(0.0, 0.0, 0.0)) -> None:
+        if self.cancel_flag.value == self.job_id:
+            raise Cancelled()
+        self.events.put(("frame", self.job_id, {
+            "type": "frame", "time": float(time), "positions": positions.tolist(), "velocities": velocities.tolist(),
+            "energy": float(energy), "d_energy": float(d_energy), "d_momentum": [float(value) for value in d_momentum],
+        }))
+
+    def write_frames(self, frames) -> None:
+        for frame in frames:
+            self.write_frame(frame["time"], frame["positions"], frame["velocities"], frame["energy"],
+                             frame["momentum"], frame["d_energy"], frame["d_momentum"])
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+def _worker_main(index: int, tasks, events, cancel_flag, service_options: Dict) -> None:
+    """Worker process: import the simulation modules once, then run tasks until None arrives"""
+    from integration_loop_refactored import NBodySimulation, SimulationConfig, InitialCondition
+    from particle3D import Particle3D
+    from chunked_export import read_trajectory_frames
+
+    events.put(("ready", index, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id = task["id"]
+        stream = FrameStream(job_id, events, cancel_flag)
+        try:
+            initial_condition = InitialCondition(task["name"], [
+                Particle3D(label, mass, np.array(position), np.array(velocity))
+                for label, mass, position, velocity in task["particles"]])
+            config = SimulationConfig(
+                num_steps=task["num_output_steps"], dt=task["dt"], output_dir=service_options["output_dir"],
+                output_buffer_frames=0, cache_dir=service_options["cache_dir"], **task["settings"])
+            simulation = NBodySimulation(config, verbose=False, frame_sinks=[stream])
+            statistics = simulation.run_simulation(initial_condition, task["method"], progress=lambda steps: None)
+            if simulation.frames_written == 0 and os.path.exists(statistics["output_file"]):
+                # A result cache hit writes no frames; stream the cached trajectory instead. Text
+                # trajectories store no times, which are rebuilt from the run's (possibly tuned) dt
+                dt = None if statistics.get("adaptive") else statistics["dt"]
+                _, frames = read_trajectory_frames(statistics["output_file"], config.output_interval, dt)
+                stream.write_frames(frames)
+            events.put(("completed", job_id, statistics))
+        except Cancelled:
+            events.put(("cancelled", job_id, None))
+        except Exception as e:
+            events.put(("failed", job_id, f"{type(e).__name__}: {e}"))
+        finally:
+            events.put(("idle", index, None))
+
+class Job:
+    """A submitted run and the messages waiting to be sent to its stream"""
+
+    def __init__(self, job_id: int, task: Dict, output_key: str, stream: bool):
+        self.id = job_id
+        self.task = task
+        self.output_key = output_key
+        self.stream = stream
+        self.status = "queued"
+        self.worker: Optional[int] = None
+        self.frames = 0
+        self.statistics: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.submitted = time.time()
+        self.finished: Optional[float] = None
+        self.messages: "queue.Queue[Dict]" = queue.Queue()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "cancelled", "failed")
+
+    def describe(self) -> Dict:
+        description = {"id": self.id, "name": self.task["name"], "method": self.task["method"], "status": self.status,
+                       "worker": self.worker, "frames": self.frames, "submitted": self.submitted, "finished": self.finished}
+        if self.statistics is not None:
+            description["statistics"] = self.statistics
+        if self.error is not None:
+            description["error"] = self.error
+        return description
+
+class SimulationService:
+    """
+    Pool of warm simulation workers with a run queue.
+
+    Parameters
+    ----------
+    workers: int
+        worker processes
+    output_dir: str
+        directory of the trajectory files
+    cache_dir: str
+        result cache directory, None to always integrate
+    max_queue: int
+        runs that may wait for a worker; further submissions are refused
+    """
+
+    def __init__(self, workers: int = 2, output_dir: Optional[str] = None, cache_dir: Optional[str] = None,
+                 max_queue: int = 64):
+        from integration_loop_refactored import DEFAULT_OUTPUT_DIR
+
+        self.output_dir = output_dir or DEFAULT_OUTPUT_DIR
+        self.cache_dir = cache_dir
+        self.max_queue = max_queue
+        self.jobs: Dict[int, Job] = {}
+        self.pending: deque = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._context = multiprocessing.get_context()
+        self._events = self._context.Queue()
+        self._workers: List[Dict] = []
+        for index in range(workers):
+            self._workers.append(self._start_worker(index))
+        self._running = True
+        self._collector = threading.Thread(target=self._collect, name="service-collector", daemon=True)
+        self._collector.start()
+
+    def _start_worker(self, index: int) -> Dict:
+        tasks = self._context.Queue()
+        cancel_flag = self._context.Value("q", 0, lock=False)
+        options = {"output_dir": self.output_dir, "cache_dir": self.cache_dir}
+        process = self._context.Process(target=_worker_main, args=(index, tasks, self._events, cancel_flag, options),
+                                        name=f"simulation-worker-{index}", daemon=True)
+        process.start()
+        return {"process": process, "tasks": tasks, "cancel": cancel_flag, "job": None, "ready": False}
+
+    def submit(self, request: Dict, stream: bool = True) -> Job:
+        """Validate a run request and queue it; raises ValueError for invalid requests and OverflowError when full"""
+        task = self._parse_request(request)
+        with self._lock:
+            if len(self.pending) >= self.max_queue:
+                raise OverflowError("The run queue is full")
+            job = Job(next(self._ids), task, f"{task['method']}/{task['name']}", stream)
+            task["id"] = job.id
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            job.messages.put({"type": "queued", "id": job.id, "position": len(self.pending)})
+            self._dispatch()
+        return job
+
+    def _parse_request(self, request: Dict) -> Dict:
+        from integration_loop_refactored import parse_initial_condition_lines, SimulationConfig
+        from schemes import parse_method
+
+        if "particles" in request:
+            name = str(request.get("name", "run"))
+            particles = [[str(particle["label"]), float(particle["mass"]),
+                          [float(value) for value in particle["position"]],
+                          [float(value) for value in particle["velocity"]]] for particle in request["particles"]]
+            if not particles or any(len(position) != 3 or len(velocity) != 3 for _, _, position, velocity in particles):
+                raise ValueError("Particles need a label, a mass and 3-vector position and velocity")
+        elif "initial_conditions" in request:
+            initial_conditions = parse_initial_condition_lines(str(request["initial_conditions"]).splitlines())
+            if "name" in request:
+                initial_conditions = [ic for ic in initial_conditions if ic.name == str(request["name"])]
+            if not initial_conditions:
+                raise ValueError("No matching configuration in the initial conditions")
+            name = initial_conditions[0].name
+            particles = [[particle.label, particle.mass, particle.position.tolist(), particle.velocity.tolist()]
+                         for particle in initial_conditions[0].particles]
+        else:
+            raise ValueError("A run needs initial_conditions or particles")
+        if not name or os.sep in name or name in (".", ".."):
+            raise ValueError(f"Invalid configuration name: {name}")
+
+        dt = float(request.get("dt", 0.001))
+        if not 0 < dt <= 0.05:
+            raise ValueError("dt must be in (0, 0.05]")
+        method = parse_method(str(request.get("method", 4)))
+        if "num_output_steps" in request:
+            num_output_steps = int(request["num_output_steps"])
+        elif "duration" in request:
+            output_interval = SimulationConfig(1, dt).output_interval
+            num_output_steps = int(round(float(request["duration"]) / output_interval))
+        else:
+            raise ValueError("A run needs a duration or num_output_steps")
+        if num_output_steps <= 0:
+            raise ValueError("The duration must be positive")
+        settings = {key: _parse_setting(key, request[key]) for key in OPTIONAL_SETTINGS if key in request}
+        if settings.get("adaptive") and settings.get("energy_tolerance") is not None:
+            raise ValueError("energy_tolerance chooses a fixed dt and cannot be used with adaptive")
+        return {"name": name, "particles": particles, "dt": dt, "method": method, "num_output_steps": num_output_steps, "settings": settings}
+
+    def _dispatch(self) -> None:
+        """Hand queued runs to idle workers; the caller holds the lock"""
+        busy = {worker["job"].output_key for worker in self._workers if worker["job"] is not None}
+        for worker_index, worker in enumerate(self._workers):
+            if worker["job"] is not None or not worker["ready"]:
+                continue
+            job = next((job for job in self.pending if job.output_key not in busy), None)
+            if job is None:
+                return
+            self.pending.remove(job)
+            busy.add(job.output_key)
+            worker["job"] = job
+            job.status = "running"
+            job.worker = worker_index
+            job.messages.put({"type": "started", "id": job.id, "worker": worker_index})
+            worker["tasks"].put(job.task)
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a queued or running run; returns False if it has already finished"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            if job.done:
+                return False
+            if job.status == "queued":
+                self.pending.remove(job)
+                self._finish(job, "cancelled")
+            else:
+                self._workers[job.worker]["cancel"].value = job_id
+            return True
+
+    def _finish(self, job: Job, status: str, statistics: Optional[Dict] = None, error: Optional[str] = None) -> None:
+        job.status = status
+        job.statistics = statistics
+        job.error = error
+        job.finished = time.time()
+        message = {"type": status, "id": job.id, "frames": job.frames}
+        if statistics is not None:
+            message["statistics"] = statistics
+        if error is not None:
+            message["error"] = error
+        job.messages.put(message)
+        finished = [other for other in self.jobs.values() if other.done]
+        for other in finished[:max(0, len(finished) - MAX_FINISHED)]:
+            del self.jobs[other.id]
+
+    def _collect(self) -> None:
+        """Route worker messages to their runs and replace workers that died"""
+        # Liveness is checked every QUEUE_POLL seconds even while other workers stream frames
+        next_check = time.monotonic() + QUEUE_POLL
+        while self._running:
+            try:
+                message = self._events.get(timeout=max(0.0, next_check - time.monotonic()))
+            except queue.Empty:
+                message = None
+            if message is not None:
+                self._route(*message)
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + QUEUE_POLL
+
+    def _route(self, kind: str, key: int, payload) -> None:
+        """Apply one worker message"""
+        with self._lock:
+            if kind == "frame":
+                job = self.jobs.get(key)
+                if job is not None and not job.done:
+                    job.frames += 1
+                    if job.stream:
+                        job.messages.put(payload)
+            elif kind in ("completed", "cancelled", "failed"):
+                job = self.jobs.get(key)
+                if job is not None and not job.done:
+                    self._finish(job, kind, payload if kind == "completed" else None,
+                                 payload if kind == "failed" else None)
+            elif kind in ("ready", "idle"):
+                worker = self._workers[key]
+                worker["ready"] = True
+                worker["job"] = None
+                self._dispatch()
+
+    def _check_workers(self) -> None:
+        with self._lock:
+            for index, worker in enumerate(self._workers):
+                if self._running and not worker["process"].is_alive():
+                    job = worker["job"]
+                    if job is not None and not job.done:
+                        self._finish(job, "failed", error=f"Worker exited with code {worker['process'].exitcode}")
+                    self._workers[index] = self._start_worker(index)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": [{"index": index, "ready": worker["ready"], "alive": worker["process"].is_alive(),
+                             "job": worker["job"].id if worker["job"] is not None else None}
+                            for index, worker in enumerate(self._workers)],
+                "queued": [job.id for job in self.pending],
+                "jobs": [job.describe() for job in self.jobs.values()],
+                "output_dir": self.output_dir,
+            }
+
+    def close(self) -> None:
+        """Stop the workers, cancelling running runs"""
+        with self._lock:
+            self._running = False
+            for worker in self._workers:
+                if worker["job"] is not None:
+                    worker["cancel"].value = worker["job"].id
+                worker["tasks"].put(None)
+        for worker in self._workers:
+            worker["process"].join(timeout=5)
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP interface of a SimulationService, given as the server's service attribute"""
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self) -> SimulationService:
+        return self.server.service
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args) -> None:
+        if getattr(self.server, "verbose", False):
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, data: Dict) -> None:
+        body = json.dumps(data, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job_id(self) -> Optional[int]:
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) == 3 and parts[1] == "simulations" and parts[2].isdigit():
+            return int(parts[2])
+        return None
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/status":
+            self._send_json(200, self.service.status())
+            return
+        job_id = self._job_id()
+        job = self.service.jobs.get(job_id) if job_id is not None else None
+        if job is None:
+            self._send_json(404, {"error": "Not found"})
+            return
+        self._send_json(200, job.describe())
+
+    def do_DELETE(self) -> None:
+        job_id = self._job_id()
+        try:
+            cancelled = self.service.cancel(job_id) if job_id is not None else None
+        except KeyError:
+            cancelled = None
+        if cancelled is None:
+            self._send_json(404, {"error": "Not found"})
+        else:
+            self._send_json(200 if cancelled else 409, {"id": job_id, "cancelled": cancelled})
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/simulations":
+            self._send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            stream = bool(request.get("stream", True))
+            job = self.service.submit(request, stream)
+        except OverflowError as e:
+            self._send_json(503, {"error": str(e)})
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        if not stream:
+            self._send_json(202, {"id": job.id, "status": job.status})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while True:
+                message = job.messages.get()
+                # Send every frame already produced in one chunk
+                batch = [message]
+                while not job.messages.empty() and len(batch) < 1024:
+                    batch.append(job.messages.get_nowait())
+                data = "".join(json.dumps(item, default=_json_default) + "\n" for item in batch).encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                if batch[-1]["type"] in ("completed", "cancelled", "failed"):
+                    break
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away: nobody is waiting for the run any more
+            self.service.cancel(job.id)
+            self.close_connection = True
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """Threading HTTP server on a Unix domain socket"""
+    address_family = socket.AF_UNIX
+
+    def server_bind(self) -> None:
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+def serve(service: SimulationService, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+          unix_socket: Optional[str] = None, verbose: bool = False) -> ThreadingHTTPServer:
+    """Create the HTTP server of a service; call serve_forever on it"""
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, ServiceRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def main():
+    from integration_loop_refactored import DEFAULT_OUTPUT_DIR
+
+    parser = argparse.ArgumentParser(description="Serve simulations from a pool of warm worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="Directory of the trajectory files")
+    parser.add_argument("--cache-dir", help="Result cache directory (default: no caching)")
+    parser.add_argument("--max-queue", type=int, default=64, help="Runs that may wait for a worker")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    service = SimulationService(args.workers, args.output_dir, args.cache_dir, args.max_queue)
+    server = serve(service, args.host, args.port, args.socket, args.verbose)
+    print(f"Serving {args.workers} workers on {args.socket or f'http://{args.host}:{args.port}'}, "
+          f"writing to {args.output_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Parallel sweep runner. Each (initial condition, method, dt) combination is an independent job
+run in a worker process of its own, at most `workers` at a time. Workers report integration
+progress through a shared queue so a single progress bar covers the whole sweep, and every job
+returns the statistics dictionary of NBodySimulation.run_simulation. A job that fails or terminates early is recorded in the summary
+and does not stop the remaining jobs. Because no two jobs share a worker, a worker that dies
+outright (an out-of-memory kill, a crash in compiled code) fails only the job it was running;
+in a shared pool it would break the pool and fail every job still queued.
+"""
+import json
+import os
+import queue
+import traceback
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional, Tuple
+
+from tqdm import tqdm
+
+from integration_loop_refactored import SimulationConfig, InitialCondition, NBodySimulation
+
+class SweepJob:
+    """One simulation of a configuration with a given method and config"""
+    def __init__(self, initial_condition: InitialCondition, method: int, config: SimulationConfig,
+                 resume: bool = False):
+        self.initial_condition = initial_condition
+        self.method = method
+        self.config = config
+        # Continue from the run's checkpoint if there is one
+        self.resume = resume
+
+    @property
+    def description(self) -> Dict:
+        return {"name": self.initial_condition.name, "method": self.method, "dt": self.config.dt}
+
+def make_jobs(initial_conditions: List[InitialCondition], methods: List[int], dts: List[float],
+              num_steps: int, proximity_threshold: float = 100, output_dir: Optional[str] = None,
+              resume: bool = False, **config_options) -> List[SweepJob]:
+    """
+    Build the job list for every configuration, method and dt. When more than one dt is swept,
+    each dt writes to its own dt_<dt> subdirectory so the trajectories do not overwrite each other.
+    Further keyword arguments (backend, cache_dir, ...) are passed to every SimulationConfig.
+    """
+    jobs = []
+    for dt in dts:
+        config = SimulationConfig(num_steps=num_steps, dt=dt, proximity_threshold=proximity_threshold,
+                                  **config_options)
+        if output_dir is not None:
+            config.output_dir = output_dir
+        if len(dts) > 1:
+            config.output_dir = os.path.join(config.output_dir, f"dt_{dt:g}")
+        for initial_condition in initial_conditions:
+            for method in methods:
+                jobs.append(SweepJob(initial_condition, method, config, resume))
+    return jobs
+
+def run_job(job: SweepJob, progress_queue) -> Dict:
+    """Run one job in a worker process, reporting progress through the queue"""
+    os.makedirs(os.path.dirname(job.config.output_path(job.initial_condition.name, job.method)), exist_ok=True)
+    simulation = NBodySimulation(job.config, verbose=False)
+    return simulation.run_simulation(job.initial_condition, job.method, progress=progress_queue.put, resume=job.resume)
+
+class SweepRunner:
+    """Runs sweep jobs in worker processes with aggregated progress"""
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self, jobs: List[SweepJob]) -> List[Dict]:
+        """Run all jobs and return one summary entry per job, in job order"""
+        summary: List[Optional[Dict]] = [None] * len(jobs)
+        total_steps = sum(job.config.num_integration_steps for job in jobs)
+
+        with multiprocessing.Manager() as manager, \
+                tqdm(total=total_steps, desc=f"Sweep ({len(jobs)} jobs, {self.workers} workers)", ncols=100) as bar:
+            progress_queue = manager.Queue()
+            queued = list(range(len(jobs)))
+            # Future of each running job -> (job index, the single-worker executor running it)
+            running: Dict[Future, Tuple[int, ProcessPoolExecutor]] = {}
+            reported = [0] * len(jobs)
+            try:
+                while queued or running:
+                    while queued and len(running) < self.workers:
+                        index = queued.pop(0)
+                        executor = ProcessPoolExecutor(max_workers=1)
+                        running[executor.submit(run_job, jobs[index], progress_queue)] = (index, executor)
+                    done, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+                    self._drain(progress_queue, bar)
+                    for future in done:
+                        index, executor = running.pop(future)
+                        executor.shutdown()
+                        job = jobs[index]
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            result = dict(job.description, status="failed", error=f"{type(e).__name__}: {e}",
+                                          traceback="".join(traceback.format_exception(e)))
+                        summary[index] = result
+                        # Early-terminated and failed jobs still count as finished work
+                        reported[index] = job.config.num_integration_steps
+                        tqdm.write(f"{result['name']} (method {result['method']}, dt={result['dt']}): {result['status']}")
+            finally:
+                for _, executor in running.values():
+                    executor.shutdown()
+            self._drain(progress_queue, bar)
+            bar.n = sum(reported)
+            bar.refresh()
+
+        return summary
+
+    @staticmethod
+    def _drain(progress_queue, bar) -> None:
+        """Apply all queued progress increments to the bar"""
+        while True:
+            try:
+                bar.update(progress_queue.get_nowait())
+            except queue.Empty:
+                return
+
+def print_summary(summary: List[Dict]) -> None:
+    """Print one line of statistics per job"""
+    print(f"\n{'configuration':<16}{'method':>13}{'dt':>12}  {'status':<11}{'energy dev':>14}{'dp_x':>14}{'dp_y':>14}")
+    for entry in summary:
+        line = f"{entry['name']:<16}{entry['method']:>13}{entry['dt']:>12g}  {entry['status']:<11}"
+        if "energy_deviation" in entry:
+            line += f"{entry['energy_deviation']:>14.6e}{entry['momentum_diff_x']:>14.6e}{entry['momentum_diff_y']:>14.6e}"
+        elif "error" in entry:
+            line += f"  {entry['error']}"
+        print(line)
+
+def write_summary(summary: List[Dict], path: str) -> None:
+    """Write the sweep summary as JSON"""
+    with open(path, "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
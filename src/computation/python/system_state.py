@@ -0,0 +1,164 @@
+"""
+SystemState, a structure-of-arrays description of an N-body system. Positions and velocities
+are stored as contiguous [N,3] arrays and masses as an [N] array, so that kicks, drifts and
+energy/momentum sums are single vectorised NumPy operations instead of per-particle method calls.
+
+Particle3D remains the I/O and compatibility view: a SystemState is built from a list of
+Particle3D instances and can write its arrays back into them.
+"""
+import numpy as np
+from particle3D import Particle3D
+
+class SystemState(object):
+    """
+    Structure-of-arrays state of a system of point particles.
+
+    All array methods operate on the trailing (particle, component) axes, so the same
+    code also works for stacked states with extra leading axes.
+
+    Attributes
+    ----------
+    labels: list of particle names
+    masses: [N] float array of particle masses
+    positions: [N,3] float array of particle positions
+    velocities: [N,3] float array of particle velocities
+
+    Methods
+    -------
+    __init__
+    copy: returns an independent copy of the state
+    to_particles: builds a list of Particle3D instances
+    sync_particles: writes positions and velocities back into Particle3D instances
+    kinetic_energy: computes the total kinetic energy
+    momentum: computes the total linear momentum
+    com_velocity: computes the centre-of-mass velocity
+    remove_com_velocity: moves to the centre-of-mass frame
+    kick: updates velocities in place, v += c·dt·f/m
+    drift: updates positions in place, r += d·dt·v
+
+    Static Methods
+    --------------
+    from_particles: initialises a SystemState from a list of Particle3D instances
+    """
+
+    def __init__(self, labels, masses, positions, velocities):
+        """
+        Initialises a system state from arrays.
+
+        Parameters
+        ----------
+        labels: list of str
+            names of the particles
+        masses: [N] float array
+            particle masses
+        positions: [N,3] float array
+            position vectors
+        velocities: [N,3] float array
+            velocity vectors
+        """
+        self.labels = [str(label) for label in labels]
+        self.masses = np.ascontiguousarray(masses, dtype=float)
+        self.positions = np.ascontiguousarray(positions, dtype=float)
+        self.velocities = np.ascontiguousarray(velocities, dtype=float)
+
+    @property
+    def n_particles(self):
+        """Number of particles in the system"""
+        return self.masses.shape[-1]
+
+    @staticmethod
+    def from_particles(particles):
+        """
+        Creates a SystemState from a list of Particle3D instances. The arrays are copies,
+        so integrating the state does not modify the particles until sync_particles is called.
+
+        Parameters
+        ----------
+        particles: list
+            A list of Particle3D instances
+
+        Returns
+        -------
+        state: SystemState
+        """
+        labels = [p.label for p in particles]
+        masses = np.array([p.mass for p in particles], dtype=float)
+        positions = np.array([p.position for p in particles], dtype=float).reshape(-1, 3)
+        velocities = np.array([p.velocity for p in particles], dtype=float).reshape(-1, 3)
+        return SystemState(labels, masses, positions, velocities)
+
+    def copy(self):
+        """Returns an independent copy of the state"""
+        return SystemState(list(self.labels), self.masses.copy(), self.positions.copy(), self.velocities.copy())
+
+    def to_particles(self):
+        """
+        Returns a list of Particle3D instances holding copies of the current state.
+        """
+        return [Particle3D(label, mass, position.copy(), velocity.copy())
+                for label, mass, position, velocity in zip(self.labels, self.masses, self.positions, self.velocities)]
+
+    def sync_particles(self, particles):
+        """
+        Writes the current positions and velocities back into a list of Particle3D instances.
+
+        Parameters
+        ----------
+        particles: list
+            The Particle3D instances this state was built from
+        """
+        for particle, position, velocity in zip(particles, self.positions, self.velocities):
+            particle.position = position.copy()
+            particle.velocity = velocity.copy()
+
+    def kinetic_energy(self):
+        """
+        Returns the total kinetic energy, sum of 1/2 m v**2
+        """
+        return 0.5 * np.sum(self.masses * np.sum(self.velocities ** 2, axis=-1), axis=-1)
+
+    def momentum(self):
+        """
+        Returns the total linear momentum, sum of m*v, as a [3] array
+        """
+        return np.sum(self.masses[..., np.newaxis] * self.velocities, axis=-2)
+
+    def com_velocity(self):
+        """
+        Returns the centre-of-mass velocity
+        """
+        return self.momentum() / np.sum(self.masses, axis=-1)[..., np.newaxis]
+
+    def remove_com_velocity(self):
+        """
+        Subtracts the centre-of-mass velocity from every particle
+        """
+        self.velocities -= self.com_velocity()[..., np.newaxis, :]
+
+    def kick(self, forces, dt, c_coeff):
+        """
+        Update the velocities in place using the symplectic method coefficients.
+
+        Parameters
+        ----------
+        forces : [N,3] float array
+            Force on each particle
+        dt : float
+            Time step
+        c_coeff : float
+            Coefficient for the velocity update
+        """
+        self.velocities += c_coeff * dt * forces / self.masses[..., np.newaxis]
+
+    def drift(self, dt, d_coeff):
+        """
+        Update the positions in place using the symplectic method coefficients.
+
+        Parameters
+        ----------
+        dt : float
+            Time step
+        d_coeff : float
+            Coefficient for the position update
+        """
+        self.positions += d_coeff * dt * self.velocities
@@ -0,0 +1,28 @@
+"""
+NumPy/Numba parity: the compiled backend must reproduce the NumPy forces, potential and
+short integrations of every scheme to PARITY_TOLERANCE.
+"""
+import pytest
+
+from backends import NUMBA_AVAILABLE, PARITY_TOLERANCE, check_parity
+from schemes import SCHEMES
+
+pytestmark = pytest.mark.skipif(not NUMBA_AVAILABLE, reason="numba is not installed")
+
+@pytest.mark.parametrize("n_particles", [3, 8])
+@pytest.mark.parametrize("name", sorted(SCHEMES))
+def test_numba_matches_numpy(name, n_particles):
+    scheme = SCHEMES[name]
+    differences = check_parity(scheme.coefficients, scheme.stages, n_particles, tolerance=float("inf"))
+    assert differences["numba"] <= PARITY_TOLERANCE
+
+@pytest.mark.parametrize("seed", range(3))
+def test_numba_matches_numpy_on_random_configurations(seed):
+    scheme = SCHEMES[sorted(SCHEMES)[0]]
+    differences = check_parity(scheme.coefficients, scheme.stages, 5, n_steps=500, seed=seed, tolerance=float("inf"))
+    assert differences["numba"] <= PARITY_TOLERANCE
+
+def test_numba_matches_numpy_with_softening():
+    scheme = SCHEMES[sorted(SCHEMES)[0]]
+    differences = check_parity(scheme.coefficients, scheme.stages, 4, tolerance=float("inf"), softening=0.1)
+    assert differences["numba"] <= PARITY_TOLERANCE
@@ -0,0 +1,332 @@
+"""
+Restricted N-body integration: massless tracer particles advected in the field of the primaries.
+
+Tracers feel the massive particles but do not act on them or on each other, so M tracers cost
+one O(M*N) pass per force evaluation (Forces_and_Separations.compute_tracer_accelerations)
+instead of an O((N+M)^2) interaction matrix. They live in their own structure-of-arrays
+TracerState next to the SystemState of the primaries and are kicked and drifted with the same
+scheme coefficients in the same stages, so both are advanced by one symplectic step.
+
+Every tracer carries a status flag: it stops as "escaped" once it is further than
+escape_radius from the centre of mass of the primaries and as "collided" once it comes within
+collision_radius of a primary, recording the time of the event and, for collisions, which
+primary it hit. Stopped tracers stay where they were flagged. This is how stability regions
+around periodic orbits are mapped: seed a grid of tracers (grid_tracers), integrate, and plot
+the survival time event_time against the initial positions.
+
+Running this module integrates one configuration of an initial conditions file with a grid of
+tracers and saves the tracer arrays to an .npz file next to the trajectory files.
+"""
+import argparse
+import copy
+import os
+import numpy as np
+from tqdm import tqdm
+from typing import Dict, List, Optional, Tuple
+
+import Forces_and_Separations
+from system_state import SystemState
+from force_cache import ForceCache
+from backends import get_backend, BACKENDS
+from schemes import SCHEMES, get_scheme, parse_method
+from integration_loop_refactored import SimulationConfig, InitialCondition, Integrator, parse_initial_conditions
+
+# Tracer status flags
+ACTIVE = 0
+ESCAPED = 1
+COLLIDED = 2
+STATUS_NAMES = {ACTIVE: "active", ESCAPED: "escaped", COLLIDED: "collided"}
+
+TRACER_SUFFIX = ".tracers.npz"
+
+class TracerState(object):
+    """
+    Structure-of-arrays state of M massless tracers, with cached accelerations.
+
+    The cache follows the ForceCache contract: accelerations are computed at most once per
+    configuration of tracers and primaries and invalidated by every drift, which moves both.
+
+    Attributes
+    ----------
+    positions: [M,3] float array of tracer positions
+    velocities: [M,3] float array of tracer velocities
+    status: [M] uint8 array of ACTIVE, ESCAPED or COLLIDED flags
+    event_time: [M] float array, the time a tracer was flagged, NaN while active
+    partner: [M] int array, the primary a tracer collided with, -1 otherwise
+    softening: Plummer softening length of the primaries' field
+    evaluations: number of acceleration evaluations performed
+    """
+
+    def __init__(self, positions: np.ndarray, velocities: np.ndarray, softening: float = 0.0):
+        self.positions = np.ascontiguousarray(positions, dtype=float).reshape(-1, 3)
+        self.velocities = np.ascontiguousarray(velocities, dtype=float).reshape(-1, 3)
+        if self.positions.shape != self.velocities.shape:
+            raise ValueError("Tracer positions and velocities must have the same shape")
+        self.status = np.full(len(self.positions), ACTIVE, dtype=np.uint8)
+        self.event_time = np.full(len(self.positions), np.nan)
+        self.partner = np.full(len(self.positions), -1, dtype=np.int16)
+        self.softening = softening
+        # Drift multiplier, 0 for stopped tracers
+        self._moving = np.ones((len(self.positions), 1))
+        self.evaluations = 0
+        self.invalidate()
+
+    @property
+    def n_tracers(self) -> int:
+        return len(self.positions)
+
+    def invalidate(self) -> None:
+        """Mark the cached accelerations as stale"""
+        self.accelerations = None
+        self.nearest = None
+        self.nearest_index = None
+        self.valid = False
+
+    def evaluate(self, state: SystemState) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Accelerations of the tracers in the field of state, which must be at the same time as
+        the tracers, with the distance to and index of the nearest primary. Stopped tracers get
+        zero acceleration.
+        """
+        if not self.valid:
+            self.accelerations, self.nearest, self.nearest_index = Forces_and_Separations.compute_tracer_accelerations(
+                self.positions, state.positions, state.masses, self.softening)
+            self.accelerations[self.status != ACTIVE] = 0.0
+            self.evaluations += 1
+            self.valid = True
+        return self.accelerations, self.nearest, self.nearest_index
+
+    def kick(self, state: SystemState, dt: float, c_coeff: float) -> None:
+        """Update the tracer velocities in place, v += c·dt·a"""
+        accelerations, _, _ = self.evaluate(state)
+        self.velocities += (c_coeff * dt) * accelerations
+
+    def drift(self, dt: float, d_coeff: float) -> None:
+        """Update the positions of the active tracers in place, r += d·dt·v"""
+        self.positions += (d_coeff * dt) * self.velocities * self._moving
+        self.invalidate()
+
+    def symplectic_step(self, state: SystemState, dt: float, coeffs: Dict[str, List[float]], steps: int,
+                        cache: ForceCache) -> None:
+        """
+        One symplectic step of the primaries and the tracers together: each stage kicks both with
+        the forces at the current positions, then drifts both.
+        """
+        for k in range(steps):
+            if coeffs["c"][k] != 0:
+                forces, _, _ = cache.evaluate(state)
+                state.kick(forces, dt, coeffs["c"][k])
+                self.kick(state, dt, coeffs["c"][k])
+            if coeffs["d"][k] != 0:
+                state.drift(dt, coeffs["d"][k])
+                cache.invalidate()
+                self.drift(dt, coeffs["d"][k])
+
+    def check(self, state: SystemState, time: float, escape_radius: float, collision_radius: float) -> int:
+        """
+        Flag active tracers beyond escape_radius from the centre of mass of the primaries or
+        within collision_radius of one of them, returning the number newly flagged. A tracer
+        meeting both conditions counts as collided.
+        """
+        active = self.status == ACTIVE
+        _, nearest, nearest_index = self.evaluate(state)
+        com = np.sum(state.masses[:, np.newaxis] * state.positions, axis=0) / np.sum(state.masses)
+        offsets = self.positions - com
+        collided = active & (nearest < collision_radius)
+        escaped = active & ~collided & (np.einsum('ak,ak->a', offsets, offsets) > escape_radius ** 2)
+        flagged = collided | escaped
+        if not np.any(flagged):
+            return 0
+        self.status[collided] = COLLIDED
+        self.partner[collided] = nearest_index[collided]
+        self.status[escaped] = ESCAPED
+        self.event_time[flagged] = time
+        self._moving[flagged] = 0.0
+        self.accelerations[flagged] = 0.0
+        return int(np.count_nonzero(flagged))
+
+    def counts(self) -> Dict[str, int]:
+        """Number of tracers with each status"""
+        return {name: int(np.count_nonzero(self.status == flag)) for flag, name in STATUS_NAMES.items()}
+
+def primary_state(initial_condition: InitialCondition) -> SystemState:
+    """The primaries of a configuration in their centre of mass frame, as the simulations start them"""
+    state = SystemState.from_particles(copy.deepcopy(initial_condition.particles))
+    state.remove_com_velocity()
+    return state
+
+def grid_tracers(state: SystemState, n: int, extent: float, velocity: str = "circular",
+                 softening: float = 0.0) -> TracerState:
+    """
+    An n x n grid of tracers spanning [-extent, extent] in x and y about the centre of mass of
+    the primaries, in the z = 0 plane through it.
+
+    Parameters
+    ----------
+    state: SystemState
+        the primaries
+    n: int
+        tracers per side
+    extent: float
+        half width of the grid
+    velocity: str
+        "circular" for prograde circular orbits about the total mass at the centre of mass,
+        "zero" for tracers starting at rest
+    softening: float
+        Plummer softening length of the primaries' field
+    """
+    total_mass = np.sum(state.masses)
+    com = np.sum(state.masses[:, np.newaxis] * state.positions, axis=0) / total_mass
+    axis = np.linspace(-extent, extent, n)
+    x, y = np.meshgrid(axis, axis, indexing="ij")
+    offsets = np.stack([x.ravel(), y.ravel(), np.zeros(n * n)], axis=1)
+    velocities = np.tile(state.com_velocity(), (n * n, 1))
+    if velocity == "circular":
+        radius = np.sqrt(np.sum(offsets ** 2, axis=1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # v = sqrt(GM/r) along z x r-hat, i.e. (-y, x, 0) * sqrt(GM/r) / r
+            scale = np.where(radius > 0, np.sqrt(Forces_and_Separations.G * total_mass / radius) / radius, 0.0)
+        velocities += scale[:, np.newaxis] * np.stack([-offsets[:, 1], offsets[:, 0], np.zeros(n * n)], axis=1)
+    elif velocity != "zero":
+        raise ValueError(f"Unknown tracer velocity: {velocity}")
+    return TracerState(com + offsets, velocities, softening)
+
+class TracerSimulation:
+    """
+    Integrates the primaries of a configuration together with a TracerState.
+
+    Parameters
+    ----------
+    config: SimulationConfig
+        time step, run length, output interval, backend and softening; the run stops if the
+        primaries separate beyond config.proximity_threshold
+    escape_radius: float
+        distance from the centre of mass at which tracers count as escaped
+    collision_radius: float
+        distance to a primary at which tracers count as collided
+    """
+
+    def __init__(self, config: SimulationConfig, escape_radius: float = 20.0, collision_radius: float = 1e-3,
+                 verbose: bool = True):
+        self.config = config
+        self.escape_radius = escape_radius
+        self.collision_radius = collision_radius
+        self.verbose = verbose
+
+    def output_path(self, name: str, method) -> str:
+        """Tracer file of a configuration and method, next to its trajectory file"""
+        return os.path.splitext(self.config.output_path(name, method))[0] + TRACER_SUFFIX
+
+    def run(self, name: str, method, state: SystemState, tracers: TracerState,
+            output_path: Optional[str] = None) -> Dict:
+        """
+        Integrate the primaries in state and the tracers in place and save the tracer arrays and
+        the status counts at every output time to output_path (by default output_path(name,
+        method)). Returns the statistics of the run.
+        """
+        scheme = get_scheme(method)
+        backend = get_backend(self.config.backend, softening=self.config.softening,
+                              force_solver=self.config.force_solver, theta=self.config.theta,
+                              quadrupole=self.config.quadrupole)
+        cache = ForceCache(backend.evaluate)
+        initial_positions = tracers.positions.copy()
+        initial_velocities = tracers.velocities.copy()
+
+        tracers.check(state, 0.0, self.escape_radius, self.collision_radius)
+        times = [0.0]
+        counts = [list(tracers.counts().values())]
+        next_output_time = self.config.output_interval
+        status = "completed"
+        steps_completed = 0
+        current_time = 0.0
+        for step in tqdm(range(self.config.num_integration_steps), desc=f"Tracing {name} (method {method})",
+                         ncols=100, disable=not self.verbose):
+            Integrator.symplectic_step(state, self.config.dt, scheme.coefficients, scheme.stages, cache, backend,
+                                       tracers=tracers)
+            steps_completed += 1
+            current_time += self.config.dt
+            tracers.check(state, current_time, self.escape_radius, self.collision_radius)
+            _, _, distances = cache.evaluate(state)
+            if np.any(distances > self.config.proximity_threshold):
+                status = "terminated"
+                break
+            if current_time >= next_output_time:
+                times.append(current_time)
+                counts.append(list(tracers.counts().values()))
+                next_output_time = current_time + self.config.output_interval
+
+        output_path = output_path or self.output_path(name, method)
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        np.savez(output_path, initial_positions=initial_positions, initial_velocities=initial_velocities,
+                 positions=tracers.positions, velocities=tracers.velocities, status=tracers.status,
+                 event_time=tracers.event_time, partner=tracers.partner, times=np.array(times),
+                 counts=np.array(counts, dtype=np.int64), status_names=np.array(list(STATUS_NAMES.values())),
+                 labels=np.array(state.labels), masses=state.masses, primary_positions=state.positions,
+                 primary_velocities=state.velocities, dt=self.config.dt, escape_radius=self.escape_radius,
+                 collision_radius=self.collision_radius)
+
+        statistics = {
+            "name": name,
+            "method": method,
+            "dt": self.config.dt,
+            "status": status,
+            "steps_completed": steps_completed,
+            "n_tracers": tracers.n_tracers,
+            "tracers": tracers.counts(),
+            "output_file": output_path,
+            "force_evaluations": cache.evaluations,
+            "tracer_evaluations": tracers.evaluations,
+        }
+        if self.verbose:
+            print(f"\nTracers for {name} (method {method}), t = {current_time:.4f}: "
+                  + ", ".join(f"{count} {flag}" for flag, count in statistics["tracers"].items()))
+            print(f"Data saved to {output_path}")
+        return statistics
+
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Advect a grid of massless tracers in the field of one configuration",
+        epilog="Note: num_output_steps represents how many 0.05 time intervals to simulate")
+    parser.add_argument("num_output_steps", type=int)
+    parser.add_argument("dt", type=float)
+    parser.add_argument("input_file")
+    parser.add_argument("--config", help="Configuration to use (default: the first in the file)")
+    parser.add_argument("--method", "--scheme", dest="method", type=parse_method, default=4,
+                        help="Symplectic integrator order (1-4) or scheme name: " + ", ".join(SCHEMES))
+    parser.add_argument("--grid", type=int, default=100, help="Tracers per side of the square grid")
+    parser.add_argument("--extent", type=float, default=3.0, help="Half width of the tracer grid")
+    parser.add_argument("--velocity", choices=["circular", "zero"], default="circular",
+                        help="Initial tracer velocities")
+    parser.add_argument("--escape-radius", type=float, default=20.0,
+                        help="Distance from the centre of mass at which tracers escape")
+    parser.add_argument("--collision-radius", type=float, default=1e-3,
+                        help="Distance to a primary at which tracers collide")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="numpy",
+                        help="Compute backend of the primaries' forces")
+    parser.add_argument("--softening", type=float, default=0.0,
+                        help="Plummer softening length (default 0, exact Newtonian gravity)")
+    parser.add_argument("--output", help="Tracer file (default: next to the trajectory files)")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_arguments()
+    initial_conditions = parse_initial_conditions(args.input_file)
+    if args.config is None:
+        initial_condition = initial_conditions[0]
+    else:
+        matches = [ic for ic in initial_conditions if ic.name == args.config]
+        if not matches:
+            raise SystemExit(f"Configuration {args.config!r} not found in {args.input_file}")
+        initial_condition = matches[0]
+
+    config = SimulationConfig(num_steps=args.num_output_steps, dt=args.dt, backend=args.backend,
+                              softening=args.softening)
+    state = primary_state(initial_condition)
+    tracers = grid_tracers(state, args.grid, args.extent, args.velocity, args.softening)
+    print(f"Tracing {tracers.n_tracers} tracers around {initial_condition.name} for {config.total_time} time units")
+    TracerSimulation(config, args.escape_radius, args.collision_radius).run(
+        initial_condition.name, args.method, state, tracers, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+Trajectory output formats.
+
+Text layout (read by the frontend), one block per output frame:
+
+    dMomentum = <dpx> <dpy> <dpz>
+    dEnergy = <dE>
+    <label> <x> <y> <z> <vx> <vy> <vz>      (one line per particle)
+
+Binary layout:
+
+    8 bytes   magic b"TBTRAJ01"
+    4 bytes   little-endian uint32 length L of the JSON header
+    L bytes   UTF-8 JSON header (labels, masses, dt, method, output_interval, ...),
+              space-padded so that the frames start on an 8-byte boundary, with
+              HEADER_RESERVE spare bytes for annotations added after the run
+    frames    fixed-stride little-endian float64 records of
+              time, positions (N,3), velocities (N,3), energy, momentum (3)
+
+The number of frames is implied by the file size, so a binary trajectory can be appended to
+and read while it is still being written. TrajectoryReader memory-maps the frames and returns
+NumPy views without loading the file.
+"""
+import argparse
+import itertools
+import json
+import struct
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import Forces_and_Separations
+
+MAGIC = b"TBTRAJ01"
+FORMATS = {"text": ".txt", "binary": ".traj"}
+# Spare header bytes of trajectories, so that a finished run can annotate its header in place
+HEADER_RESERVE = 64
+
+def frame_dtype(n_particles: int) -> np.dtype:
+    """Record layout of one binary frame"""
+    return np.dtype([
+        ("time", "<f8"),
+        ("positions", "<f8", (n_particles, 3)),
+        ("velocities", "<f8", (n_particles, 3)),
+        ("energy", "<f8"),
+        ("momentum", "<f8", (3,)),
+    ])
+
+def buffer_dtype(n_particles: int) -> np.dtype:
+    """Binary frame layout extended with the per-frame changes written to text files"""
+    return np.dtype(frame_dtype(n_particles).descr + [
+        ("d_energy", "<f8"),
+        ("d_momentum", "<f8", (3,)),
+    ])
+
+def output_frames(dt: float, output_interval: float = 0.05) -> Iterator[Tuple[int, float]]:
+    """
+    (step, time) of every frame a fixed-step run writes, the initial state first. The run adds
+    dt to its time each step and writes a frame once the time reaches the next output time,
+    which is then set one output_interval later; the first step is always written. Times are
+    accumulated the same way, so every frame lands on exactly the step the run writes it at
+    (roughly 0, dt, dt + output_interval, ..., with an extra step wherever rounding leaves the
+    time just short of the output time).
+    """
+    yield 0, 0.0
+    step, time, next_output_time = 0, 0.0, 0.0
+    chunk = max(1024, 4 * int(output_interval / dt))
+    while True:
+        # Sequential sums, as current_time += dt
+        times = np.add.accumulate(np.concatenate(([time], np.full(chunk, dt))))[1:]
+        index = 0
+        while True:
+            index += int(np.searchsorted(times[index:], next_output_time))
+            if index == chunk:
+                break
+            next_output_time = times[index] + output_interval
+            yield step + index + 1, float(times[index])
+            index += 1
+        step += chunk
+        time = times[-1]
+
+def output_times(n_frames: int, dt: Optional[float] = None, output_interval: float = 0.05) -> np.ndarray:
+    """
+    Times of the first n_frames frames of a fixed-step run (see output_frames), which text
+    trajectories do not store. Without dt (adaptive runs, or dt unknown) the frames are placed
+    on the output grid.
+    """
+    if dt is None:
+        return np.arange(n_frames) * output_interval
+    return np.array([time for _, time in itertools.islice(output_frames(dt, output_interval), n_frames)])
+
+def write_frame(output_file, labels: List[str], positions: np.ndarray, velocities: np.ndarray,
+                d_momentum: Tuple[float, float, float], d_energy: float) -> None:
+    """Write one output frame in the text trajectory layout read by the frontend"""
+    d_mx, d_my, d_mz = d_momentum
+    # Write momentum and energy changes
+    output_file.write(f"dMomentum = {d_mx:.6e} {d_my:.6e} {d_mz:.6e}\n")
+    output_file.write(f"dEnergy = {d_energy:.6e}\n")
+    # Write particle states
+    for label, position, velocity in zip(labels, positions, velocities):
+        output_file.write(f"{label} {' '.join(map(str, position))} "
+                        f"{' '.join(map(str, velocity))}\n")
+
+class TextTrajectoryWriter:
+    """Writes frames in the text layout"""
+    def __init__(self, path: str, header: Dict, mode: str = "w"):
+        self.path = path
+        self.labels = list(header["labels"])
+        self.file = open(path, mode)
+
+    def write_frame(self, time: float, positions: np.ndarray, velocities: np.ndarray, energy: float,
+                    momentum: np.ndarray, d_energy: float, d_momentum: Tuple[float, float, float]) -> None:
+        write_frame(self.file, self.labels, positions, velocities, d_momentum, d_energy)
+
+    def write_frames(self, frames: np.ndarray) -> None:
+        """Write a block of frames with the buffer_dtype layout in one call"""
+        lines = []
+        for frame in frames:
+            d_mx, d_my, d_mz = frame["d_momentum"]
+            lines.append(f"dMomentum = {d_mx:.6e} {d_my:.6e} {d_mz:.6e}\n")
+            lines.append(f"dEnergy = {frame['d_energy']:.6e}\n")
+            for label, position, velocity in zip(self.labels, frame["positions"], frame["velocities"]):
+                lines.append(f"{label} {' '.join(map(str, position))} {' '.join(map(str, velocity))}\n")
+        self.file.write("".join(lines))
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BinaryTrajectoryWriter:
+    """Writes frames in the binary layout. In append mode the existing header is kept."""
+    def __init__(self, path: str, header: Dict, mode: str = "w"):
+        self.path = path
+        self.dtype = frame_dtype(len(header["labels"]))
+        self.file = open(path, "ab" if mode == "a" else "wb")
+        if self.file.tell() == 0:
+            self.file.write(encode_header(header, reserve=HEADER_RESERVE))
+        self._frame = np.zeros((), dtype=self.dtype)
+
+    def write_frame(self, time: float, positions: np.ndarray, velocities: np.ndarray, energy: float,
+                    momentum: np.ndarray, d_energy: float = 0.0, d_momentum: Tuple[float, float, float] = (0.0, 0.0, 0.0)) -> None:
+        frame = self._frame
+        frame["time"] = time
+        frame["positions"] = positions
+        frame["velocities"] = velocities
+        frame["energy"] = energy
+        frame["momentum"] = momentum
+        self.file.write(frame.tobytes())
+
+    def write_frames(self, frames: np.ndarray) -> None:
+        """Write a block of frames with the buffer_dtype layout in one call"""
+        block = np.zeros(len(frames), dtype=self.dtype)
+        for name in self.dtype.names:
+            block[name] = frames[name]
+        self.file.write(block.tobytes())
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_trajectory_writer(path: str, output_format: str, header: Dict, mode: str = "w"):
+    """Open a writer for the given output format ("text" or "binary")"""
+    if output_format == "text":
+        return TextTrajectoryWriter(path, header, mode)
+    if output_format == "binary":
+        return BinaryTrajectoryWriter(path, header, mode)
+    raise ValueError(f"Unknown output format: {output_format}")
+
+def encode_header(header: Dict, magic: bytes = MAGIC, reserve: int = 0) -> bytes:
+    """Serialise a header dictionary into the binary file prefix, with reserve spare bytes"""
+    payload = json.dumps(header).encode("utf-8") + b" " * reserve
+    # Pad so that the first frame is 8-byte aligned
+    padding = -(len(magic) + 4 + len(payload)) % 8
+    payload += b" " * padding
+    return magic + struct.pack("<I", len(payload)) + payload
+
+def read_header(path: str, magic: bytes = MAGIC) -> Tuple[Dict, int]:
+    """Read the header of a binary trajectory, returning it with the byte offset of the first frame"""
+    with open(path, "rb") as trajectory_file:
+        prefix = trajectory_file.read(len(magic) + 4)
+        if len(prefix) < len(magic) + 4 or prefix[:len(magic)] != magic:
+            raise ValueError(f"Not a binary trajectory file: {path}")
+        (length,) = struct.unpack("<I", prefix[len(magic):])
+        header = json.loads(trajectory_file.read(length).decode("utf-8"))
+    return header, len(magic) + 4 + length
+
+def update_header(path: str, header: Dict, magic: bytes = MAGIC) -> None:
+    """
+    Replace the header of a binary trajectory in place. The new header must fit in the space of
+    the old one, including its spare bytes, so that the frames do not move.
+    """
+    _, data_offset = read_header(path, magic)
+    payload = json.dumps(header).encode("utf-8")
+    length = data_offset - len(magic) - 4
+    if len(payload) > length:
+        raise ValueError(f"The new header of {path} does not fit in its {length} bytes")
+    with open(path, "r+b") as trajectory_file:
+        trajectory_file.seek(len(magic) + 4)
+        trajectory_file.write(payload + b" " * (length - len(payload)))
+
+class TrajectoryReader:
+    """
+    Memory-mapped reader for binary trajectories.
+
+    Attributes
+    ----------
+    header: dictionary with labels, masses, dt, method and output_interval
+    labels: particle names
+    masses: [N] array of particle masses
+    n_frames: number of complete frames in the file
+
+    Methods
+    -------
+    frames: structured frame records in a range
+    times, positions, velocities, energy, momentum: field views in a range
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header, self.data_offset = read_header(path)
+        self.labels = self.header["labels"]
+        self.masses = np.asarray(self.header["masses"], dtype=float)
+        self.dtype = frame_dtype(len(self.labels))
+        with open(path, "rb") as trajectory_file:
+            trajectory_file.seek(0, 2)
+            size = trajectory_file.tell()
+        # A partially written trailing frame is ignored
+        self.n_frames = (size - self.data_offset) // self.dtype.itemsize
+        if self.n_frames > 0:
+            self._frames = np.memmap(path, dtype=self.dtype, mode="r", offset=self.data_offset, shape=(self.n_frames,))
+        else:
+            self._frames = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self) -> int:
+        return self.n_frames
+
+    def frames(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Structured view of frames [start, stop)"""
+        return self._frames[start:stop]
+
+    def times(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return self._frames["time"][start:stop]
+
+    def positions(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return self._frames["positions"][start:stop]
+
+    def velocities(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return self._frames["velocities"][start:stop]
+
+    def energy(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return self._frames["energy"][start:stop]
+
+    def momentum(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return self._frames["momentum"][start:stop]
+
+def read_text_trajectory(path: str) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    Parse a text trajectory into labels and [F,N,3] position and velocity arrays.
+    The dMomentum/dEnergy lines are skipped.
+    """
+    with open(path, "r") as trajectory_file:
+        lines = [line for line in trajectory_file.read().splitlines() if line.strip()]
+    particle_lines = [line for line in lines if not line.startswith("d")]
+    if not particle_lines:
+        return [], np.zeros((0, 0, 3)), np.zeros((0, 0, 3))
+
+    # Particles of the first frame are the lines between its dEnergy line and the next dMomentum line
+    first_frame = lines[2:]
+    n_particles = next((i for i, line in enumerate(first_frame) if line.startswith("d")), len(first_frame))
+    labels = [line.split()[0] for line in particle_lines[:n_particles]]
+    values = np.array([line.split()[1:7] for line in particle_lines], dtype=float)
+    values = values[:len(values) - len(values) % n_particles].reshape(-1, n_particles, 6)
+    return labels, values[..., :3], values[..., 3:]
+
+def system_energy_momentum(masses: np.ndarray, positions: np.ndarray, velocities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Total energy and momentum of each frame of [F,N,3] arrays"""
+    separations = Forces_and_Separations.compute_separations_array(positions)
+    _, potential = Forces_and_Separations.compute_forces_potential_array(masses, separations)
+    kinetic = 0.5 * np.sum(masses * np.sum(velocities ** 2, axis=-1), axis=-1)
+    momentum = np.sum(masses[..., np.newaxis] * velocities, axis=-2)
+    return kinetic + potential, momentum
+
+def text_to_binary(text_path: str, binary_path: str, masses: Optional[List[float]] = None,
+                   dt: Optional[float] = None, method: Optional[int] = None, output_interval: float = 0.05) -> None:
+    """
+    Convert a text trajectory to the binary layout.
+
+    The text layout carries neither masses nor absolute energy and momentum, so these are
+    recomputed from the stored states using the given masses (1 for every particle by default).
+    Frame times are reconstructed from dt (see output_times).
+    """
+    labels, positions, velocities = read_text_trajectory(text_path)
+    masses = np.ones(len(labels)) if masses is None else np.asarray(masses, dtype=float)
+    header = {"labels": labels, "masses": masses.tolist(), "dt": dt, "method": method, "output_interval": output_interval}
+    energy, momentum = system_energy_momentum(masses, positions, velocities)
+    frames = np.zeros(len(positions), dtype=frame_dtype(len(labels)))
+    frames["time"] = output_times(len(positions), dt, output_interval)
+    frames["positions"] = positions
+    frames["velocities"] = velocities
+    frames["energy"] = energy
+    frames["momentum"] = momentum
+    with open(binary_path, "wb") as binary_file:
+        binary_file.write(encode_header(header))
+        binary_file.write(frames.tobytes())
+
+def binary_to_text(binary_path: str, text_path: str) -> None:
+    """
+    Convert a binary trajectory to the text layout read by the frontend. The dMomentum and
+    dEnergy lines hold the change since the previous output frame.
+    """
+    reader = TrajectoryReader(binary_path)
+    energy = np.asarray(reader.energy())
+    momentum = np.asarray(reader.momentum())
+    d_energy = np.diff(energy, prepend=energy[:1])
+    d_momentum = np.diff(momentum, axis=0, prepend=momentum[:1])
+    with open(text_path, "w") as text_file:
+        for i, frame in enumerate(reader.frames()):
+            write_frame(text_file, reader.labels, frame["positions"], frame["velocities"], tuple(d_momentum[i]), d_energy[i])
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert trajectories between the text and binary layouts")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_binary = subparsers.add_parser("to-binary", help="Convert a text trajectory to the binary layout")
+    to_binary.add_argument("text_path")
+    to_binary.add_argument("binary_path")
+    to_binary.add_argument("--masses", type=float, nargs="+", help="Particle masses (default 1 for every particle)")
+    to_binary.add_argument("--dt", type=float)
+    to_binary.add_argument("--method", type=int)
+    to_text = subparsers.add_parser("to-text", help="Convert a binary trajectory to the text layout")
+    to_text.add_argument("binary_path")
+    to_text.add_argument("text_path")
+    args = parser.parse_args()
+
+    if args.command == "to-binary":
+        text_to_binary(args.text_path, args.binary_path, args.masses, args.dt, args.method)
+    else:
+        binary_to_text(args.binary_path, args.text_path)
+
+if __name__ == "__main__":
+    main()